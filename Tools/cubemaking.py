@@ -7,9 +7,12 @@ binning the data.
 # Imports
 #==================================================
 
+import os
 import ctools
+import gammalib
 import numpy as np
 from kesacco.Tools import utilities
+from kesacco.Tools import pipeline_stages
 
 #==================================================
 # Counts bin
@@ -19,6 +22,7 @@ def counts_cube(output_dir,
                 map_reso, map_coord, map_fov,
                 emin, emax, enumbins, ebinalg,
                 stack=True,
+                inobs=None,
                 logfile=None,
                 silent=False):
     """
@@ -38,6 +42,8 @@ def counts_cube(output_dir,
     - enumbins (int): the number of energy bins
     - ebinalg (str): the energy binning algorithm
     - stack (bool): do we use stacking of individual event files or not
+    - inobs (GObservations): in memory observations (e.g. ctselect.obs()),
+    used instead of reading Ana_EventsSelected.xml
     - silent (bool): use this keyword to print information
 
     Outputs
@@ -51,9 +57,12 @@ def counts_cube(output_dir,
 
     npix = utilities.npix_from_fov_def(map_fov, map_reso)
     
-    ctscube = ctools.ctbin()
+    if inobs is None:
+        ctscube = ctools.ctbin()
+    else:
+        ctscube = ctools.ctbin(inobs)
     
-    ctscube['inobs']      = output_dir+'/Ana_EventsSelected.xml'
+    if inobs is None: ctscube['inobs'] = output_dir+'/Ana_EventsSelected.xml'
     if stack:
         ctscube['outobs'] = output_dir+'/Ana_Countscube.fits'
     else:
@@ -93,6 +102,7 @@ def counts_cube(output_dir,
 def exp_cube(output_dir,
              map_reso, map_coord, map_fov,
              emin, emax, enumbins, ebinalg,
+             inobs=None,
              logfile=None,
              silent=False):
     """
@@ -112,6 +122,8 @@ def exp_cube(output_dir,
     - emin/emax (float): min and max energy in TeV
     - enumbins (int): the number of energy bins
     - ebinalg (str): the energy binning algorithm
+    - inobs (GObservations): in memory observations (e.g. ctselect.obs()),
+    used instead of reading Ana_EventsSelected.xml
     - silent (bool): use this keyword to print information
 
     Outputs
@@ -122,9 +134,12 @@ def exp_cube(output_dir,
 
     npix = utilities.npix_from_fov_def(map_fov, map_reso)
     
-    expcube = ctools.ctexpcube()
+    if inobs is None:
+        expcube = ctools.ctexpcube()
+    else:
+        expcube = ctools.ctexpcube(inobs)
     
-    expcube['inobs']      = output_dir+'/Ana_EventsSelected.xml'
+    if inobs is None: expcube['inobs'] = output_dir+'/Ana_EventsSelected.xml'
     expcube['incube']     = output_dir+'/Ana_Countscube.fits'
     #expcube['caldb']      = 
     #expcube['irf']        = 
@@ -164,6 +179,7 @@ def psf_cube(output_dir,
              map_reso, map_coord, map_fov,
              emin, emax, enumbins, ebinalg,
              amax=0.3, anumbins=200,
+             inobs=None,
              logfile=None,
              silent=False):
     """
@@ -186,6 +202,8 @@ def psf_cube(output_dir,
     - amax (float): Upper bound of angular separation between true and 
     measued photon direction (in degrees).
     - anumbins (int): Number of angular separation bins.
+    - inobs (GObservations): in memory observations (e.g. ctselect.obs()),
+    used instead of reading Ana_EventsSelected.xml
     - silent (bool): use this keyword to print information
 
     Outputs
@@ -195,9 +213,12 @@ def psf_cube(output_dir,
 
     npix = utilities.npix_from_fov_def(map_fov, map_reso)
     
-    psfcube = ctools.ctpsfcube()
+    if inobs is None:
+        psfcube = ctools.ctpsfcube()
+    else:
+        psfcube = ctools.ctpsfcube(inobs)
 
-    psfcube['inobs']      = output_dir+'/Ana_EventsSelected.xml'
+    if inobs is None: psfcube['inobs'] = output_dir+'/Ana_EventsSelected.xml'
     psfcube['incube']     = output_dir+'/Ana_Countscube.fits'
     #psfcube['caldb']      =
     #psfcube['irf']        =
@@ -236,6 +257,7 @@ def psf_cube(output_dir,
 #==================================================
 
 def bkg_cube(output_dir,
+             inobs=None,
              logfile=None,
              silent=False):
     """
@@ -246,6 +268,8 @@ def bkg_cube(output_dir,
     ----------
     - output_dir (str): directory where to get input files and 
     save outputs
+    - inobs (GObservations): in memory observations (e.g. ctselect.obs()),
+    used instead of reading Ana_EventsSelected.xml
     - silent (bool): use this keyword to print information
 
     Outputs
@@ -255,9 +279,12 @@ def bkg_cube(output_dir,
     including the stacked background
     """
     
-    bkgcube = ctools.ctbkgcube()
+    if inobs is None:
+        bkgcube = ctools.ctbkgcube()
+    else:
+        bkgcube = ctools.ctbkgcube(inobs)
 
-    bkgcube['inobs']    = output_dir+'/Ana_EventsSelected.xml'
+    if inobs is None: bkgcube['inobs'] = output_dir+'/Ana_EventsSelected.xml'
     bkgcube['incube']   = output_dir+'/Ana_Countscube.fits'
     bkgcube['inmodel']  = output_dir+'/Ana_Model_Input_Unstack.xml'
     #bkgcube['caldb']    =
@@ -285,6 +312,7 @@ def edisp_cube(output_dir,
                map_coord, map_fov,
                emin, emax, enumbins, ebinalg,
                binsz=1.0, migramax=2.0, migrabins=100,
+               inobs=None,
                logfile=None,
                silent=False):
     """
@@ -307,6 +335,8 @@ def edisp_cube(output_dir,
     - migramax (float): Upper bound of ratio between reconstructed and 
     true photon energy.
     - migrabins (int): Number of migration bins.
+    - inobs (GObservations): in memory observations (e.g. ctselect.obs()),
+    used instead of reading Ana_EventsSelected.xml
     - silent (bool): use this keyword to print information
 
     Outputs
@@ -316,9 +346,12 @@ def edisp_cube(output_dir,
 
     npix = utilities.npix_from_fov_def(map_fov.to_value('deg'), binsz)
 
-    edcube = ctools.ctedispcube()
+    if inobs is None:
+        edcube = ctools.ctedispcube()
+    else:
+        edcube = ctools.ctedispcube(inobs)
 
-    edcube['inobs']      = output_dir+'/Ana_EventsSelected.xml'
+    if inobs is None: edcube['inobs'] = output_dir+'/Ana_EventsSelected.xml'
     edcube['incube']     = 'NONE' #output_dir+'/Ana_Countscube.fits'
     #edcube['caldb']    = 
     #edcube['irf']      =
@@ -352,6 +385,129 @@ def edisp_cube(output_dir,
     return edcube
 
 
+#==================================================
+# All cubes in parallel
+#==================================================
+
+def make_cubes_parallel(output_dir,
+                        map_reso, map_coord, map_fov,
+                        emin, emax, enumbins, ebinalg,
+                        edisp=False,
+                        nproc=2,
+                        inobs=None,
+                        silent=False):
+    """
+    Compute the stacked and unstacked counts cubes, the exposure, psf,
+    background and (optionally) energy dispersion cubes, running the ctools
+    in separate processes. The exposure, psf and background cubes wait for 
+    the stacked counts cube, which defines their geometry. The unstacked 
+    counts cube and the edisp cube are independent.
+
+    Parameters
+    ----------
+    - output_dir (str): directory where to get input files and 
+    save outputs
+    - map_reso (float): the resolution of the map (can be an
+    astropy.unit object, or in deg)
+    - map_coord (float): a skycoord object that give the center of the map
+    - map_fov (float): the field of view of the map (can be an 
+    astropy.unit object, or in deg)
+    - emin/emax (float): min and max energy in TeV
+    - enumbins (int): the number of energy bins
+    - ebinalg (str): the energy binning algorithm
+    - edisp (bool): compute the energy dispersion cube
+    - nproc (int): maximum number of ctools running at the same time
+    - inobs (GObservations): in memory selected observations, shared by
+    the forked processes
+    - silent (bool): use this keyword to print information
+
+    Outputs
+    --------
+    - The cubes and log files of counts_cube (stacked: Ana_Countscube_log.txt,
+    unstacked: Ana_Countscube_Unstack_log.txt), exp_cube, psf_cube, 
+    bkg_cube and edisp_cube
+    - outs (list): None for each cube, since the ctools objects live in the
+    child processes
+    """
+
+    mapdef = (map_reso, map_coord, map_fov, emin, emax, enumbins, ebinalg)
+    
+    stages = [pipeline_stages.make_stage('Countscube',
+                                         lambda: counts_cube(output_dir, *mapdef, stack=True, inobs=inobs,
+                                                             logfile=output_dir+'/Ana_Countscube_log.txt',
+                                                             silent=silent)),
+              pipeline_stages.make_stage('Countscube_Unstack',
+                                         lambda: counts_cube(output_dir, *mapdef, stack=False, inobs=inobs,
+                                                             logfile=output_dir+'/Ana_Countscube_Unstack_log.txt',
+                                                             silent=silent)),
+              pipeline_stages.make_stage('Expcube',
+                                         lambda: exp_cube(output_dir, *mapdef, inobs=inobs,
+                                                          logfile=output_dir+'/Ana_Expcube_log.txt',
+                                                          silent=silent),
+                                         depends=['Countscube']),
+              pipeline_stages.make_stage('Psfcube',
+                                         lambda: psf_cube(output_dir, *mapdef, inobs=inobs,
+                                                          logfile=output_dir+'/Ana_Psfcube_log.txt',
+                                                          silent=silent),
+                                         depends=['Countscube']),
+              pipeline_stages.make_stage('Bkgcube',
+                                         lambda: bkg_cube(output_dir, inobs=inobs,
+                                                          logfile=output_dir+'/Ana_Bkgcube_log.txt',
+                                                          silent=silent),
+                                         depends=['Countscube'])]
+    if edisp:
+        stages.append(pipeline_stages.make_stage('Edispcube',
+                                                 lambda: edisp_cube(output_dir, map_coord, map_fov,
+                                                                    emin, emax, enumbins, ebinalg,
+                                                                    inobs=inobs,
+                                                                    logfile=output_dir+'/Ana_Edispcube_log.txt',
+                                                                    silent=silent)))
+    
+    pipeline_stages.run_stages(stages, None, nproc=nproc, silent=silent)
+    
+    return [None]*len(stages)
+
+
+#==================================================
+# Stacked observation, in memory
+#==================================================
+
+_STACKED_OBS = {}
+
+def stacked_obs(output_dir, edisp=False):
+    """
+    Build the stacked observation from the counts and response cubes, 
+    and keep it in memory so that successive model cubes (e.g. the grid 
+    nodes) do not read the cubes again. The cache is invalidated when 
+    the cube files change.
+
+    Parameters
+    ----------
+    - output_dir (str): directory where to get the cubes
+    - edisp (bool): include the energy dispersion cube
+
+    Outputs
+    --------
+    - obs (GObservations): the stacked observation
+    """
+
+    files = [output_dir+'/Ana_Countscube.fits',
+             output_dir+'/Ana_Expcube.fits',
+             output_dir+'/Ana_Psfcube.fits']
+    if edisp:
+        files.append(output_dir+'/Ana_Edispcube.fits')
+    files.append(output_dir+'/Ana_Bkgcube.fits')
+    
+    key = tuple([(f, os.stat(f).st_mtime_ns) for f in files])
+    if key not in _STACKED_OBS:
+        _STACKED_OBS.clear()
+        obs = gammalib.GObservations()
+        obs.append(gammalib.GCTAObservation(*files))
+        _STACKED_OBS[key] = obs
+
+    return _STACKED_OBS[key]
+
+
 #==================================================
 # Model cube
 #==================================================
@@ -363,6 +519,7 @@ def model_cube(output_dir,
                stack=True,
                inmodel_usr=None,
                outmap_usr=None,
+               inmemory=False,
                logfile=None,
                silent=False):
     """
@@ -382,8 +539,12 @@ def model_cube(output_dir,
     - enumbins (int): the number of energy bins
     - ebinalg (str): the energy binning algorithm
     - stack (bool): do we use stacking of individual event files or not
-    - inmodel_usr (str): use this keyword to pass non default inmodel
+    - inmodel_usr (str or GModels): use this keyword to pass non default inmodel,
+    either as an xml file or as an in memory GModels
     - outmap_usr (str): use this keyword to pass non default outmap
+    - inmemory (bool): in the stacked case, use the in memory stacked 
+    observation (see stacked_obs), which carries the response cubes, 
+    instead of reading the cubes. The model cube is still saved in outmap.
     - silent (bool): use this keyword to print information
 
     Outputs
@@ -392,22 +553,28 @@ def model_cube(output_dir,
     
     npix = utilities.npix_from_fov_def(map_fov, map_reso)
     
-    model = ctools.ctmodel()
+    if stack and inmemory:
+        model = ctools.ctmodel(stacked_obs(output_dir, edisp=edisp))
+    else:
+        model = ctools.ctmodel()
     
     if stack:
-        model['inobs'] = output_dir+'/Ana_Countscube.fits'
+        if not inmemory: model['inobs'] = output_dir+'/Ana_Countscube.fits'
     else:
         model['inobs'] = output_dir+'/Ana_ObsDef.xml'
     if inmodel_usr is None:
         model['inmodel']   = output_dir+'/Ana_Model_Output.xml'
-    else:
+    elif isinstance(inmodel_usr, str):
         model['inmodel']   = inmodel_usr
+    else:
+        model['inmodel']   = 'NONE'
+        model.models(inmodel_usr) # in memory model, no xml round trip
     model['incube']    = 'NONE'
     model['expcube']   = 'NONE'
     model['psfcube']   = 'NONE'
     model['edispcube'] = 'NONE'
     model['bkgcube']   = 'NONE'
-    if stack:
+    if stack and not inmemory:
         model['incube']    = output_dir+'/Ana_Countscube.fits'
         model['expcube']   = output_dir+'/Ana_Expcube.fits'
         model['psfcube']   = output_dir+'/Ana_Psfcube.fits'
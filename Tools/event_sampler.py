@@ -0,0 +1,293 @@
+"""
+This file contains a NumPy event sampler for the diffuse cluster component.
+Photons are drawn from the Sim_Model_Map.fits and Sim_Model_Spectrum.txt
+templates, folded with an on-axis effective area and a Gaussian PSF. It is
+much faster than ctobssim, at the cost of ignoring the off-axis IRF variations,
+the energy dispersion and the background, so it is meant for Monte Carlo
+studies of the cluster signal.
+
+"""
+
+#==================================================
+# Requested imports
+#==================================================
+
+import os
+import hashlib
+import numpy as np
+import astropy.units as u
+from astropy.io import fits
+from astropy.wcs import WCS
+from astropy.time import Time
+
+
+#==================================================
+# Read the spectrum template
+#==================================================
+
+def read_spectrum_template(filename):
+    """
+    Read the spectrum template written by make_cluster_template.make_spectrum.
+
+    Parameters
+    ----------
+    - filename (str): the spectrum file
+
+    Outputs
+    --------
+    - energy (quantity array): the energy
+    - spectrum (quantity array): the spectrum, in MeV-1 cm-2 s-1
+    """
+
+    energy = []
+    spectrum = []
+    with open(filename, 'r') as f:
+        for line in f:
+            cols = line.split()
+            try:
+                e, s = float(cols[0]), float(cols[1])
+            except (ValueError, IndexError): # header lines
+                continue
+            energy.append(e)
+            spectrum.append(s)
+
+    return np.array(energy)*u.MeV, np.array(spectrum)*u.Unit('MeV-1 cm-2 s-1')
+
+
+#==================================================
+# On-axis IRF from the calibration database
+#==================================================
+
+def onaxis_irf(irf_file, cache_dir=None):
+    """
+    Extract the on-axis effective area and Gaussian PSF width from a
+    CTA IRF fits file (e.g. $CALDB/data/cta/{caldb}/bcf/{irf}/irf_file.fits.gz).
+    The result can be cached as a small npz file, to avoid reading the IRF
+    at each simulation.
+
+    Parameters
+    ----------
+    - irf_file (str): the IRF fits file
+    - cache_dir (str): directory where to cache the result, None for no cache
+
+    Outputs
+    --------
+    - energy (quantity array): the energy (bin centers)
+    - aeff (quantity array): the on-axis effective area
+    - psf_sigma (quantity array): the on-axis PSF width (SIGMA_1)
+    """
+
+    #---------- Check the cache
+    if cache_dir is not None:
+        info = os.stat(irf_file)
+        key = hashlib.md5((os.path.abspath(irf_file)+' '+str(info.st_size)+' '
+                           +str(info.st_mtime_ns)).encode()).hexdigest()
+        cache_file = cache_dir+'/IRF_onaxis_'+key+'.npz'
+        if os.path.isfile(cache_file):
+            data = np.load(cache_file)
+            return data['energy']*u.TeV, data['aeff']*u.cm**2, data['psf_sigma']*u.deg
+
+    #---------- Read the IRF
+    hdul = fits.open(irf_file)
+    aeff_data = hdul['EFFECTIVE AREA'].data
+    psf_data  = hdul['POINT SPREAD FUNCTION'].data
+
+    e_lo = aeff_data['ENERG_LO'][0] * u.Unit(hdul['EFFECTIVE AREA'].columns['ENERG_LO'].unit)
+    e_hi = aeff_data['ENERG_HI'][0] * u.Unit(hdul['EFFECTIVE AREA'].columns['ENERG_HI'].unit)
+    energy = np.sqrt(e_lo*e_hi).to('TeV')
+    aeff = aeff_data['EFFAREA'][0][0,:] * u.Unit(hdul['EFFECTIVE AREA'].columns['EFFAREA'].unit)
+
+    p_lo = psf_data['ENERG_LO'][0] * u.Unit(hdul['POINT SPREAD FUNCTION'].columns['ENERG_LO'].unit)
+    p_hi = psf_data['ENERG_HI'][0] * u.Unit(hdul['POINT SPREAD FUNCTION'].columns['ENERG_HI'].unit)
+    psf_energy = np.sqrt(p_lo*p_hi).to_value('TeV')
+    sigma = psf_data['SIGMA_1'][0][0,:] * u.Unit(hdul['POINT SPREAD FUNCTION'].columns['SIGMA_1'].unit)
+    psf_sigma = np.interp(np.log10(energy.to_value('TeV')), np.log10(psf_energy), sigma.to_value('deg'))*u.deg
+    hdul.close()
+
+    aeff = aeff.to('cm2')
+
+    #---------- Save the cache
+    if cache_dir is not None:
+        if not os.path.exists(cache_dir): os.mkdir(cache_dir)
+        tmpfile = cache_file+'.tmp'+str(os.getpid())+'.npz'
+        np.savez(tmpfile, energy=energy.to_value('TeV'), aeff=aeff.to_value('cm2'),
+                 psf_sigma=psf_sigma.to_value('deg'))
+        os.replace(tmpfile, cache_file)
+
+    return energy, aeff, psf_sigma
+
+
+#==================================================
+# Sample the sky position
+#==================================================
+
+def sample_map(image, wcs, n_events, rng):
+    """
+    Draw sky positions from a map using inverse-CDF sampling on the
+    flattened pixel grid, with a uniform position within the pixel.
+
+    Parameters
+    ----------
+    - image (2d array): the map (any normalization)
+    - wcs (WCS object): the map WCS
+    - n_events (int): the number of positions
+    - rng (numpy Generator): the random generator
+
+    Outputs
+    --------
+    - ra, dec (array): the coordinates in deg
+    """
+
+    cdf = np.cumsum(np.clip(image, 0, None).ravel())
+    if cdf[-1] <= 0:
+        raise ValueError('The map template does not contain any positive pixel.')
+
+    ipix = np.searchsorted(cdf, rng.uniform(0, cdf[-1], n_events), side='right')
+    iy, ix = np.unravel_index(np.clip(ipix, 0, cdf.size-1), image.shape)
+
+    x = ix + rng.uniform(-0.5, 0.5, n_events)
+    y = iy + rng.uniform(-0.5, 0.5, n_events)
+    ra, dec = wcs.wcs_pix2world(x, y, 0)
+
+    return ra, dec
+
+
+#==================================================
+# Sample the energy
+#==================================================
+
+def sample_energy(energy, rate, n_events, rng):
+    """
+    Draw energies from a differential rate using inverse-CDF sampling
+    in log energy, the rate being interpolated as a power law between
+    the energy samples.
+
+    Parameters
+    ----------
+    - energy (array): the energy sampling
+    - rate (array): the differential rate at the energy sampling (dN/dE)
+    - n_events (int): the number of energies
+    - rng (numpy Generator): the random generator
+
+    Outputs
+    --------
+    - energies (array): the energies, same unit as energy
+    """
+
+    lne = np.log(energy)
+    integrand = rate * energy # dN/dlnE
+    cdf = np.concatenate(([0], np.cumsum(0.5*(integrand[1:]+integrand[:-1])*np.diff(lne))))
+
+    return np.exp(np.interp(rng.uniform(0, cdf[-1], n_events), cdf, lne))
+
+
+#==================================================
+# Simulate the cluster events
+#==================================================
+
+def simulate_cluster_events(map_file, spectrum_file, outfile,
+                            livetime,
+                            aeff,
+                            psf_sigma,
+                            emin=50*u.GeV, emax=100*u.TeV,
+                            obsid='000001',
+                            tstart=0.0*u.s,
+                            mjdref=51544.5,
+                            seed=None):
+    """
+    Simulate the events of the cluster component and write an event file
+    which can be read by plotting.events_quicklook.
+
+    Parameters
+    ----------
+    - map_file (str): the map template (Sim_Model_Map.fits)
+    - spectrum_file (str): the spectrum template (Sim_Model_Spectrum.txt)
+    - outfile (str): the output event file
+    - livetime (quantity): the observing live time
+    - aeff (tuple): on-axis effective area as (energy, area) quantity arrays,
+    e.g. from onaxis_irf
+    - psf_sigma (quantity or tuple): Gaussian PSF width, either a single value
+    or (energy, sigma) quantity arrays
+    - emin, emax (quantity): the energy range
+    - obsid (str): the observation ID
+    - tstart (quantity): start time with respect to mjdref
+    - mjdref (float): the reference MJD
+    - seed (int): the seed of the random generator
+
+    Outputs
+    --------
+    - The event file is written
+    - n_events (int): the number of simulated events
+    """
+
+    rng = np.random.default_rng(seed)
+
+    #---------- Expected rate as a function of energy
+    energy, spectrum = read_spectrum_template(spectrum_file)
+    wrange = (energy >= emin) * (energy <= emax)
+    energy = energy[wrange].to_value('TeV')
+    spectrum = spectrum[wrange].to_value('TeV-1 cm-2 s-1')
+    if len(energy) < 2:
+        raise ValueError('The spectrum template does not cover the requested energy range.')
+
+    area = np.interp(np.log10(energy), np.log10(aeff[0].to_value('TeV')), aeff[1].to_value('cm2'),
+                     left=0.0, right=0.0)
+    rate = spectrum * area * livetime.to_value('s') # counts TeV-1
+
+    lne = np.log(energy)
+    n_expected = np.sum(0.5*(rate[1:]*energy[1:] + rate[:-1]*energy[:-1])*np.diff(lne))
+    n_events = rng.poisson(n_expected)
+
+    #---------- Draw the photons
+    header = fits.getheader(map_file)
+    image  = fits.getdata(map_file)
+    ra, dec = sample_map(image, WCS(header), n_events, rng)
+    eng = sample_energy(energy, rate, n_events, rng)
+
+    # PSF: Gaussian offset in the tangent plane
+    if isinstance(psf_sigma, tuple):
+        sigma = np.interp(np.log10(eng), np.log10(psf_sigma[0].to_value('TeV')),
+                          psf_sigma[1].to_value('deg'))
+    else:
+        sigma = psf_sigma.to_value('deg')
+    eta = rng.normal(0, 1, n_events)*sigma*np.pi/180.0 # towards north
+    xi  = rng.normal(0, 1, n_events)*sigma*np.pi/180.0 # towards east
+    dec0 = dec*np.pi/180.0
+    denom = np.cos(dec0) - eta*np.sin(dec0)
+    dec = np.arctan2(np.sin(dec0) + eta*np.cos(dec0), np.sqrt(xi**2 + denom**2))*180.0/np.pi
+    ra  = (ra + np.arctan2(xi, denom)*180.0/np.pi) % 360.0
+
+    tstart = tstart.to_value('s')
+    tstop  = tstart + livetime.to_value('s')
+    time = np.sort(rng.uniform(tstart, tstop, n_events))
+
+    #---------- Write the event file
+    cols = [fits.Column(name='EVENT_ID', format='K', array=np.arange(1, n_events+1)),
+            fits.Column(name='TIME',     format='D', array=time,  unit='s'),
+            fits.Column(name='RA',       format='E', array=ra,    unit='deg'),
+            fits.Column(name='DEC',      format='E', array=dec,   unit='deg'),
+            fits.Column(name='ENERGY',   format='E', array=eng,   unit='TeV')]
+    events = fits.BinTableHDU.from_columns(cols, name='EVENTS')
+
+    date_obs = Time(mjdref + tstart/86400.0, format='mjd').isot.split('T')
+    date_end = Time(mjdref + tstop/86400.0, format='mjd').isot.split('T')
+    events.header['OBS_ID']   = obsid
+    events.header['DATE-OBS'] = date_obs[0]
+    events.header['TIME-OBS'] = date_obs[1]
+    events.header['DATE-END'] = date_end[0]
+    events.header['TIME-END'] = date_end[1]
+    events.header['TSTART']   = tstart
+    events.header['TSTOP']    = tstop
+    events.header['LIVETIME'] = livetime.to_value('s')
+    events.header['TIMEUNIT'] = 's'
+    events.header['MJDREFI']  = int(mjdref)
+    events.header['MJDREFF']  = mjdref - int(mjdref)
+    events.header['EUNIT']    = 'TeV'
+
+    gti = fits.BinTableHDU.from_columns([fits.Column(name='START', format='D', array=[tstart], unit='s'),
+                                         fits.Column(name='STOP',  format='D', array=[tstop],  unit='s')],
+                                        name='GTI')
+
+    fits.HDUList([fits.PrimaryHDU(), events, gti]).writeto(outfile, overwrite=True)
+
+    return n_events
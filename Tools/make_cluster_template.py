@@ -9,10 +9,130 @@ templates are built from a Cluster object (Model class from ClusterModel)
 # Requested imports
 #==================================================
 
+import os
+import shutil
+import hashlib
 import numpy as np
 from astropy.io import fits
 import astropy.units as u
 
+from kesacco.Tools import utilities
+
+
+#==================================================
+# Template cache
+#==================================================
+
+def cache_key(cluster, *args):
+    """
+    Compute the key of a template in the cache, as a hash of the
+    cluster state and of the template parameters.
+    
+    Parameters
+    ----------
+    - cluster: ClusterModel object
+    - args: any other parameter defining the template
+
+    Outputs
+    --------
+    - key (str): the hash
+    """
+
+    state = {}
+    for key in vars(cluster).keys():
+        if key.lstrip('_') not in ['output_dir', 'silent']:
+            state[key] = vars(cluster)[key]
+    
+    md5 = hashlib.md5()
+    utilities.hash_update(md5, state, set([id(cluster)]))
+    for arg in args:
+        utilities.hash_update(md5, arg, set())
+
+    return md5.hexdigest()
+
+
+def cache_fetch(cache_dir, name, filename):
+    """
+    Get a template from the cache, hard-linked (or copied) to the 
+    requested file name.
+    
+    Parameters
+    ----------
+    - cache_dir (str): the cache directory
+    - name (str): the name of the template in the cache
+    - filename (str): where the template is requested
+
+    Outputs
+    --------
+    - hit (bool): True if the template was in the cache
+    """
+
+    cached = cache_dir+'/'+name
+    if not os.path.exists(cached):
+        return False
+
+    # The access time is used for eviction
+    os.utime(cached)
+
+    if os.path.exists(filename):
+        os.remove(filename)
+    try:
+        os.link(cached, filename)
+    except OSError:
+        shutil.copyfile(cached, filename)
+    
+    return True
+
+
+def cache_store(cache_dir, name, filename, cache_size=2e9):
+    """
+    Store a template in the cache, and remove the least recently
+    used templates if the cache exceeds its maximum size.
+    
+    Parameters
+    ----------
+    - cache_dir (str): the cache directory
+    - name (str): the name of the template in the cache
+    - filename (str): the file of the template
+    - cache_size (float): maximum size of the cache in bytes
+
+    Outputs
+    --------
+    - the template is copied in the cache
+    """
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+
+    # Atomic, in case several processes share the cache
+    tmpfile = cache_dir+'/.'+name+'.tmp'+str(os.getpid())
+    shutil.copyfile(filename, tmpfile)
+    os.replace(tmpfile, cache_dir+'/'+name)
+
+    # Least recently used eviction
+    entries = []
+    for fname in os.listdir(cache_dir):
+        if fname.startswith('.'):
+            continue
+        try:
+            stat = os.stat(cache_dir+'/'+fname)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, fname))
+    entries.sort()
+    
+    total_size = np.sum([entry[1] for entry in entries])
+    for mtime, size, fname in entries:
+        if total_size <= cache_size:
+            break
+        if fname == name:
+            continue
+        try:
+            os.remove(cache_dir+'/'+fname)
+            total_size -= size
+        except OSError:
+            pass
+
 
 #==================================================
 # Maps
@@ -22,7 +142,9 @@ def make_map(cluster,
              filename,
              Egmin=5e-2*u.TeV,
              Egmax=1e+2*u.TeV,
-             includeIC=False):
+             includeIC=False,
+             cache_dir=None,
+             cache_size=2e9):
     """
     Compute the map of a cluster for ctools.
         
@@ -35,6 +157,8 @@ def make_map(cluster,
     emission because the shape of the profile is the same at all energies,
     but has (very) little effect on IC emission.
     - includeIC (bool): include inverse compton emission or not
+    - cache_dir (str): directory of the template cache, None for no cache
+    - cache_size (float): maximum size of the template cache in bytes
     
     Outputs
     --------
@@ -43,6 +167,12 @@ def make_map(cluster,
     
     header = cluster.get_map_header()
 
+    #----- Get the map from the cache if available
+    if cache_dir is not None:
+        key = cache_key(cluster, 'map', header.tostring(), Egmin, Egmax, includeIC)
+        if cache_fetch(cache_dir, key+'.fits', filename):
+            return
+
     #----- IC + pion decay
     if includeIC:
         flux1 = cluster.get_ic_flux(Rmin=cluster._Rmin,
@@ -84,7 +214,12 @@ def make_map(cluster,
     hdu.data = image.value
     hdu.header.add_comment('Gamma map')
     hdu.header.add_comment('Unit = '+str(image.unit))
+    if os.path.exists(filename): # Do not write through a hard link to the cache
+        os.remove(filename)
     hdu.writeto(filename, overwrite=True)
+
+    if cache_dir is not None:
+        cache_store(cache_dir, key+'.fits', filename, cache_size=cache_size)
     
     
 #==================================================
@@ -94,7 +229,9 @@ def make_map(cluster,
 def make_spectrum(cluster,
                   filename,
                   energy=np.logspace(-2,6,1000)*u.GeV,
-                  includeIC=False):
+                  includeIC=False,
+                  cache_dir=None,
+                  cache_size=2e9):
     """
     Compute the spectrum of a cluster for ctools.
     
@@ -104,11 +241,19 @@ def make_spectrum(cluster,
     - filename: in which file to save the results
     - energy (quantity array): the photon energy sampling
     - includeIC (bool): include inverse compton emission or not
+    - cache_dir (str): directory of the template cache, None for no cache
+    - cache_size (float): maximum size of the template cache in bytes
     
     Outputs
     --------
     - fits file map is saved
     """
+
+    #---------- Get the spectrum from the cache if available
+    if cache_dir is not None:
+        key = cache_key(cluster, 'spectrum', energy, includeIC)
+        if cache_fetch(cache_dir, key+'.txt', filename):
+            return
     
     #---------- pion decay
     eng, spec = cluster.get_gamma_spectrum(energy,
@@ -130,10 +275,13 @@ def make_spectrum(cluster,
     spec   = spec[wgood]
 
     #---------- Write the file
+    if os.path.exists(filename): # Do not write through a hard link to the cache
+        os.remove(filename)
     cluster._save_txt_file(filename,
                            energy.to_value('MeV'),
                            spec.to_value('MeV-1 cm-2 s-1'),
                            'energy (MeV)',
                            'spectrum (MeV-1 cm-2 s-1)')
-        
-    
+
+    if cache_dir is not None:
+        cache_store(cache_dir, key+'.txt', filename, cache_size=cache_size)
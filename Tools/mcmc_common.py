@@ -8,13 +8,32 @@ that are common to the different implemented methods
 # Requested imports
 #==================================================
 
+import os
+import shutil
+import socket
 import pickle
+import time
+import hashlib
+import warnings
+import contextlib
+import multiprocessing
+from multiprocessing import shared_memory
 import numpy as np
+from scipy import special, stats
+import emcee
+from astropy.io import fits
+import astropy.units as u
+from astropy.wcs import WCS
+from astropy.coordinates.sky_coordinate import SkyCoord
 import matplotlib.pyplot as plt
 import pandas as pd
 import corner
 
+from minot.ClusterTools import map_tools
+from kesacco.Tools import radial_profile
 from kesacco.Tools import plotting
+from kesacco.Tools import utilities
+from kesacco.Tools import make_cluster_template
 
 #==================================================
 # Save object
@@ -61,6 +80,1261 @@ def load_object(filename):
     return obj
 
 
+#==================================================
+# Chains stored on disk during the sampling
+#==================================================
+
+def file_signature(filename):
+    '''
+    Describe the state of a file by its size and modification time.
+
+    Parameters
+    ----------
+    - filename (str): the file
+
+    Output
+    ------
+    - signature (str): size and modification time, or 'missing'
+    '''
+
+    if not os.path.isfile(filename):
+        return 'missing'
+    
+    info = os.stat(filename)
+    return str(info.st_size)+' '+str(info.st_mtime_ns)
+
+
+def chains_backend(filename, nwalkers, ndim, reset=False, config=None):
+    '''
+    Open the HDF5 file in which the chains and log probabilities are
+    appended step after step during the sampling. Only the samples are
+    stored, not the likelihood arguments (data, model grids), and the
+    sampling can be resumed from the last stored state. A hash of the
+    fit configuration is stored with the chains, and chains obtained
+    with another configuration are not resumed.
+
+    Parameters
+    ----------
+    - filename (str): the HDF5 file
+    - nwalkers (int): number of walkers
+    - ndim (int): number of parameters
+    - reset (bool): discard the chains already stored
+    - config (dict): the fit configuration (e.g. likelihood, prior range,
+    data and model files)
+
+    Output
+    ------
+    - backend (emcee HDFBackend): the backend to give to the sampler
+    - resume (bool): True if the stored chains are continued
+    '''
+
+    md5 = hashlib.md5()
+    utilities.hash_update(md5, config, set())
+    config_hash = md5.hexdigest()
+    
+    backend = emcee.backends.HDFBackend(filename)
+
+    resume = False
+    if os.path.exists(filename) and not reset:
+        try:
+            iteration = backend.iteration
+            shape = backend.shape
+            with backend.open() as f:
+                config_previous = f[backend.name].attrs.get('config')
+        except (KeyError, OSError):
+            iteration = 0
+            shape = None
+            config_previous = None
+        if iteration > 0 and shape == (nwalkers, ndim) and config_previous == config_hash:
+            resume = True
+        elif iteration > 0 and shape != (nwalkers, ndim):
+            print('WARNING: the stored chains have (nwalkers, ndim) = '+str(shape)+
+                  ', not '+str((nwalkers, ndim))+'. They are reset.')
+        elif iteration > 0:
+            print('WARNING: the stored chains were obtained with another configuration. They are reset.')
+
+    if not resume:
+        backend.reset(nwalkers, ndim)
+        with backend.open('a') as f:
+            f[backend.name].attrs['config'] = config_hash
+
+    return backend, resume
+
+
+#==================================================
+# Parallel and resumable computation of grid nodes
+#==================================================
+
+# Nodes of the grid being computed, inherited by the forked workers
+_GRID_STATE = {}
+
+def _lock_is_stale(lockfile, lock_timeout):
+    """
+    Tell if a lock file was left by a dead process, or is older than
+    the timeout.
+    """
+    try:
+        with open(lockfile) as f:
+            owner = f.read().split()
+        age = time.time() - os.path.getmtime(lockfile)
+    except (OSError, IOError):
+        return False
+
+    if lock_timeout is not None and age > lock_timeout:
+        return True
+    
+    if len(owner) == 2 and owner[0] == socket.gethostname():
+        try:
+            os.kill(int(owner[1]), 0)
+        except ProcessLookupError:
+            return True
+        except (PermissionError, ValueError):
+            return False
+    
+    return False
+
+
+def _reclaim_stale_lock(lockfile, lock_timeout):
+    """
+    Remove a stale lock file, so that only one of the jobs which found it
+    stale can claim the node. The lock is atomically renamed to a name
+    unique to this job, and removed only if the renamed file is still
+    stale: a job which found it stale too late may have renamed the fresh
+    lock of the winner, which is then put back.
+    """
+    stalefile = lockfile+'.stale_'+socket.gethostname()+'_'+str(os.getpid())
+    try:
+        os.rename(lockfile, stalefile)
+    except FileNotFoundError:
+        return False
+
+    if _lock_is_stale(stalefile, lock_timeout):
+        os.remove(stalefile)
+        return True
+
+    try:
+        os.link(stalefile, lockfile)
+    except FileExistsError:
+        pass
+    os.remove(stalefile)
+    return False
+
+
+def _claim_grid_node(tag):
+    """
+    Claim a node through the atomic creation of its lock file.
+    """
+    lockfile = _GRID_STATE['subdir']+'/Grid_Lock/'+tag+'.lock'
+    
+    for attempt in range(2):
+        try:
+            fd = os.open(lockfile, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if attempt == 0 and _lock_is_stale(lockfile, _GRID_STATE['lock_timeout']):
+                if _reclaim_stale_lock(lockfile, _GRID_STATE['lock_timeout']):
+                    continue
+            return False
+        os.write(fd, (socket.gethostname()+' '+str(os.getpid())).encode())
+        os.close(fd)
+        return True
+    
+    return False
+
+
+def _run_grid_node(tag):
+    """
+    Compute a node in its own working directory, move the outputs to
+    the grid directory and record the node as done.
+    """
+    subdir = _GRID_STATE['subdir']
+    donefile = subdir+'/Grid_Done/'+tag
+    
+    if os.path.exists(donefile) or not _claim_grid_node(tag):
+        return False
+
+    lockfile = subdir+'/Grid_Lock/'+tag+'.lock'
+    workdir = subdir+'/Grid_Work/'+tag
+    try:
+        if os.path.exists(workdir):
+            shutil.rmtree(workdir)
+        os.makedirs(workdir)
+
+        _GRID_STATE['nodes'][tag](workdir)
+
+        for fname in os.listdir(workdir):
+            os.replace(workdir+'/'+fname, subdir+'/'+fname)
+        with open(donefile+'.tmp'+str(os.getpid()), 'w') as f:
+            f.write(socket.gethostname()+' '+str(os.getpid())+' '+time.ctime()+'\n')
+        os.replace(donefile+'.tmp'+str(os.getpid()), donefile)
+        shutil.rmtree(workdir)
+    finally:
+        os.remove(lockfile)
+
+    return True
+
+
+def grid_configuration(cpipe, **kwargs):
+    """
+    Collect the configuration on which the nodes of a model grid
+    depend: the cluster state, the analysis map and spectral binning,
+    the analysis cubes (size and modification time), and any other
+    parameter given as keyword argument.
+
+    Parameters
+    ----------
+    - cpipe (ClusterPipe object): the pipeline
+    - kwargs: other parameters defining the nodes (e.g. includeIC)
+
+    Output
+    ------
+    - config (dict): the configuration, to be passed to run_grid_nodes
+
+    """
+
+    config = {'cluster':make_cluster_template.cache_key(cpipe.cluster)}
+    for key in ['map_reso', 'map_coord', 'map_fov',
+                'spec_emin', 'spec_emax', 'spec_enumbins', 'spec_ebinalg', 'spec_edisp',
+                'method_stat']:
+        config[key] = getattr(cpipe, key)
+    
+    for cube in ['Countscube', 'Expcube', 'Psfcube', 'Bkgcube', 'Edispcube']:
+        config[cube] = file_signature(cpipe.output_dir+'/Ana_'+cube+'.fits')
+
+    config.update(kwargs)
+    
+    return config
+
+
+def run_grid_nodes(nodes, subdir, nproc=1, resume=False, config=None,
+                   lock_timeout=86400.0, poll=30.0):
+    """
+    Compute the nodes of a model grid. A manifest of the nodes and of
+    the hash of the model configuration is written in subdir, and the
+    completed nodes are recorded, so that a restart with resume=True only
+    computes the missing nodes, provided the configuration did not change. Each node
+    runs in its own working directory, and is claimed through a lock file,
+    so that several jobs sharing the file system can fill the same grid.
+    This function returns once all the nodes are done.
+
+    Parameters
+    ----------
+    - nodes (list): list of (tag, info, function) for each node, where
+    tag (str) names the node, info (str) describes its parameters, and
+    function computes the node given the working directory in which 
+    the outputs should be written
+    - subdir (str): the directory of the grid
+    - nproc (int): number of processes
+    - resume (bool): keep the nodes computed in a previous run
+    - config (dict): the model configuration on which the nodes depend,
+    see grid_configuration
+    - lock_timeout (float): time in second after which a lock left by
+    another job is considered stale
+    - poll (float): time in second between two checks of the nodes 
+    being computed by other jobs
+
+    Output
+    ------
+    The outputs of all the nodes are in subdir
+
+    """
+
+    global _GRID_STATE
+
+    tags = [node[0] for node in nodes]
+    md5 = hashlib.md5()
+    utilities.hash_update(md5, config, set())
+    manifest = ['config '+md5.hexdigest()] + [node[0]+' '+node[1] for node in nodes]
+    manifest_file = subdir+'/Grid_Manifest.txt'
+
+    #---------- Check or define the manifest
+    if resume and os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest_previous = f.read().splitlines()
+        if manifest_previous[0:1] != manifest[0:1]:
+            raise ValueError('The model configuration has changed since last run, the grid cannot be resumed.')
+        if manifest_previous != manifest:
+            raise ValueError('The grid manifest has changed since last run, the grid cannot be resumed.')
+    else:
+        # Nodes may be under computation by another job sharing the directory
+        if os.path.exists(subdir+'/Grid_Lock'):
+            for fname in os.listdir(subdir+'/Grid_Lock'):
+                if not _lock_is_stale(subdir+'/Grid_Lock/'+fname, lock_timeout):
+                    raise ValueError('The grid node '+fname.replace('.lock', '')+' is being computed '+
+                                     'by another job, the grid cannot be reset.')
+        for dname in ['Grid_Done', 'Grid_Lock', 'Grid_Work']:
+            if os.path.exists(subdir+'/'+dname):
+                shutil.rmtree(subdir+'/'+dname)
+
+    for dname in ['Grid_Done', 'Grid_Lock', 'Grid_Work']:
+        os.makedirs(subdir+'/'+dname, exist_ok=True)
+    with open(manifest_file+'.tmp'+str(os.getpid()), 'w') as f:
+        f.write('\n'.join(manifest)+'\n')
+    os.replace(manifest_file+'.tmp'+str(os.getpid()), manifest_file)
+
+    #---------- Compute the nodes
+    _GRID_STATE = {'nodes':{node[0]:node[2] for node in nodes},
+                   'subdir':subdir,
+                   'lock_timeout':lock_timeout}
+    try:
+        while True:
+            todo = [tag for tag in tags if not os.path.exists(subdir+'/Grid_Done/'+tag)]
+            print('--- Grid nodes: '+str(len(tags))+' in total, '+str(len(tags)-len(todo))+' done')
+            if len(todo) == 0:
+                break
+            
+            if nproc > 1:
+                with multiprocessing.get_context('fork').Pool(min(nproc, len(todo))) as pool:
+                    computed = pool.map(_run_grid_node, todo, chunksize=1)
+            else:
+                computed = [_run_grid_node(tag) for tag in todo]
+
+            # The remaining nodes are being computed by other jobs
+            if not any(computed):
+                time.sleep(poll)
+    finally:
+        _GRID_STATE = {}
+
+
+#==================================================
+# Write a model grid extension cube by cube
+#==================================================
+
+def append_grid_hdu(filename, grid_shape, get_cube, dtype=np.float64):
+    """
+    Append an image extension containing a model grid, of shape
+    grid_shape x (cube shape), to an existing FITS file. The grid is
+    written one cube at a time, so that only a single cube is held
+    in memory.
+
+    Parameters
+    ----------
+    - filename (str): the FITS file, which must already exist
+    - grid_shape (tuple): the shape of the grid of parameters
+    - get_cube (function): function returning the model cube given
+    the index tuple of a grid node
+    - dtype (numpy dtype): precision used to store the grid, e.g.
+    np.float32 or np.float64
+
+    Output
+    ------
+    The extension is appended to the file
+
+    """
+
+    dtype = np.dtype(dtype)
+    
+    for inode, node in enumerate(np.ndindex(*grid_shape)):
+        cube = np.asarray(get_cube(node), dtype=dtype)
+
+        # The header is defined from the first cube
+        if inode == 0:
+            shape = tuple(grid_shape) + cube.shape
+            header = fits.ImageHDU(data=np.zeros((1,)*len(shape), dtype=dtype)).header
+            for iax in range(len(shape)):
+                header['NAXIS'+str(iax+1)] = shape[::-1][iax]
+            shdu = fits.StreamingHDU(filename, header)
+
+        if cube.shape != shape[len(grid_shape):]:
+            shdu.close()
+            raise ValueError('The model cubes do not have all the same shape')
+        
+        shdu.write(cube)
+        
+    shdu.close()
+
+
+#==================================================
+# Open a model grid extension as a memory map
+#==================================================
+
+def read_grid_hdu(hdul, ext, memmap=True):
+    """
+    Get the model grid stored in a FITS image extension. With memmap,
+    the grid is mapped read-only from the file instead of being loaded,
+    so that only the cubes that are used are read.
+
+    Parameters
+    ----------
+    - hdul (HDUList): the opened FITS file
+    - ext (int): the extension number
+    - memmap (bool): return a memory map instead of loading the data
+
+    Output
+    ------
+    - grid (ndarray): the model grid
+
+    """
+
+    hdu = hdul[ext]
+    header = hdu.header
+
+    bitpix2dtype = {-32:'>f4', -64:'>f8', 16:'>i2', 32:'>i4', 64:'>i8'}
+    scaled = header.get('BSCALE', 1) != 1 or header.get('BZERO', 0) != 0
+    
+    if (not memmap) or scaled or header['BITPIX'] not in bitpix2dtype.keys():
+        return np.array(hdu.data)
+
+    shape = tuple([header['NAXIS'+str(iax)] for iax in range(header['NAXIS'], 0, -1)])
+    grid = np.memmap(hdul.filename(), dtype=bitpix2dtype[header['BITPIX']], mode='r',
+                     offset=hdu.fileinfo()['datLoc'], shape=shape)
+    
+    return grid
+
+
+#==================================================
+# Bracketing nodes and weights along a grid axis
+#==================================================
+
+def grid_interp_weights(grid, value):
+    """
+    Find the grid nodes bracketing a given value along a 1D
+    regular (sorted) grid axis, and the associated linear
+    interpolation weights.
+
+    Parameters
+    ----------
+    - grid (1d array): the grid node values, sorted
+    - value (float): the value at which to interpolate
+
+    Output
+    ------
+    - idx (list of int): index of the nodes used for interpolation
+    - wgt (list of float): linear weights associated to the nodes
+
+    """
+
+    Ngrid = len(grid)
+
+    if value < grid[0] or value > grid[-1] or np.isnan(value):
+        raise ValueError('The requested value '+str(value)+' is out of the grid bounds ['
+                         +str(grid[0])+', '+str(grid[-1])+'].')
+
+    if Ngrid == 1:
+        return [0], [1.0]
+
+    i0 = np.searchsorted(grid, value, side='right') - 1
+    i0 = min(max(i0, 0), Ngrid-2)
+    t  = (value - grid[i0]) / (grid[i0+1] - grid[i0])
+
+    return [i0, i0+1], [1.0-t, t]
+
+
+#==================================================
+# Linear interpolation of a model grid along axis 0
+#==================================================
+
+def interp_grid1d(grid, models, value):
+    """
+    Interpolate a stack of precomputed models along their first
+    axis only. This is equivalent to scipy interp1d(grid, models,
+    axis=0)(value), but only the (at most) 2 bracketing models
+    are combined.
+
+    Parameters
+    ----------
+    - grid (1d array): the parameter values of the grid nodes
+    - models (ndarray): models as Ngrid x (model shape)
+    - value (float): the parameter value at which to interpolate
+
+    Output
+    ------
+    - output (ndarray): the interpolated model
+
+    """
+
+    idx, wgt = grid_interp_weights(grid, value)
+
+    output = np.zeros(models.shape[1:])
+    for i, w in zip(idx, wgt):
+        if w != 0:
+            output += w*models[i]
+
+    return output
+
+
+#==================================================
+# Bilinear interpolation of a model grid along axis 0,1
+#==================================================
+
+def interp_grid2d(grid1, grid2, models, value1, value2):
+    """
+    Interpolate a stack of precomputed models along their first
+    two axes only (i.e. parameter axes). The pixel axes are left
+    untouched, so that the result matches scipy interpn over the
+    full grid evaluated at the pixel nodes, but the output is
+    obtained as a weighted sum of at most 4 precomputed models.
+
+    Parameters
+    ----------
+    - grid1 (1d array): the parameter values of the nodes along axis 0
+    - grid2 (1d array): the parameter values of the nodes along axis 1
+    - models (ndarray): models as Ngrid1 x Ngrid2 x (model shape)
+    - value1 (float): the parameter value along axis 0
+    - value2 (float): the parameter value along axis 1
+
+    Output
+    ------
+    - output (ndarray): the interpolated model
+
+    """
+
+    idx1, wgt1 = grid_interp_weights(grid1, value1)
+    idx2, wgt2 = grid_interp_weights(grid2, value2)
+
+    output = np.zeros(models.shape[2:])
+    for i, w1 in zip(idx1, wgt1):
+        for j, w2 in zip(idx2, wgt2):
+            if w1*w2 != 0:
+                output += (w1*w2)*models[i,j]
+
+    return output
+
+
+#==================================================
+# MCMC: flat prior for a batch of walkers
+#==================================================
+
+def lnprior_batch(params, par_min, par_max):
+    '''
+    Return the flat prior on parameters for a batch of walkers
+
+    Parameters
+    ----------
+    - params (ndarray): the parameters as Nwalker x Npar
+    - par_min (list): the minimum value for params
+    - par_max (list): the maximum value for params
+
+    Output
+    ------
+    - prior (array): the value of the prior for each walker, either 0 or -inf
+
+    '''
+
+    params = np.atleast_2d(params)
+
+    inside = np.all((params > np.array(par_min)) * (params < np.array(par_max)), axis=1)
+    prior = np.where(inside, 0.0, -np.inf)
+
+    return prior
+
+
+#==================================================
+# Nodes and weights along a grid axis, walker batch
+#==================================================
+
+def grid_interp_weights_batch(grid, values):
+    """
+    Vectorized version of grid_interp_weights for an array of values.
+    Values outside the grid are clipped to the edges, so they should
+    be rejected beforehand (e.g. via the prior).
+
+    Parameters
+    ----------
+    - grid (1d array): the grid node values, sorted
+    - values (1d array): the values at which to interpolate
+
+    Output
+    ------
+    - idx (ndarray): Nvalue x 2 index of the nodes used for interpolation
+    - wgt (ndarray): Nvalue x 2 linear weights associated to the nodes
+
+    """
+
+    Ngrid  = len(grid)
+    values = np.clip(np.asarray(values, dtype=float), grid[0], grid[-1])
+
+    if Ngrid == 1:
+        idx = np.zeros((len(values), 2), dtype=int)
+        wgt = np.zeros((len(values), 2))
+        wgt[:,0] = 1.0
+        return idx, wgt
+
+    i0 = np.searchsorted(grid, values, side='right') - 1
+    i0 = np.clip(i0, 0, Ngrid-2)
+    t  = (values - grid[i0]) / (grid[i0+1] - grid[i0])
+
+    idx = np.stack([i0, i0+1], axis=1)
+    wgt = np.stack([1.0-t, t], axis=1)
+
+    return idx, wgt
+
+
+#==================================================
+# Weighted sum of the grid models, walker batch
+#==================================================
+
+def _stacked_weighted_sum(weights, models, naxis):
+    """
+    Compute weights @ models, where the first naxis axes of models
+    are flattened as the grid nodes. Only the nodes with non zero
+    weights are read, which matters for memory mapped grids.
+
+    Parameters
+    ----------
+    - weights (ndarray): Nwalker x Nnode weight matrix
+    - models (ndarray): models as (grid shape) x (model shape)
+    - naxis (int): number of grid axes in models
+
+    Output
+    ------
+    - output (ndarray): Nwalker x (model shape)
+
+    """
+
+    model_shape = models.shape[naxis:]
+    models_flat = models.reshape((-1,)+model_shape)
+
+    used = np.where(np.any(weights != 0, axis=0))[0]
+    output = weights[:,used] @ np.asarray(models_flat[used]).reshape(len(used), -1)
+
+    return output.reshape((weights.shape[0],)+model_shape)
+
+
+def interp_grid1d_batch(grid, models, values):
+    """
+    Vectorized version of interp_grid1d for a batch of walkers.
+
+    Parameters
+    ----------
+    - grid (1d array): the parameter values of the grid nodes
+    - models (ndarray): models as Ngrid x (model shape)
+    - values (1d array): the parameter values at which to interpolate
+
+    Output
+    ------
+    - output (ndarray): the interpolated models as Nvalue x (model shape)
+
+    """
+
+    idx, wgt = grid_interp_weights_batch(grid, values)
+
+    weights = np.zeros((len(idx), len(grid)))
+    for k in range(idx.shape[1]):
+        np.add.at(weights, (np.arange(len(idx)), idx[:,k]), wgt[:,k])
+
+    return _stacked_weighted_sum(weights, models, 1)
+
+
+def interp_grid2d_batch(grid1, grid2, models, values1, values2):
+    """
+    Vectorized version of interp_grid2d for a batch of walkers. The
+    interpolated models are obtained as a single stacked weighted sum
+    of the grid models.
+
+    Parameters
+    ----------
+    - grid1 (1d array): the parameter values of the nodes along axis 0
+    - grid2 (1d array): the parameter values of the nodes along axis 1
+    - models (ndarray): models as Ngrid1 x Ngrid2 x (model shape)
+    - values1 (1d array): the parameter values along axis 0
+    - values2 (1d array): the parameter values along axis 1
+
+    Output
+    ------
+    - output (ndarray): the interpolated models as Nvalue x (model shape)
+
+    """
+
+    idx1, wgt1 = grid_interp_weights_batch(grid1, values1)
+    idx2, wgt2 = grid_interp_weights_batch(grid2, values2)
+
+    Nval = len(idx1)
+    weights = np.zeros((Nval, len(grid1)*len(grid2)))
+    for k1 in range(idx1.shape[1]):
+        for k2 in range(idx2.shape[1]):
+            np.add.at(weights, (np.arange(Nval), idx1[:,k1]*len(grid2)+idx2[:,k2]),
+                      wgt1[:,k1]*wgt2[:,k2])
+
+    return _stacked_weighted_sum(weights, models, 2)
+
+
+#==================================================
+# Likelihood of a model linear in its amplitudes
+#==================================================
+
+def _pixel_lnlike(data, model, gauss=False):
+    """
+    Compute the log likelihood of each pixel, and its first and second
+    derivatives with respect to the model, for the Poisson likelihood
+    data*log(model) - model, or its Gaussian approximation
+    -0.5*(data-model)**2/model. Non finite derivatives are set to 0.
+
+    Parameters
+    ----------
+    - data (ndarray): the data
+    - model (ndarray): the model, with the walkers along the first axis
+    - gauss (bool): use the gaussian approximation of the likelihood
+
+    Output
+    ------
+    - lnl, dlnl, d2lnl (ndarray): the log likelihood and its derivatives
+
+    """
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if gauss:
+            lnl   = -0.5*(data - model)**2/model
+            dlnl  = 0.5*(data**2/model**2 - 1.0)
+            d2lnl = -data**2/model**3
+        else:
+            lnl   = data*np.log(model) - model
+            dlnl  = data/model - 1.0
+            d2lnl = -data/model**2
+
+    dlnl[~np.isfinite(dlnl)]   = 0.0
+    d2lnl[~np.isfinite(d2lnl)] = 0.0
+
+    return lnl, dlnl, d2lnl
+
+
+def _linear_lnlike(templates, data, amp, gauss=False, derivatives=True):
+    """
+    Compute the log likelihood of the models sum_k amp_k templates_k,
+    and its gradient and Hessian with respect to the amplitudes.
+
+    Parameters
+    ----------
+    - templates (ndarray): Nwalker x Ncomp x Npix unit amplitude models
+    - data (array): the Npix data
+    - amp (ndarray): Nwalker x Ncomp amplitudes
+    - gauss (bool): use the gaussian approximation of the likelihood
+    - derivatives (bool): also compute the gradient and Hessian
+
+    Output
+    ------
+    - lnL (array): the log likelihood of each walker
+    - grad (ndarray): Nwalker x Ncomp gradient
+    - hess (ndarray): Nwalker x Ncomp x Ncomp Hessian
+
+    """
+
+    model = np.einsum('wk,wkp->wp', amp, templates)
+    lnl, dlnl, d2lnl = _pixel_lnlike(data, model, gauss=gauss)
+    lnL = np.nansum(lnl, axis=1)
+
+    if not derivatives:
+        return lnL
+
+    grad = np.einsum('wkp,wp->wk', templates, dlnl)
+    hess = np.matmul(templates*d2lnl[:,np.newaxis,:], np.swapaxes(templates, 1, 2))
+
+    return lnL, grad, hess
+
+
+def _laplace_marginal(lnL, grad, hess, amp, rng):
+    """
+    Laplace approximation of the likelihood integrated over the positive
+    amplitudes, for one walker, around the constrained maximum. The free
+    amplitudes (amp > 0) are integrated over the Gaussian approximation.
+    The amplitudes at zero, where the gradient is negative, are then
+    integrated over the positive half line only, independently of each
+    other, using the curvature conditional to the other bound amplitudes
+    (exact for a single bound amplitude). The amplitudes are drawn from
+    the same approximation: truncated normal for the bound amplitudes,
+    and Gaussian for the free amplitudes given the bound ones, redrawn if
+    negative.
+
+    Parameters
+    ----------
+    - lnL (float): the maximum log likelihood
+    - grad (array): the Ncomp gradient at the maximum
+    - hess (ndarray): the Ncomp x Ncomp Hessian at the maximum
+    - amp (array): the Ncomp amplitudes at the maximum
+    - rng (np.random.Generator): the generator of the amplitude draws
+
+    Output
+    ------
+    - lnZ (float): the log of the marginal likelihood
+    - amp_draw (array): the drawn amplitudes
+
+    """
+
+    tiny  = np.finfo(float).tiny
+    H     = -hess
+    free  = amp > 0
+    bound = ~free
+    lnZ   = lnL
+    dev   = np.zeros(len(amp))
+
+    #---------- Gaussian integral over the free amplitudes
+    if np.sum(free) > 0:
+        eigval, eigvec = np.linalg.eigh(H[np.ix_(free, free)])
+        eigval = np.maximum(eigval, tiny)
+        lnZ = lnZ + 0.5*np.sum(free)*np.log(2*np.pi) - 0.5*np.sum(np.log(eigval))
+        Hff_inv = np.dot(eigvec/eigval, eigvec.T)
+
+    #---------- One-sided integral over the bound amplitudes
+    if np.sum(bound) > 0:
+        S = H[np.ix_(bound, bound)]
+        if np.sum(free) > 0:
+            S = S - np.dot(H[np.ix_(bound, free)], np.dot(Hff_inv, H[np.ix_(free, bound)]))
+        curv = np.maximum(np.diag(S), tiny)
+        slope = np.minimum(grad[bound], 0.0)
+        # int_0^inf exp(slope x - curv x^2/2) dx
+        lnZ = lnZ + np.sum(0.5*np.log(np.pi/(2*curv)) + np.log(special.erfcx(-slope/np.sqrt(2*curv))))
+
+        mu, sigma = slope/curv, 1/np.sqrt(curv)
+        dev[bound] = mu + sigma*stats.truncnorm.ppf(rng.uniform(size=len(mu)), -mu/sigma, np.inf)
+
+    #---------- Draw the free amplitudes given the bound ones
+    if np.sum(free) > 0:
+        mean = amp[free]
+        if np.sum(bound) > 0:
+            mean = mean - np.dot(Hff_inv, np.dot(H[np.ix_(free, bound)], dev[bound]))
+        for itry in range(100):
+            draw = mean + np.dot(eigvec, rng.standard_normal(len(mean))/np.sqrt(eigval))
+            if np.all(draw >= 0):
+                break
+        dev[free] = np.maximum(draw, 0.0) - amp[free]
+
+    return lnZ, amp + dev
+
+
+def profile_linear_amplitudes(templates, data, gauss=False, marginalize=False,
+                              niter=20, tol=1e-6, rng=None):
+    """
+    Maximize the likelihood of a model which is linear in its amplitudes,
+    model = sum_k amp_k templates_k, over the amplitudes, for a batch of
+    walkers. The likelihood is concave in the amplitudes, so that a few
+    Newton iterations on the small Ncomp x Ncomp system are enough. The
+    steps are damped so that the likelihood never decreases, and the
+    amplitudes are kept positive (the amplitudes at zero with a negative
+    gradient being fixed). Optionally, the amplitudes are
+    marginalized over (flat prior) with the Laplace approximation.
+
+    Parameters
+    ----------
+    - templates (ndarray): the unit amplitude models, Nwalker x Ncomp x (data shape)
+    - data (ndarray): the data
+    - gauss (bool): use the gaussian approximation of the likelihood
+    - marginalize (bool): return the Laplace approximation of the marginal likelihood
+    over the positive amplitudes instead of the maximum likelihood, and amplitudes
+    drawn from the corresponding (truncated) Gaussian distribution instead of the
+    best fit amplitudes, see _laplace_marginal
+    - niter (int): maximum number of Newton iterations
+    - tol (float): stop when the log likelihood of all walkers improves by less than tol
+    - rng (np.random.Generator): the generator of the amplitude draws when marginalize
+    is True. A freshly seeded generator is used if None
+
+    Output
+    ------
+    - lnL (array): the profiled (or marginal) log likelihood of each walker
+    - amp (ndarray): the Nwalker x Ncomp amplitudes
+
+    """
+
+    Nwalker, Ncomp = templates.shape[0:2]
+    tpl = np.reshape(templates, (Nwalker, Ncomp, -1))
+    dat = np.ravel(data)
+
+    #---------- Newton iterations, starting from the input templates
+    amp = np.ones((Nwalker, Ncomp))
+    lnL, grad, hess = _linear_lnlike(tpl, dat, amp, gauss=gauss)
+
+    for it in range(niter):
+        # Amplitudes at zero which would become negative are kept fixed
+        free = (amp > 0) + (grad > 0)
+        hess_free = -hess * free[:,:,np.newaxis] * free[:,np.newaxis,:]
+        step = np.einsum('wkl,wl->wk', np.linalg.pinv(hess_free), grad*free)
+
+        # Halve the step until the likelihood does not decrease
+        new_amp = amp.copy()
+        new_lnL = lnL.copy()
+        todo = np.ones(Nwalker, dtype=bool)
+        alpha = 1.0
+        for ihalf in range(10):
+            iwalk = np.where(todo)[0]
+            trial = np.maximum(amp[iwalk] + alpha*step[iwalk], 0.0)
+            trial_lnL = _linear_lnlike(tpl[iwalk], dat, trial, gauss=gauss, derivatives=False)
+            ok = trial_lnL >= lnL[iwalk]
+            new_amp[iwalk[ok]] = trial[ok]
+            new_lnL[iwalk[ok]] = trial_lnL[ok]
+            todo[iwalk[ok]] = False
+            if np.sum(todo) == 0:
+                break
+            alpha = alpha/2.0
+
+        gain = new_lnL - lnL
+        amp = new_amp
+        lnL, grad, hess = _linear_lnlike(tpl, dat, amp, gauss=gauss)
+        if not np.any(gain >= tol):
+            break
+
+    #---------- Laplace approximation
+    if marginalize:
+        if rng is None:
+            rng = np.random.default_rng()
+        for iw in range(Nwalker):
+            lnL[iw], amp[iw] = _laplace_marginal(lnL[iw], grad[iw], hess[iw], amp[iw], rng)
+
+    return lnL, amp
+
+
+#==================================================
+# Shared memory model grid for parallel sampling
+#==================================================
+
+# Shared memory blocks already attached by this process
+_SHARED_ATTACHED = {}
+
+class SharedModgrid(dict):
+    """
+    Model grid dictionary whose large arrays live in POSIX shared memory.
+    When pickled (e.g. sent to a worker of a multiprocessing pool), only
+    the name, shape and dtype of the shared blocks are transmitted, and
+    the worker attaches to the existing memory instead of receiving a
+    copy of the grid.
+
+    Parameters
+    ----------
+    - modgrid (dict): the model grid as returned by read_data
+    - min_nbytes (int): arrays smaller than this are copied as usual
+
+    """
+
+    def __init__(self, modgrid, min_nbytes=1000000):
+        dict.__init__(self)
+        self._descriptor = {}
+        self._shm = []
+        for key in modgrid.keys():
+            self[key], self._descriptor[key] = self._share(modgrid[key], min_nbytes)
+
+    def _share(self, value, min_nbytes):
+        if isinstance(value, list):
+            shared = [self._share(val, min_nbytes) for val in value]
+            return [sh[0] for sh in shared], ('list', [sh[1] for sh in shared])
+        
+        if not isinstance(value, np.ndarray) or value.nbytes < min_nbytes:
+            return value, ('copy', value)
+
+        if isinstance(value, np.memmap) and value.filename is not None and value.flags['C_CONTIGUOUS']:
+            return value, ('memmap', (value.filename, value.offset, value.dtype.str, value.shape))
+        
+        shm = shared_memory.SharedMemory(create=True, size=max(value.nbytes, 1))
+        self._shm.append(shm)
+        array = np.ndarray(value.shape, dtype=value.dtype, buffer=shm.buf)
+        array[...] = value
+        array.flags.writeable = False
+        return array, ('shm', (shm.name, value.dtype.str, value.shape))
+
+    def __reduce__(self):
+        return (_attach_modgrid, (self._descriptor,))
+
+    def release(self):
+        """
+        Free the shared memory blocks. To be called by the process that
+        created the grid, once the workers are done.
+        """
+        for key in self.keys():
+            self[key] = None
+        for shm in self._shm:
+            shm.close()
+            shm.unlink()
+        self._shm = []
+
+
+def _attach_value(descriptor):
+    """
+    Rebuild a modgrid value from its SharedModgrid descriptor.
+    """
+    kind, content = descriptor
+
+    if kind == 'list':
+        return [_attach_value(desc) for desc in content]
+    
+    if kind == 'memmap':
+        filename, offset, dtype, shape = content
+        return np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape)
+    
+    if kind == 'shm':
+        name, dtype, shape = content
+        if name not in _SHARED_ATTACHED:
+            _SHARED_ATTACHED[name] = shared_memory.SharedMemory(name=name)
+        array = np.ndarray(shape, dtype=dtype, buffer=_SHARED_ATTACHED[name].buf)
+        array.flags.writeable = False
+        return array
+    
+    return content
+
+
+def _attach_modgrid(descriptor):
+    """
+    Unpickling function of SharedModgrid: returns a plain dictionary
+    whose arrays are views of the shared memory blocks.
+    """
+    return {key: _attach_value(descriptor[key]) for key in descriptor.keys()}
+
+
+#==================================================
+# Run the sampler, possibly with a pool of processes
+#==================================================
+
+@contextlib.contextmanager
+def ensemble_pool(sampler, nproc=1):
+    """
+    Attach a pool of nproc processes to the sampler for the duration of
+    a with block, the model grid dictionaries passed to the likelihood
+    being placed in shared memory once for all. The sampler can then be
+    run several times with the same pool.
+
+    Parameters
+    ----------
+    - sampler (emcee EnsembleSampler): the sampler
+    - nproc (int): number of processes
+
+    Output
+    ------
+    The sampler uses the pool within the with block
+
+    """
+
+    if nproc > 1 and sampler.vectorize:
+        print('WARNING: the vectorized likelihood is used, nproc='+str(nproc)+' is ignored.')
+        nproc = 1
+
+    if nproc <= 1:
+        yield
+        return
+
+    args = sampler.log_prob_fn.args
+    shared_args = [SharedModgrid(arg) if isinstance(arg, dict) else arg for arg in args]
+    try:
+        with multiprocessing.Pool(nproc) as pool:
+            sampler.pool = pool
+            sampler.log_prob_fn.args = shared_args
+            yield
+    finally:
+        sampler.pool = None
+        sampler.log_prob_fn.args = args
+        for arg in shared_args:
+            if isinstance(arg, SharedModgrid):
+                arg.release()
+
+
+def run_ensemble(sampler, pos, nsteps, nproc=1):
+    """
+    Run the emcee sampler. If nproc > 1, the likelihood is evaluated in
+    a pool of nproc processes, the model grid dictionaries passed to the
+    likelihood being placed in shared memory once for all.
+
+    Parameters
+    ----------
+    - sampler (emcee EnsembleSampler): the sampler
+    - pos (array): the starting position of the walkers
+    - nsteps (int): number of MCMC steps
+    - nproc (int): number of processes
+
+    Output
+    ------
+    The sampler is run in place
+
+    """
+
+    with ensemble_pool(sampler, nproc=nproc):
+        sampler.run_mcmc(pos, nsteps, progress=True)
+
+
+#==================================================
+# Run the sampler until the chains are long enough
+#==================================================
+
+def run_ensemble_adaptive(sampler, pos, nsteps, nproc=1, check_every=100, ntau=50.0, tau_rtol=0.01):
+    """
+    Run the emcee sampler by chunks of check_every steps, estimating the
+    integrated autocorrelation time of each parameter after each chunk.
+    The sampling stops when the chains are longer than ntau autocorrelation
+    times and the autocorrelation time changed by less than tau_rtol
+    since the previous check, or when the chains reach nsteps steps
+    (including the steps of resumed chains). The pool of processes is
+    created once for all the chunks.
+
+    Parameters
+    ----------
+    - sampler (emcee EnsembleSampler): the sampler
+    - pos (array): the starting position of the walkers
+    - nsteps (int): maximum length of the chains
+    - nproc (int): number of processes
+    - check_every (int): number of steps between two checks
+    - ntau (float): required chain length in unit of autocorrelation time
+    - tau_rtol (float): relative tolerance on the autocorrelation time stability
+
+    Output
+    ------
+    - tau_history (list): the iteration and autocorrelation times at each check
+
+    """
+
+    tau_history = []
+    tau_old = None
+    with ensemble_pool(sampler, nproc=nproc):
+        while sampler.iteration < nsteps:
+            nchunk = min(check_every, nsteps - sampler.iteration)
+            sampler.run_mcmc(pos, nchunk, progress=True)
+            pos = sampler.get_last_sample()
+
+            tau = sampler.get_autocorr_time(tol=0)
+            tau_history.append([sampler.iteration]+list(tau))
+            print('--- Iteration '+str(sampler.iteration)+', autocorrelation time: '+str(np.round(tau, 1)))
+
+            if tau_old is not None and np.all(np.isfinite(tau)):
+                long_enough = np.all(ntau*tau < sampler.iteration)
+                stable = np.all(np.abs(tau_old - tau)/tau < tau_rtol)
+                if long_enough and stable:
+                    print('--- The chains are converged, stop after '+str(sampler.iteration)+' steps')
+                    break
+            tau_old = tau
+
+    return tau_history
+
+
+#==================================================
+# Burnin and thinning from the autocorrelation time
+#==================================================
+
+def autocorr_diagnostics(sampler, ntau=50.0, tau_history=None, parname=None, outfile=None):
+    """
+    Estimate the integrated autocorrelation time of the chains, and the
+    corresponding burnin (twice the largest time) and thinning (half the
+    smallest time).
+
+    Parameters
+    ----------
+    - sampler (emcee EnsembleSampler): the sampler
+    - ntau (float): required chain length in unit of autocorrelation time
+    - tau_history (list): autocorrelation times from run_ensemble_adaptive
+    - parname (list): list of parameter names
+    - outfile (str): full path to file to write the diagnostics
+
+    Output
+    ------
+    - burnin (int): number of steps to remove
+    - thin (int): thinning factor
+
+    """
+
+    niter = sampler.iteration
+    tau = sampler.get_autocorr_time(tol=0)
+    if np.all(np.isfinite(tau)):
+        burnin = min(int(np.ceil(2*np.amax(tau))), niter-1)
+        thin   = max(int(0.5*np.amin(tau)), 1)
+    else:
+        print('WARNING: the autocorrelation time could not be estimated, no burnin nor thinning applied.')
+        burnin = 0
+        thin   = 1
+    converged = np.all(ntau*tau < niter)
+    if not converged:
+        print('WARNING: the chains are shorter than '+str(ntau)+' autocorrelation times.')
+
+    if outfile is not None:
+        file = open(outfile,'w')
+        file.write('Number of steps: '+str(niter)+'\n')
+        file.write('Converged (Nstep > '+str(ntau)+' tau): '+str(converged)+'\n')
+        file.write('Burnin: '+str(burnin)+'\n')
+        file.write('Thinning: '+str(thin)+'\n')
+        for ipar in range(len(tau)):
+            if parname is not None:
+                parnamei = parname[ipar]
+            else:
+                parnamei = 'no name'
+            file.write('param '+str(ipar)+' ('+parnamei+'): tau = '+str(tau[ipar])+'\n')
+        if tau_history is not None:
+            file.write('History (iteration, tau):\n')
+            for hist in tau_history:
+                file.write('  '+' '.join([str(h) for h in hist])+'\n')
+        file.close()
+
+    return burnin, thin
+
+
+#==================================================
+# Map geometry
+#==================================================
+
+def map_geometry(header, coord=None, profile_reso=0.05*u.deg):
+    """
+    Get the 2D map geometry used for the profiles and spectra
+        
+    Parameters
+    ----------
+    - header (str): map header (3D)
+    - coord (SkyCoord): coordinates of the cluster, the map center if None
+    - profile_reso (quantity): bin used for profile extraction
+
+    Output
+    ------
+    - header (str): the 2D map header
+    - proj (WCS): the 2D map projection
+    - coord (SkyCoord): the coordinates of the cluster
+    - radmap (2D array): the distance to the cluster in deg
+    - profiler (RadialProfiler): radial profiler for the map
+
+    """
+
+    header = header.copy()
+    header['NAXIS'] = 2
+    del header['NAXIS3']
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        proj = WCS(header)
+        ra_map, dec_map = map_tools.get_radec_map(header)
+
+    if coord is None:
+        coord = SkyCoord(np.median(ra_map)*u.deg, np.median(dec_map)*u.deg, frame='icrs')
+
+    radmap = map_tools.greatcircle(ra_map, dec_map,
+                                   coord.ra.to_value('deg'), coord.dec.to_value('deg'))
+    profiler = radial_profile.RadialProfiler(header,
+                                             [coord.icrs.ra.to_value('deg'), coord.icrs.dec.to_value('deg')],
+                                             profile_reso.to_value('deg'))
+
+    return header, proj, coord, radmap, profiler
+
+
+#==================================================
+# Streaming posterior predictive statistics
+#==================================================
+
+def posterior_predictive(model_batch, param_chains, reductions, Nmc=100, batch_size=20):
+    '''
+    Draw Nmc models from the chains by batches and reduce them on the fly,
+    so that the full stack of Nmc models is never held in memory.
+    The reductions are per-sample quantities (e.g. profiles or spectra).
+
+    Parameters
+    ----------
+    - model_batch (function): function returning the models (dict of arrays,
+    or of lists of arrays, with the samples along the first axis) for a
+    Nbatch x Npar array of parameters
+    - param_chains (ndarray): array of chains parameters
+    - reductions (dict): functions of the batch models returning a per-sample
+    quantity, with the samples along the first axis
+    - Nmc (int): number of models
+    - batch_size (int): number of models computed at once
+
+    Output
+    ------
+    - MC_stat (dict): the Nmc x ... array of each reduction
+    '''
+
+    par_flat = param_chains.reshape(param_chains.shape[0]*param_chains.shape[1],
+                                    param_chains.shape[2])
+    Nsample = len(par_flat[:,0])-1
+    isample = np.random.randint(0, high=Nsample, size=Nmc) # randomly taken from chains
+
+    MC_stat = {}
+    for istart in range(0, Nmc, batch_size):
+        mods = model_batch(par_flat[isample[istart:istart+batch_size], :])
+
+        #----- Per-sample quantities
+        for name in reductions.keys():
+            red = np.asarray(reductions[name](mods))
+            if name not in MC_stat:
+                MC_stat[name] = np.zeros((Nmc,)+red.shape[1:])
+            MC_stat[name][istart:istart+red.shape[0]] = red
+
+    return MC_stat
+
+
 #==================================================
 # Compute chain statistics
 #==================================================
@@ -70,7 +1344,8 @@ def chains_statistics(param_chains,
                       parname=None,
                       conf=68.0,
                       show=True,
-                      outfile=None):
+                      outfile=None,
+                      par_best=None):
     """
     Get the statistics of the chains, such as maximum likelihood,
     parameters errors, etc.
@@ -83,6 +1358,8 @@ def chains_statistics(param_chains,
     - conf (float): confidence interval in %
     - show (bool): show or not the values
     - outfile (str): full path to file to write results
+    - par_best (array): best-fit parameters to report instead of the sample
+    with maximum likelihood
 
     Output
     ------
@@ -97,11 +1374,11 @@ def chains_statistics(param_chains,
     Npar = len(param_chains[0,0,:])
 
     wbest = (lnL_chains == np.amax(lnL_chains))
-    par_best       = np.zeros(Npar)
+    if par_best is None:
+        par_best = param_chains[wbest][0]
+    par_best       = np.array(par_best, dtype=float)
     par_percentile = np.zeros((3, Npar))
     for ipar in range(Npar):
-        # Maximum likelihood
-        par_best[ipar]          = param_chains[:,:,ipar][wbest][0]
 
         # Median and xx % CL
         perc = np.percentile(param_chains[:,:,ipar].flatten(),
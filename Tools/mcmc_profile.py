@@ -9,8 +9,8 @@ This file contains the modules which perform the MCMC constraint.
 import pickle
 import copy
 import os
+import hashlib
 import numpy as np
-from scipy.interpolate import interp1d
 import matplotlib.pyplot as plt
 import matplotlib
 from matplotlib import cm
@@ -26,13 +26,122 @@ import ctools
 import gammalib
 
 from minot.model_tools import trapz_loglog
-from minot.ClusterTools.map_tools import radial_profile_cts
+from kesacco.Tools import radial_profile
 from kesacco.Tools import plotting
 from kesacco.Tools import mcmc_common
 from kesacco.Tools import make_cluster_template
 from kesacco.Tools import cubemaking
 
 
+#==================================================
+# Compute the model of a grid node
+#==================================================
+
+def make_model_node(cpipe, subdir, cluster, rad, prof_ini, spatial_i, exti,
+                    includeIC=False):
+    """
+    Compute the cluster templates, fit the data with ctools, and
+    compute the best fit model cubes, with and without the cluster,
+    for a given profile scaling.
+    
+    Parameters
+    ----------
+    - cpipe (kesacco object): a kesacco object
+    - subdir (str): full path to the directory where outputs are written
+    - cluster (minot object): the cluster model
+    - rad (np array): the radius array for the 3d profile sampling
+    - prof_ini (np array): the initial cluster profile to be rescaled
+    - spatial_i (float): the spatial rescaling value
+    - exti (str): extension used to tag the files
+    - includeIC (bool): include inverse Compton in the model
+
+    Outputs files
+    -------------
+    - The templates, xml models and cubes of the node
+
+    """
+
+    #---------- Compute the model spectrum, map, and xml model file
+    # Re-scaling        
+    cluster.density_crp_model  = {'name':'User',
+                                  'radius':rad, 'profile':prof_ini.value ** spatial_i}
+    
+    # Cluster model
+    make_cluster_template.make_map(cluster,
+                                   subdir+'/Model_Map_'+exti+'.fits',
+                                   Egmin=cpipe.obs_setup.get_emin(),Egmax=cpipe.obs_setup.get_emax(),
+                                   includeIC=includeIC,
+                                   cache_dir=cpipe.template_cache_dir,
+                                   cache_size=cpipe.template_cache_size)
+    make_cluster_template.make_spectrum(cluster,
+                                        subdir+'/Model_Spectrum_'+exti+'.txt',
+                                        energy=np.logspace(-1,5,1000)*u.GeV,
+                                        includeIC=includeIC,
+                                        cache_dir=cpipe.template_cache_dir,
+                                        cache_size=cpipe.template_cache_size)
+
+    # xml model
+    model_tot = gammalib.GModels(cpipe.output_dir+'/Ana_Model_Input_Stack.xml')
+    clencounter = 0
+    for i in range(len(model_tot)):
+        if model_tot[i].name() == cluster.name:
+            spefn = subdir+'/Model_Spectrum_'+exti+'.txt'
+            model_tot[i].spectral().filename(spefn)
+            spafn = subdir+'/Model_Map_'+exti+'.fits'
+            model_tot[i].spatial(gammalib.GModelSpatialDiffuseMap(spafn))
+            clencounter += 1
+    if clencounter != 1:
+        raise ValueError('No cluster encountered in the input stack model')
+    model_tot.save(subdir+'/Model_Input_'+exti+'.xml')
+
+    #---------- Likelihood fit
+    like = ctools.ctlike()
+    like['inobs']           = cpipe.output_dir+'/Ana_Countscube.fits'
+    like['inmodel']         = subdir+'/Model_Input_'+exti+'.xml'
+    like['expcube']         = cpipe.output_dir+'/Ana_Expcube.fits'
+    like['psfcube']         = cpipe.output_dir+'/Ana_Psfcube.fits'
+    like['bkgcube']         = cpipe.output_dir+'/Ana_Bkgcube.fits'
+    like['edispcube']       = cpipe.output_dir+'/Ana_Edispcube.fits'
+    like['edisp']           = cpipe.spec_edisp
+    like['outmodel']        = subdir+'/Model_Output_'+exti+'.xml'
+    like['outcovmat']       = 'NONE'
+    like['statistic']       = cpipe.method_stat
+    like['refit']           = False
+    like['like_accuracy']   = 0.005
+    like['max_iter']        = 50
+    like['fix_spat_for_ts'] = False
+    like['logfile']         = subdir+'/Model_Output_log_'+exti+'.txt'
+    like.logFileOpen()
+    like.execute()
+    like.logFileClose()
+
+    #---------- Compute the 3D residual cube
+    cpipe._rm_source_xml(subdir+'/Model_Output_'+exti+'.xml',
+                         subdir+'/Model_Output_Cluster_'+exti+'.xml',
+                         cluster.name)
+    
+    modcube = cubemaking.model_cube(cpipe.output_dir,
+                                    cpipe.map_reso, cpipe.map_coord, cpipe.map_fov,
+                                    cpipe.spec_emin, cpipe.spec_emax, cpipe.spec_enumbins,
+                                    cpipe.spec_ebinalg,
+                                    edisp=cpipe.spec_edisp,
+                                    stack=cpipe.method_stack,
+                                    silent=True, inmemory=True,
+                                    logfile=subdir+'/Model_Cube_log_'+exti+'.txt',
+                                    inmodel_usr=subdir+'/Model_Output_'+exti+'.xml',
+                                    outmap_usr=subdir+'/Model_Cube_'+exti+'.fits')
+    
+    modcube_Cl = cubemaking.model_cube(cpipe.output_dir,
+                                       cpipe.map_reso, cpipe.map_coord, cpipe.map_fov,
+                                       cpipe.spec_emin, cpipe.spec_emax, cpipe.spec_enumbins,
+                                       cpipe.spec_ebinalg,
+                                       edisp=cpipe.spec_edisp,
+                                       stack=cpipe.method_stack, silent=True, inmemory=True,
+                                       logfile=subdir+'/Model_Cube_Cluster_log_'+exti+'.txt',
+                                       inmodel_usr=subdir+'/Model_Output_Cluster_'+exti+'.xml',
+                                       outmap_usr=subdir+'/Model_Cube_Cluster_'+exti+'.fits')
+
+
 #==================================================
 # Compute the model profile grid
 #==================================================
@@ -43,13 +152,17 @@ def build_model_grid(cpipe,
                      spatial_value, spatial_idx,
                      profile_reso,
                      includeIC=False,
-                     rm_tmp=False):
+                     rm_tmp=False,
+                     nproc=1,
+                     resume=False):
     """
     Build a grid of models for the cluster and background, using
     as n_CRp(r) propto n_CRp_ref^scaling.
     
     Parameters
     ----------
+    - nproc (int): number of processes used to compute the grid nodes
+    - resume (bool): only compute the grid nodes missing from a previous run
 
     Outputs files
     -------------
@@ -60,91 +173,26 @@ def build_model_grid(cpipe,
     # Save the cluster model before modification
     cluster_tmp = copy.deepcopy(cpipe.cluster)
     
+    #----- The grid is incomplete until all nodes are computed, the
+    # parameters of the run are kept for the checks of a resumed grid
+    if os.path.exists(subdir+'/Grid_Parameters.npy'):
+        os.remove(subdir+'/Grid_Parameters.npy')
+    np.save(subdir+'/Grid_Parameters_Pending.npy',
+            [cpipe.cluster, spatial_value], allow_pickle=True)
+    
     #----- Loop changing profile
     spatial_npt = len(spatial_value)
-    
-    for imod in range(spatial_npt):
-        print('--- Building model template '+str(1+imod)+'/'+str(spatial_npt))
+    profile_hash = hashlib.md5(prof_ini.value.tobytes()).hexdigest()
 
-        #---------- Indexing
-        spatial_i = spatial_value[imod]            
-        exti = 'TMP_'+str(imod)
-
-        #---------- Compute the model spectrum, map, and xml model file
-        # Re-scaling        
-        cluster_tmp.density_crp_model  = {'name':'User',
-                                          'radius':rad, 'profile':prof_ini.value ** spatial_i}
-        
-        # Cluster model
-        make_cluster_template.make_map(cluster_tmp,
-                                       subdir+'/Model_Map_'+exti+'.fits',
-                                       Egmin=cpipe.obs_setup.get_emin(),Egmax=cpipe.obs_setup.get_emax(),
-                                       includeIC=includeIC)
-        make_cluster_template.make_spectrum(cluster_tmp,
-                                            subdir+'/Model_Spectrum_'+exti+'.txt',
-                                            energy=np.logspace(-1,5,1000)*u.GeV,
-                                            includeIC=includeIC)
-
-        # xml model
-        model_tot = gammalib.GModels(cpipe.output_dir+'/Ana_Model_Input_Stack.xml')
-        clencounter = 0
-        for i in range(len(model_tot)):
-            if model_tot[i].name() == cluster_tmp.name:
-                spefn = subdir+'/Model_Spectrum_'+exti+'.txt'
-                model_tot[i].spectral().filename(spefn)
-                spafn = subdir+'/Model_Map_'+exti+'.fits'
-                model_tot[i].spatial(gammalib.GModelSpatialDiffuseMap(spafn))
-                clencounter += 1
-        if clencounter != 1:
-            raise ValueError('No cluster encountered in the input stack model')
-        model_tot.save(subdir+'/Model_Input_'+exti+'.xml')
-
-        #---------- Likelihood fit
-        like = ctools.ctlike()
-        like['inobs']           = cpipe.output_dir+'/Ana_Countscube.fits'
-        like['inmodel']         = subdir+'/Model_Input_'+exti+'.xml'
-        like['expcube']         = cpipe.output_dir+'/Ana_Expcube.fits'
-        like['psfcube']         = cpipe.output_dir+'/Ana_Psfcube.fits'
-        like['bkgcube']         = cpipe.output_dir+'/Ana_Bkgcube.fits'
-        like['edispcube']       = cpipe.output_dir+'/Ana_Edispcube.fits'
-        like['edisp']           = cpipe.spec_edisp
-        like['outmodel']        = subdir+'/Model_Output_'+exti+'.xml'
-        like['outcovmat']       = 'NONE'
-        like['statistic']       = cpipe.method_stat
-        like['refit']           = False
-        like['like_accuracy']   = 0.005
-        like['max_iter']        = 50
-        like['fix_spat_for_ts'] = False
-        like['logfile']         = subdir+'/Model_Output_log_'+exti+'.txt'
-        like.logFileOpen()
-        like.execute()
-        like.logFileClose()
-
-        #---------- Compute the 3D residual cube
-        cpipe._rm_source_xml(subdir+'/Model_Output_'+exti+'.xml',
-                             subdir+'/Model_Output_Cluster_'+exti+'.xml',
-                             cluster_tmp.name)
-        
-        modcube = cubemaking.model_cube(cpipe.output_dir,
-                                        cpipe.map_reso, cpipe.map_coord, cpipe.map_fov,
-                                        cpipe.spec_emin, cpipe.spec_emax, cpipe.spec_enumbins,
-                                        cpipe.spec_ebinalg,
-                                        edisp=cpipe.spec_edisp,
-                                        stack=cpipe.method_stack,
-                                        silent=True,
-                                        logfile=subdir+'/Model_Cube_log_'+exti+'.txt',
-                                        inmodel_usr=subdir+'/Model_Output_'+exti+'.xml',
-                                        outmap_usr=subdir+'/Model_Cube_'+exti+'.fits')
-        
-        modcube_Cl = cubemaking.model_cube(cpipe.output_dir,
-                                           cpipe.map_reso, cpipe.map_coord, cpipe.map_fov,
-                                           cpipe.spec_emin, cpipe.spec_emax, cpipe.spec_enumbins,
-                                           cpipe.spec_ebinalg,
-                                           edisp=cpipe.spec_edisp,
-                                           stack=cpipe.method_stack, silent=True,
-                                           logfile=subdir+'/Model_Cube_Cluster_log_'+exti+'.txt',
-                                           inmodel_usr=subdir+'/Model_Output_Cluster_'+exti+'.xml',
-                                           outmap_usr=subdir+'/Model_Cube_Cluster_'+exti+'.fits')
+    nodes = []
+    for imod in range(spatial_npt):
+        nodes.append(('TMP_'+str(imod),
+                      'spatial='+str(spatial_value[imod])+' profile='+profile_hash,
+                      lambda workdir, imod=imod: make_model_node(cpipe, workdir, cluster_tmp,
+                                                                 rad, prof_ini, spatial_value[imod],
+                                                                 'TMP_'+str(imod), includeIC=includeIC)))
+    config = mcmc_common.grid_configuration(cpipe, includeIC=includeIC, profile_reso=profile_reso)
+    mcmc_common.run_grid_nodes(nodes, subdir, nproc=nproc, resume=resume, config=config)
     
     #----- Build the data
     hdul = fits.open(cpipe.output_dir+'/Ana_Countscube.fits')
@@ -153,12 +201,13 @@ def build_model_grid(cpipe,
     header['NAXIS'] = 2
     cntmap = np.sum(hdul[0].data, axis=0)
     hdul.close()
-    r_dat, p_dat, err_dat = radial_profile_cts(cntmap,
-                                               [cpipe.cluster.coord.icrs.ra.to_value('deg'),
-                                                cpipe.cluster.coord.icrs.dec.to_value('deg')],
-                                               stddev=np.sqrt(cntmap), header=header,
-                                               binsize=profile_reso.to_value('deg'),
-                                               stat='POISSON', counts2brightness=True)
+    profiler = radial_profile.RadialProfiler(header,
+                                             [cpipe.cluster.coord.icrs.ra.to_value('deg'),
+                                              cpipe.cluster.coord.icrs.dec.to_value('deg')],
+                                             profile_reso.to_value('deg'))
+    r_dat, p_dat, err_dat = profiler.profile(cntmap,
+                                             stddev=np.sqrt(cntmap),
+                                             stat='POISSON', counts2brightness=True)
     tabdat = Table()
     tabdat['radius']      = r_dat
     tabdat['radius_min']  = r_dat - profile_reso.to_value('deg')/2.0
@@ -186,18 +235,12 @@ def build_model_grid(cpipe,
         map_cl = cntmap - cntmap_cl
         map_bk = cntmap_cl
         
-        r_cl, p_cl, err_cl = radial_profile_cts(map_cl,
-                                                [cpipe.cluster.coord.icrs.ra.to_value('deg'),
-                                                 cpipe.cluster.coord.icrs.dec.to_value('deg')],
-                                                stddev=np.sqrt(map_cl), header=header,
-                                                binsize=profile_reso.to_value('deg'),
-                                                stat='POISSON', counts2brightness=True)
-        r_bk, p_bk, err_bk = radial_profile_cts(map_bk,
-                                                [cpipe.cluster.coord.icrs.ra.to_value('deg'),
-                                                 cpipe.cluster.coord.icrs.dec.to_value('deg')],
-                                                stddev=np.sqrt(map_bk), header=header,
-                                                binsize=profile_reso.to_value('deg'),
-                                                stat='POISSON', counts2brightness=True)
+        r_cl, p_cl, err_cl = profiler.profile(map_cl,
+                                              stddev=np.sqrt(map_cl),
+                                              stat='POISSON', counts2brightness=True)
+        r_bk, p_bk, err_bk = profiler.profile(map_bk,
+                                              stddev=np.sqrt(map_bk),
+                                              stat='POISSON', counts2brightness=True)
         modgrid_bk[imod,:] = p_bk
         modgrid_cl[imod,:] = p_cl
 
@@ -216,11 +259,11 @@ def build_model_grid(cpipe,
     hdul.append(dat_hdu)
     hdul.append(grid_cl_hdu)
     hdul.append(grid_bk_hdu)
-    hdul.writeto(subdir+'/Grid_Sampling.fits', overwrite=True)
+    hdul.writeto(subdir+'/Grid_Sampling.fits.tmp'+str(os.getpid()), overwrite=True)
+    os.replace(subdir+'/Grid_Sampling.fits.tmp'+str(os.getpid()), subdir+'/Grid_Sampling.fits')
 
     #----- Save the properties of the last computation run
-    np.save(subdir+'/Grid_Parameters.npy',
-            [cpipe.cluster, spatial_value], allow_pickle=True)
+    os.replace(subdir+'/Grid_Parameters_Pending.npy', subdir+'/Grid_Parameters.npy')
     
     #----- remove TMP files
     if rm_tmp:
@@ -248,7 +291,7 @@ def get_mc_model(modgrid, param_chains, Nmc=100):
         
     Parameters
     ----------
-    - modgrid (array): grid of model
+    - modgrid (ProfileModel): compiled grid of models
     - param_chains (ndarray): array of chains parametes
     - Nmc (int): number of models
 
@@ -263,17 +306,11 @@ def get_mc_model(modgrid, param_chains, Nmc=100):
     
     Nsample = len(par_flat[:,0])-1
     
-    MC_model_background = np.zeros((Nmc, len(modgrid['radius'])))
-    MC_model_cluster = np.zeros((Nmc, len(modgrid['radius'])))
-    
-    for i in range(Nmc):
-        param_MC = par_flat[np.random.randint(0, high=Nsample), :] # randomly taken from chains
-        models = model_profile(modgrid, param_MC)
-        MC_model_cluster[i,:]    = models['cluster']
-        MC_model_background[i,:] = models['background']
+    param_MC = par_flat[np.random.randint(0, high=Nsample, size=Nmc), :] # randomly taken from chains
+    models = model_profile_batch(modgrid, param_MC)
 
-    MC_models = {'cluster':MC_model_cluster,
-                 'background':MC_model_background}
+    MC_models = {'cluster':models['cluster'],
+                 'background':models['background']}
     
     return MC_models
 
@@ -451,17 +488,18 @@ def read_data(input_file):
     Output
     ------
     - data (Table): Table containing the data
+    - modgrid (ProfileModel): the compiled model grid
 
     """
 
     hdul = fits.open(input_file)
 
-    modgrid = {'spa_val':hdul[1].data['value'],
-               'radius':hdul[2].data['radius'],
-               'radius_min':hdul[2].data['radius_min'],
-               'radius_max':hdul[2].data['radius_max'],
-               'models_cl':hdul[3].data,
-               'models_bk':hdul[4].data}
+    modgrid = ProfileModel({'spa_val':hdul[1].data['value'],
+                            'radius':hdul[2].data['radius'],
+                            'radius_min':hdul[2].data['radius_min'],
+                            'radius_max':hdul[2].data['radius_max'],
+                            'models_cl':hdul[3].data,
+                            'models_bk':hdul[4].data})
 
     data = {'radius':hdul[2].data['radius'],
             'radius_min':hdul[2].data['radius_min'],
@@ -561,6 +599,165 @@ def lnlike(params, data, modgrid, par_min, par_max, gauss=True):
     return lnL + prior
 
 
+#==================================================
+# MCMC: Defines log likelihood for a batch of walkers
+#==================================================
+
+def lnlike_batch(params, data, modgrid, par_min, par_max, gauss=True):
+    '''
+    Return the log likelihood for a batch of walkers, as used
+    by emcee with vectorize=True
+
+    Parameters
+    ----------
+    - params (ndarray): the parameters as Nwalker x Npar
+    - data (Table): the data flux and errors
+    - modgrid (Table): grid of model for different scaling to be interpolated
+    - par_min (list): the minimum value for params
+    - par_max (list): the maximum value for params
+    - gauss (bool): use a gaussian approximation for errors
+
+    Output
+    ------
+    - lnlike (array): the value of the log likelihood for each walker
+    '''
+
+    params = np.atleast_2d(params)
+
+    #---------- Get the prior
+    prior = mcmc_common.lnprior_batch(params, par_min, par_max)
+    lnL   = np.zeros(len(params)) - np.inf
+    good  = np.isfinite(prior)
+    if np.sum(good) == 0:
+        return lnL
+    
+    #---------- Get the test model for walkers within the prior
+    test_model = model_profile_batch(modgrid, params[good])
+    
+    #---------- Compute the likelihood
+    # Gaussian likelihood
+    if gauss:
+        resi = data['profile']-test_model['cluster']-test_model['background']
+        chi2 = resi**2/np.sqrt(test_model['cluster'])**2
+        lnL_good = -0.5*np.nansum(chi2, axis=1)
+
+    # Likelihood taking into account the background counts
+    else:
+        area = np.pi*data['radius_max']**2 - np.pi*data['radius_min']**2
+        L_i1 = (test_model['cluster']+test_model['background'])*area
+        L_i2 = data['profile']*area * np.log(L_i1)
+        lnL_good = -np.nansum(L_i1 - L_i2, axis=1)
+        
+    # In case of NaN, goes to infinity
+    lnL_good[np.isnan(lnL_good)] = -np.inf
+    lnL[good] = lnL_good
+    
+    return lnL + prior
+
+
+#==================================================
+# MCMC: Compiled profile model
+#==================================================
+
+class ProfileModel(dict):
+    """
+    Model grid dictionary, as read by read_data, compiled for the
+    likelihood calls. The slopes of the cluster and background models
+    between consecutive nodes of spa_val are precomputed once, so that
+    a model is obtained by gathering its bracketing node and slope,
+    instead of building scipy interpolators at each call. The result
+    is identical to interp1d(spa_val, models, axis=0).
+
+    Parameters
+    ----------
+    - modgrid (dict): the model grid, with keys spa_val, radius, radius_min,
+    radius_max, models_cl (Ngrid x Nradius) and models_bk (Ngrid x Nradius)
+
+    Methods
+    ----------
+    - bracket(values): the bracketing node and offset of spa_val values
+    - model(params): the model for a given set of parameters
+    - model_batch(params): the models for a batch of walkers
+    """
+
+    def __init__(self, modgrid):
+        dict.__init__(self, modgrid)
+
+        self['spa_val'] = np.asarray(self['spa_val'], dtype=np.float64)
+        if len(self['spa_val']) < 2:
+            raise ValueError('The model grid should contain at least two spatial scaling values.')
+        dx = np.diff(self['spa_val'])
+        
+        for key in ['cl', 'bk']:
+            models = np.asarray(self['models_'+key], dtype=np.float64)
+            self['models_'+key] = models
+            self['slope_'+key]  = (models[1:] - models[:-1]) / dx[:,np.newaxis]
+
+    def bracket(self, values):
+        """
+        Find the lower bracketing node of the values along spa_val.
+        Values outside the grid are clipped to the edges, so they should
+        be rejected beforehand (e.g. via the prior).
+
+        Parameters
+        ----------
+        - values (1d array): the spatial scaling values
+
+        Output
+        ------
+        - idx (int array): the index of the lower node, i.e. of the slope
+        - offset (array): the distance to the lower node
+        """
+
+        spa_val = self['spa_val']
+        values  = np.clip(np.asarray(values, dtype=np.float64), spa_val[0], spa_val[-1])
+        idx     = np.clip(np.searchsorted(spa_val, values), 1, len(spa_val)-1) - 1
+
+        return idx, values - spa_val[idx]
+
+    def model_batch(self, params):
+        """
+        Gamma ray model for the MCMC, computed for a batch of walkers
+
+        Parameters
+        ----------
+        - params (ndarray): the parameters as Nwalker x Npar
+
+        Output
+        ------
+        - output_model (dict): the output models in units of the input expected,
+        with the walkers along the first axis
+        """
+
+        params = np.atleast_2d(params)
+        idx, offset = self.bracket(params[:,1])
+
+        output_model_cl = self['slope_cl'][idx]*offset[:,np.newaxis] + self['models_cl'][idx]
+        output_model_bk = self['slope_bk'][idx]*offset[:,np.newaxis] + self['models_bk'][idx]
+
+        output_model = {'cluster':params[:,0,np.newaxis]*output_model_cl,
+                        'background':output_model_bk}
+
+        return output_model
+
+    def model(self, params):
+        """
+        Gamma ray model for the MCMC
+
+        Parameters
+        ----------
+        - params (list): the parameters
+
+        Output
+        ------
+        - output_model (dict): the output model in units of the input expected
+        """
+
+        output_model = self.model_batch(np.asarray(params, dtype=np.float64)[np.newaxis,:])
+
+        return {'cluster':output_model['cluster'][0], 'background':output_model['background'][0]}
+
+
 #==================================================
 # MCMC: Defines model
 #==================================================
@@ -571,23 +768,43 @@ def model_profile(modgrid, params):
 
     Parameters
     ----------
-    - modgrid (array): grid of models
+    - modgrid (ProfileModel): compiled grid of models (a plain dict is compiled on the fly)
     - param (list): the parameter to sample in the model
 
     Output
     ------
     - output_model (array): the output model in units of the input expected
     '''
-    
-    f_cl = interp1d(modgrid['spa_val'], modgrid['models_cl'], axis=0)
-    f_bk = interp1d(modgrid['spa_val'], modgrid['models_bk'], axis=0)
 
-    output_model_cl = params[0] * f_cl(params[1])
-    output_model_bk = f_bk(params[1])
+    if not isinstance(modgrid, ProfileModel):
+        modgrid = ProfileModel(modgrid)
 
-    output_model = {'cluster':output_model_cl, 'background':output_model_bk}
-    
-    return output_model
+    return modgrid.model(params)
+
+
+#==================================================
+# MCMC: Defines model for a batch of walkers
+#==================================================
+
+def model_profile_batch(modgrid, params):
+    '''
+    Gamma ray model for the MCMC, computed for a batch of walkers
+
+    Parameters
+    ----------
+    - modgrid (ProfileModel): compiled grid of models (a plain dict is compiled on the fly)
+    - param (ndarray): the parameters to sample in the model, as Nwalker x Npar
+
+    Output
+    ------
+    - output_model (array): the output models in units of the input expected,
+    with the walkers along the first axis
+    '''
+
+    if not isinstance(modgrid, ProfileModel):
+        modgrid = ProfileModel(modgrid)
+
+    return modgrid.model_batch(params)
 
 
 #==================================================
@@ -603,7 +820,12 @@ def run_profile_constraint(input_file,
                            Nmc=100,
                            GaussLike=False,
                            reset_mcmc=False,
-                           run_mcmc=True):
+                           run_mcmc=True,
+                           adaptive=False,
+                           ntau=50.0,
+                           check_every=100,
+                           vectorize=False,
+                           nproc=1):
     """
     Run the MCMC constraints to the profile
         
@@ -619,6 +841,13 @@ def run_profile_constraint(input_file,
     - GaussLike (bool): use gaussian approximation of the likelihood
     - reset_mcmc (bool): reset the existing MCMC chains?
     - run_mcmc (bool): run the MCMC sampling?                            
+    - adaptive (bool): run the MCMC by chunks until the chains are longer than ntau
+    autocorrelation times (nsteps is then the maximum), and set the burnin and
+    thinning from the autocorrelation time
+    - ntau (float): required chain length in unit of autocorrelation time
+    - check_every (int): number of steps between two convergence checks
+    - vectorize (bool): evaluate the likelihood for all walkers at once
+    - nproc (int): number of processes used to evaluate the likelihood
 
     Output
     ------
@@ -638,17 +867,12 @@ def run_profile_constraint(input_file,
     par_max = [np.inf, np.amax(modgrid['spa_val'])]
 
     #========== Names
-    sampler_file   = subdir+'/MCMC_sampler.pkl'
+    chains_file    = subdir+'/MCMC_chains.h5'
     chainstat_file = subdir+'/MCMC_chainstat.txt'
+    autocorr_file  = subdir+'/MCMC_autocorr.txt'
     chainplot_file = subdir+'/MCMC_chainplot'
 
     #========== Start running MCMC definition and sampling    
-    #---------- Check if a MCMC sampler was already recorded
-    sampler_exist = os.path.exists(sampler_file)
-    if sampler_exist:
-        sampler = mcmc_common.load_object(sampler_file)
-        print('    Existing sampler: '+sampler_file)
-    
     #---------- MCMC parameters
     ndim = len(par0)
     
@@ -659,36 +883,50 @@ def run_profile_constraint(input_file,
     print('    burnin              = '+str(burnin))
     print('    conf                = '+str(conf))
     print('    reset_mcmc          = '+str(reset_mcmc))
+    print('    adaptive            = '+str(adaptive))
     print('    Gaussian likelihood = '+str(GaussLike))
+    print('    vectorize           = '+str(vectorize))
+    print('    nproc               = '+str(nproc))
 
     #---------- Defines the start
-    if sampler_exist:
-        if reset_mcmc:
-            print('--- Reset MCMC even though sampler already exists')
-            pos = [par0 + 1e-2*np.random.randn(ndim) for i in range(nwalkers)]
-            sampler.reset()
-            sampler = emcee.EnsembleSampler(nwalkers, ndim, lnlike,
-                                            args=[data, modgrid, par_min, par_max, GaussLike])
-        else:
-            print('--- Start from already existing sampler')
-            pos = sampler.chain[:,-1,:]
+    if vectorize:
+        lnfunc = lnlike_batch
     else:
-        print('--- No pre-existing sampler, start from scratch')
+        lnfunc = lnlike
+    
+    config = {'data':mcmc_common.file_signature(input_file),
+              'par_min':par_min, 'par_max':par_max, 'GaussLike':GaussLike}
+    backend, resume = mcmc_common.chains_backend(chains_file, nwalkers, ndim, reset=reset_mcmc,
+                                                 config=config)
+    sampler = emcee.EnsembleSampler(nwalkers, ndim, lnfunc,
+                                    args=[data, modgrid, par_min, par_max, GaussLike],
+                                    vectorize=vectorize, backend=backend)
+    if resume:
+        print('--- Continue the chains recorded in '+chains_file+' ('+str(backend.iteration)+' steps)')
+        pos = backend.get_last_sample()
+    else:
+        print('--- No chains to continue, start from scratch')
         pos = [par0 + 1e-2*np.random.randn(ndim) for i in range(nwalkers)]
-        sampler = emcee.EnsembleSampler(nwalkers, ndim, lnlike,
-                                        args=[data, modgrid, par_min, par_max, GaussLike])
         
     #---------- Run the MCMC
+    tau_history = None
     if run_mcmc:
-        print('--- Runing '+str(nsteps)+' MCMC steps')
-        sampler.run_mcmc(pos, nsteps, progress=True)
-
-    #---------- Save the MCMC after the run
-    mcmc_common.save_object(sampler, sampler_file)
+        if adaptive:
+            print('--- Runing up to '+str(nsteps)+' MCMC steps, until convergence')
+            tau_history = mcmc_common.run_ensemble_adaptive(sampler, pos, nsteps, nproc=nproc,
+                                                            check_every=check_every, ntau=ntau)
+        else:
+            print('--- Runing '+str(nsteps)+' MCMC steps')
+            mcmc_common.run_ensemble(sampler, pos, nsteps, nproc=nproc)
 
     #---------- Burnin
-    param_chains = sampler.chain[:, burnin:, :]
-    lnL_chains = sampler.lnprobability[:, burnin:]
+    thin = 1
+    if adaptive:
+        burnin, thin = mcmc_common.autocorr_diagnostics(sampler, ntau=ntau, tau_history=tau_history,
+                                                        parname=parname, outfile=autocorr_file)
+        print('--- Burnin and thinning from the autocorrelation time: '+str(burnin)+', '+str(thin))
+    param_chains = sampler.chain[:, burnin::thin, :]
+    lnL_chains = sampler.lnprobability[:, burnin::thin]
     
     #---------- Get the parameter statistics
     par_best, par_percentile = mcmc_common.chains_statistics(param_chains, lnL_chains,
@@ -9,9 +9,9 @@ This file contains the modules which perform the MCMC spectral imaging constrain
 import pickle
 import copy
 import os
+import hashlib
 import numpy as np
 from scipy.interpolate import interp1d
-from scipy.interpolate import interpn
 from scipy.ndimage.filters import gaussian_filter
 import matplotlib.pyplot as plt
 import matplotlib
@@ -37,6 +37,117 @@ from kesacco.Tools import make_cluster_template
 from kesacco.Tools import cubemaking
 
 
+#==================================================
+# Compute the model of a grid node
+#==================================================
+
+def make_model_node(cpipe, subdir, cluster, rad, prof_ini, spatial_i, spectral_j, extij,
+                    includeIC=False):
+    """
+    Compute the cluster templates, fit the data with ctools, and
+    compute the best fit model cubes, with and without the cluster,
+    for a given profile scaling and spectral index.
+    
+    Parameters
+    ----------
+    - cpipe (kesacco object): a kesacco object
+    - subdir (str): full path to the directory where outputs are written
+    - cluster (minot object): the cluster model
+    - rad (np array): the radius array for the 3d profile sampling
+    - prof_ini (np array): the initial cluster profile to be rescaled
+    - spatial_i (float): the spatial rescaling value
+    - spectral_j (float): the spectral index
+    - extij (str): extension used to tag the files
+    - includeIC (bool): include inverse Compton in the model
+
+    Output
+    ------
+    - The templates, xml models and cubes of the node
+    
+    """
+    
+    #---------- Compute the model spectrum, map, and xml model file
+    # Re-scaling        
+    cluster.density_crp_model  = {'name':'User',
+                                      'radius':rad, 'profile':prof_ini.value ** spatial_i}
+    cluster.spectrum_crp_model = {'name':'PowerLaw', 'Index':spectral_j}
+    
+    # Cluster model
+    make_cluster_template.make_map(cluster,
+                                   subdir+'/Model_Map_'+extij+'.fits',
+                                   Egmin=cpipe.obs_setup.get_emin(),Egmax=cpipe.obs_setup.get_emax(),
+                                   includeIC=includeIC,
+                                   cache_dir=cpipe.template_cache_dir,
+                                   cache_size=cpipe.template_cache_size)
+    make_cluster_template.make_spectrum(cluster,
+                                        subdir+'/Model_Spectrum_'+extij+'.txt',
+                                        energy=np.logspace(-1,5,1000)*u.GeV,
+                                        includeIC=includeIC,
+                                        cache_dir=cpipe.template_cache_dir,
+                                        cache_size=cpipe.template_cache_size)
+    
+    # xml model
+    model_tot = gammalib.GModels(cpipe.output_dir+'/Ana_Model_Input_Stack.xml')
+    clencounter = 0
+    for i in range(len(model_tot)):
+        if model_tot[i].name() == cluster.name:
+            spefn = subdir+'/Model_Spectrum_'+extij+'.txt'
+            model_tot[i].spectral().filename(spefn)
+            spafn = subdir+'/Model_Map_'+extij+'.fits'
+            model_tot[i].spatial(gammalib.GModelSpatialDiffuseMap(spafn))
+            clencounter += 1
+    if clencounter != 1:
+        raise ValueError('No cluster encountered in the input stack model')
+    model_tot.save(subdir+'/Model_Input_'+extij+'.xml')
+
+    #---------- Likelihood fit
+    like = ctools.ctlike()
+    like['inobs']           = cpipe.output_dir+'/Ana_Countscube.fits'
+    like['inmodel']         = subdir+'/Model_Input_'+extij+'.xml'
+    like['expcube']         = cpipe.output_dir+'/Ana_Expcube.fits'
+    like['psfcube']         = cpipe.output_dir+'/Ana_Psfcube.fits'
+    like['bkgcube']         = cpipe.output_dir+'/Ana_Bkgcube.fits'
+    like['edispcube']       = cpipe.output_dir+'/Ana_Edispcube.fits'
+    like['edisp']           = cpipe.spec_edisp
+    like['outmodel']        = subdir+'/Model_Output_'+extij+'.xml'
+    like['outcovmat']       = 'NONE'
+    like['statistic']       = cpipe.method_stat
+    like['refit']           = False
+    like['like_accuracy']   = 0.005
+    like['max_iter']        = 50
+    like['fix_spat_for_ts'] = False
+    like['logfile']         = subdir+'/Model_Output_log_'+extij+'.txt'
+    like.logFileOpen()
+    like.execute()
+    like.logFileClose()
+
+    #---------- Compute the 3D residual cube
+    cpipe._rm_source_xml(subdir+'/Model_Output_'+extij+'.xml',
+                         subdir+'/Model_Output_Cluster_'+extij+'.xml',
+                         cluster.name)
+    
+    modcube = cubemaking.model_cube(cpipe.output_dir,
+                                    cpipe.map_reso, cpipe.map_coord, cpipe.map_fov,
+                                    cpipe.spec_emin, cpipe.spec_emax, cpipe.spec_enumbins,
+                                    cpipe.spec_ebinalg,
+                                    edisp=cpipe.spec_edisp,
+                                    stack=cpipe.method_stack,
+                                    silent=True, inmemory=True,
+                                    logfile=subdir+'/Model_Cube_log_'+extij+'.txt',
+                                    inmodel_usr=subdir+'/Model_Output_'+extij+'.xml',
+                                    outmap_usr=subdir+'/Model_Cube_'+extij+'.fits')
+    
+    modcube_Cl = cubemaking.model_cube(cpipe.output_dir,
+                                       cpipe.map_reso, cpipe.map_coord, cpipe.map_fov,
+                                       cpipe.spec_emin, cpipe.spec_emax, cpipe.spec_enumbins,
+                                       cpipe.spec_ebinalg,
+                                       edisp=cpipe.spec_edisp,
+                                       stack=cpipe.method_stack, silent=True, inmemory=True,
+                                       logfile=subdir+'/Model_Cube_Cluster_log_'+extij+'.txt',
+                                       inmodel_usr=subdir+'/Model_Output_Cluster_'+extij+'.xml',
+                                       outmap_usr=subdir+'/Model_Cube_Cluster_'+extij+'.fits')
+
+
 #==================================================
 # Build model grid
 #==================================================
@@ -49,7 +160,10 @@ def build_model_grid(cpipe,
                      spectral_value,
                      spectral_idx,
                      includeIC=False,
-                     rm_tmp=False):
+                     rm_tmp=False,
+                     float32=False,
+                     nproc=1,
+                     resume=False):
     """
     Build a grid of models for the cluster and background. The 
     background model is obtained using the likelihood best fit
@@ -67,6 +181,9 @@ def build_model_grid(cpipe,
     - spectral_idx (np array): the spectral corresponding to spectral_value
     - includeIC (bool): include inverse Compton in the model
     - rm_tmp (bool): remove temporary files
+    - float32 (bool): store the model grids in single precision
+    - nproc (int): number of processes used to compute the grid nodes
+    - resume (bool): only compute the grid nodes missing from a previous run
 
     Output
     ------
@@ -78,116 +195,32 @@ def build_model_grid(cpipe,
     # Save the cluster model before modification
     cluster_tmp = copy.deepcopy(cpipe.cluster)
     
+    #===== The grid is incomplete until all nodes are computed, the
+    # parameters of the run are kept for the checks of a resumed grid
+    if os.path.exists(subdir+'/Grid_Parameters.npy'):
+        os.remove(subdir+'/Grid_Parameters.npy')
+    np.save(subdir+'/Grid_Parameters_Pending.npy',
+            [cpipe.cluster, spatial_value, spectral_value], allow_pickle=True)
+    
     #===== Loop over all models to be tested
     spatial_npt = len(spatial_value)
     spectral_npt = len(spectral_value)
-    
-    for imod in range(spatial_npt):
-        for jmod in range(spectral_npt):
-            print('--- Building model template '+str(1+jmod+imod*spectral_npt)+'/'+str(spatial_npt*spectral_npt))
-            
-            #---------- Indexing
-            spatial_i = spatial_value[imod]            
-            spectral_j   = spectral_value[jmod]
-            extij = 'TMP_'+str(imod)+'_'+str(jmod)
-            
-            #---------- Compute the model spectrum, map, and xml model file
-            # Re-scaling        
-            cluster_tmp.density_crp_model  = {'name':'User',
-                                              'radius':rad, 'profile':prof_ini.value ** spatial_i}
-            cluster_tmp.spectrum_crp_model = {'name':'PowerLaw', 'Index':spectral_j}
-            
-            # Cluster model
-            make_cluster_template.make_map(cluster_tmp,
-                                           subdir+'/Model_Map_'+extij+'.fits',
-                                           Egmin=cpipe.obs_setup.get_emin(),Egmax=cpipe.obs_setup.get_emax(),
-                                           includeIC=includeIC)
-            make_cluster_template.make_spectrum(cluster_tmp,
-                                                subdir+'/Model_Spectrum_'+extij+'.txt',
-                                                energy=np.logspace(-1,5,1000)*u.GeV,
-                                                includeIC=includeIC)
-            
-            # xml model
-            model_tot = gammalib.GModels(cpipe.output_dir+'/Ana_Model_Input_Stack.xml')
-            clencounter = 0
-            for i in range(len(model_tot)):
-                if model_tot[i].name() == cluster_tmp.name:
-                    spefn = subdir+'/Model_Spectrum_'+extij+'.txt'
-                    model_tot[i].spectral().filename(spefn)
-                    spafn = subdir+'/Model_Map_'+extij+'.fits'
-                    model_tot[i].spatial(gammalib.GModelSpatialDiffuseMap(spafn))
-                    clencounter += 1
-            if clencounter != 1:
-                raise ValueError('No cluster encountered in the input stack model')
-            model_tot.save(subdir+'/Model_Input_'+extij+'.xml')
-
-            #---------- Likelihood fit
-            like = ctools.ctlike()
-            like['inobs']           = cpipe.output_dir+'/Ana_Countscube.fits'
-            like['inmodel']         = subdir+'/Model_Input_'+extij+'.xml'
-            like['expcube']         = cpipe.output_dir+'/Ana_Expcube.fits'
-            like['psfcube']         = cpipe.output_dir+'/Ana_Psfcube.fits'
-            like['bkgcube']         = cpipe.output_dir+'/Ana_Bkgcube.fits'
-            like['edispcube']       = cpipe.output_dir+'/Ana_Edispcube.fits'
-            like['edisp']           = cpipe.spec_edisp
-            like['outmodel']        = subdir+'/Model_Output_'+extij+'.xml'
-            like['outcovmat']       = 'NONE'
-            like['statistic']       = cpipe.method_stat
-            like['refit']           = False
-            like['like_accuracy']   = 0.005
-            like['max_iter']        = 50
-            like['fix_spat_for_ts'] = False
-            like['logfile']         = subdir+'/Model_Output_log_'+extij+'.txt'
-            like.logFileOpen()
-            like.execute()
-            like.logFileClose()
-
-            #---------- Compute the 3D residual cube
-            cpipe._rm_source_xml(subdir+'/Model_Output_'+extij+'.xml',
-                                subdir+'/Model_Output_Cluster_'+extij+'.xml',
-                                cluster_tmp.name)
-            
-            modcube = cubemaking.model_cube(cpipe.output_dir,
-                                            cpipe.map_reso, cpipe.map_coord, cpipe.map_fov,
-                                            cpipe.spec_emin, cpipe.spec_emax, cpipe.spec_enumbins,
-                                            cpipe.spec_ebinalg,
-                                            edisp=cpipe.spec_edisp,
-                                            stack=cpipe.method_stack,
-                                            silent=True,
-                                            logfile=subdir+'/Model_Cube_log_'+extij+'.txt',
-                                            inmodel_usr=subdir+'/Model_Output_'+extij+'.xml',
-                                            outmap_usr=subdir+'/Model_Cube_'+extij+'.fits')
-            
-            modcube_Cl = cubemaking.model_cube(cpipe.output_dir,
-                                               cpipe.map_reso, cpipe.map_coord, cpipe.map_fov,
-                                               cpipe.spec_emin, cpipe.spec_emax, cpipe.spec_enumbins,
-                                               cpipe.spec_ebinalg,
-                                               edisp=cpipe.spec_edisp,
-                                               stack=cpipe.method_stack, silent=True,
-                                               logfile=subdir+'/Model_Cube_Cluster_log_'+extij+'.txt',
-                                               inmodel_usr=subdir+'/Model_Output_Cluster_'+extij+'.xml',
-                                               outmap_usr=subdir+'/Model_Cube_Cluster_'+extij+'.fits')
-
-    #===== Build the grid
-    hdul = fits.open(subdir+'/Model_Cube_TMP_'+str(0)+'_'+str(0)+'.fits')
-    cnt0 = hdul[0].data
-    hdul.close()
-    modgrid_bk = np.zeros((spatial_npt, spectral_npt,
-                           cnt0.shape[0], cnt0.shape[1], cnt0.shape[2]))
-    modgrid_cl = np.zeros((spatial_npt, spectral_npt,
-                           cnt0.shape[0], cnt0.shape[1], cnt0.shape[2]))
-    
+    profile_hash = hashlib.md5(prof_ini.value.tobytes()).hexdigest()
+
+    nodes = []
     for imod in range(spatial_npt):
         for jmod in range(spectral_npt):
             extij = 'TMP_'+str(imod)+'_'+str(jmod)
-            
-            hdul1 = fits.open(subdir+'/Model_Cube_'+extij+'.fits')
-            hdul2 = fits.open(subdir+'/Model_Cube_Cluster_'+extij+'.fits')
-            modgrid_bk[imod,jmod,:,:,:] = hdul2[0].data
-            modgrid_cl[imod,jmod,:,:,:] = hdul1[0].data - hdul2[0].data
-            hdul1.close()
-            hdul2.close()
-            
+            nodes.append((extij,
+                          'spatial='+str(spatial_value[imod])+' spectral='+str(spectral_value[jmod])+
+                          ' profile='+profile_hash,
+                          lambda workdir, imod=imod, jmod=jmod, extij=extij:
+                          make_model_node(cpipe, workdir, cluster_tmp, rad, prof_ini,
+                                          spatial_value[imod], spectral_value[jmod], extij,
+                                          includeIC=includeIC)))
+    config = mcmc_common.grid_configuration(cpipe, includeIC=includeIC)
+    mcmc_common.run_grid_nodes(nodes, subdir, nproc=nproc, resume=resume, config=config)
+
     #===== Save in a table
     scal_spa = Table()
     scal_spa['spatial_idx'] = spatial_idx
@@ -199,24 +232,44 @@ def build_model_grid(cpipe,
     scal_spe['spectral_val'] = spectral_value
     scal_spe_hdu = fits.BinTableHDU(scal_spe)
     
-    grid_cl_hdu = fits.ImageHDU(modgrid_cl)
-    grid_bk_hdu = fits.ImageHDU(modgrid_bk)
+    #===== Build the grid, written cube by cube in the file
+    if float32:
+        grid_dtype = np.float32
+    else:
+        grid_dtype = np.float64
+    # Written in a temporary file, moved once complete
+    grid_file = subdir+'/Grid_Sampling.fits.tmp'+str(os.getpid())
+    
+    def read_cube(node, component):
+        extij = 'TMP_'+str(node[0])+'_'+str(node[1])
+        hdul2 = fits.open(subdir+'/Model_Cube_Cluster_'+extij+'.fits')
+        cube = np.array(hdul2[0].data)
+        hdul2.close()
+        if component == 'bk':
+            return cube
+        hdul1 = fits.open(subdir+'/Model_Cube_'+extij+'.fits')
+        cube = hdul1[0].data - cube
+        hdul1.close()
+        return cube
     
     hdul = fits.HDUList()
     hdul.append(scal_spa_hdu)
     hdul.append(scal_spe_hdu)
-    hdul.append(grid_bk_hdu)
-    hdul.append(grid_cl_hdu)
-    hdul.writeto(subdir+'/Grid_Sampling.fits', overwrite=True)
+    hdul.writeto(grid_file, overwrite=True)
+    mcmc_common.append_grid_hdu(grid_file, (spatial_npt, spectral_npt),
+                                lambda node: read_cube(node, 'bk'), dtype=grid_dtype)
+    mcmc_common.append_grid_hdu(grid_file, (spatial_npt, spectral_npt),
+                                lambda node: read_cube(node, 'cl'), dtype=grid_dtype)
+
+    os.replace(grid_file, subdir+'/Grid_Sampling.fits')
 
     #===== Save the properties of the last computation run
-    np.save(subdir+'/Grid_Parameters.npy',
-            [cpipe.cluster, spatial_value, spectral_value], allow_pickle=True)
+    os.replace(subdir+'/Grid_Parameters_Pending.npy', subdir+'/Grid_Parameters.npy')
     
     #===== remove TMP files
     if rm_tmp:
-        for imod in range(spatial_scaling_npt):
-            for jmod in range(spectral_slope_npt):
+        for imod in range(spatial_npt):
+            for jmod in range(spectral_npt):
                 extij = 'TMP_'+str(imod)+'_'+str(jmod)
                 os.remove(subdir+'/Model_Map_'+extij+'.fits')
                 os.remove(subdir+'/Model_Spectrum_'+extij+'.txt')
@@ -234,40 +287,49 @@ def build_model_grid(cpipe,
 # Get models from the parameter space
 #==================================================
 
-def get_mc_model(modgrid, param_chains, Nmc=100):
+def get_mc_model(modgrid, param_chains, modbest, Nmc=100,
+                 coord=None, theta=1*u.deg, profile_reso=0.05*u.deg,
+                 batch_size=20):
     """
-    Get models randomly sampled from the parameter space
+    Get models randomly sampled from the parameter space. The models are
+    computed by batches and reduced on the fly to the quantities used in
+    the plots, so that the memory does not depend on Nmc.
         
     Parameters
     ----------
     - modgrid (array): grid of model
     - param_chains (ndarray): array of chains parametes
+    - modbest (dict): best fit model, used for the profile weights
     - Nmc (int): number of models
+    - coord (SkyCoord): coordinates of the cluster
+    - theta (quantity): angle used for spectral extraction
+    - profile_reso (quantity): bin used for profile extraction
+    - batch_size (int): number of models computed at once
 
     Output
     ------
-    - MC_model (ndarray): Nmc x N_eng array
+    - MC_model (dict): the 'cluster_profile' (Nmc x N_bin), 'cluster_spectrum'
+    and 'background_spectrum' (Nmc x N_eng) of each sample
 
     """
 
-    par_flat = param_chains.reshape(param_chains.shape[0]*param_chains.shape[1],
-                                    param_chains.shape[2])
-    
-    Nsample = len(par_flat[:,0])-1
-    
-    MC_model_background = np.zeros((Nmc, modgrid['xx_val'].shape[0],
-                                    modgrid['xx_val'].shape[1], modgrid['xx_val'].shape[2]))
-    MC_model_cluster = np.zeros((Nmc, modgrid['xx_val'].shape[0],
-                                 modgrid['xx_val'].shape[1], modgrid['xx_val'].shape[2]))
-    
-    for i in range(Nmc):
-        param_MC = par_flat[np.random.randint(0, high=Nsample), :] # randomly taken from chains
-        mods = model_specimg(modgrid, param_MC)
-        MC_model_cluster[i,:,:,:]    = mods['cluster']
-        MC_model_background[i,:,:,:] = mods['background']
+    header, proj, coord, radmap, profiler = mcmc_common.map_geometry(modgrid['header'], coord=coord,
+                                                                     profile_reso=profile_reso)
+    mask = np.where(radmap > theta.to_value('deg'), 0.0, 1.0)
+    stddev_cl = np.sqrt(np.sum(modbest['cluster'], axis=0))
+
+    def cluster_profile(mods):
+        r_cl, p_cl, err_cl = profiler.profile(np.sum(mods['cluster'], axis=1),
+                                              stddev=stddev_cl,
+                                              stat='POISSON', counts2brightness=True, residual=True)
+        return p_cl
 
-    MC_models = {'cluster':MC_model_cluster,
-                 'background':MC_model_background}
+    reductions = {'cluster_profile':cluster_profile,
+                  'cluster_spectrum':lambda mods: np.sum(mods['cluster']*mask, axis=(2,3)),
+                  'background_spectrum':lambda mods: np.sum(mods['background']*mask, axis=(2,3))}
+
+    MC_models = mcmc_common.posterior_predictive(lambda params: model_specimg_batch(modgrid, params),
+                                                 param_chains, reductions, Nmc=Nmc, batch_size=batch_size)
     
     return MC_models
 
@@ -286,7 +348,7 @@ def modelplot(data, modbest, MC_model, header, Ebins, outdir,
     ----------
     - data (dict): data file
     - modbest (dict): best fit model
-    - MC_model (dict): Monte Carlo models computed with get_mc_model
+    - MC_model (dict): Monte Carlo statistics computed with get_mc_model
     - header (str): map header
     - Ebins (ndarray): Energy bins 
     - outdir (str): path to output directory
@@ -305,18 +367,7 @@ def modelplot(data, modbest, MC_model, header, Ebins, outdir,
     #========== Get needed information
     reso = header['CDELT2']
     sigma_sm = (FWHM/(2*np.sqrt(2*np.log(2)))).to_value('deg')/reso
-    header['NAXIS'] = 2
-    del header['NAXIS3']
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        proj = WCS(header)
-        ra_map, dec_map = map_tools.get_radec_map(header)
-
-    if coord is None:
-        coord = SkyCoord(np.median(ra_map)*u.deg, np.median(dec_map)*u.deg, frame='icrs')
-
-    radmap = map_tools.greatcircle(ra_map, dec_map,
-                                   coord.ra.to_value('deg'), coord.dec.to_value('deg'))
+    header, proj, coord, radmap, profiler = mcmc_common.map_geometry(header, coord=coord, profile_reso=profile_reso)
 
     #========== Plot 1: map, Data - model, stack
     fig = plt.figure(0, figsize=(18, 4))
@@ -405,42 +456,17 @@ def modelplot(data, modbest, MC_model, header, Ebins, outdir,
 
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        r_dat, p_dat, err_dat = map_tools.radial_profile_cts(cntmap_data,
-                                                             [coord.icrs.ra.to_value('deg'),
-                                                              coord.icrs.dec.to_value('deg')],
-                                                             stddev=np.sqrt(cntmap_tot),
-                                                             header=header,
-                                                             binsize=profile_reso.to_value('deg'),
-                                                             stat='POISSON', counts2brightness=True,
-                                                             residual=True)
-        r_tot, p_tot, err_tot = map_tools.radial_profile_cts(cntmap_tot,
-                                                             [coord.icrs.ra.to_value('deg'),
-                                                              coord.icrs.dec.to_value('deg')],
-                                                             stddev=np.sqrt(cntmap_tot),
-                                                             header=header,
-                                                             binsize=profile_reso.to_value('deg'),
-                                                             stat='POISSON', counts2brightness=True,
-                                                             residual=True)
-        r_cl, p_cl, err_cl = map_tools.radial_profile_cts(cntmap_cl,
-                                                          [coord.icrs.ra.to_value('deg'),
-                                                           coord.icrs.dec.to_value('deg')],
-                                                          stddev=np.sqrt(cntmap_cl),
-                                                          header=header,
-                                                          binsize=profile_reso.to_value('deg'),
-                                                          stat='POISSON', counts2brightness=True,
-                                                          residual=True)
-        Nmc = MC_model['cluster'].shape[0]
-        p_cl_mc = np.zeros((Nmc, len(p_cl)))
-        for i in range(Nmc):
-            r_cl_i, p_cl_i, err_cl_i = map_tools.radial_profile_cts(np.sum(MC_model['cluster'][i,:,:,:],axis=0),
-                                                                    [coord.icrs.ra.to_value('deg'),
-                                                                     coord.icrs.dec.to_value('deg')],
-                                                                    stddev=np.sqrt(cntmap_cl),
-                                                                    header=header,
-                                                                    binsize=profile_reso.to_value('deg'),
-                                                                    stat='POISSON', counts2brightness=True,
-                                                                    residual=True)
-            p_cl_mc[i, :]    = p_cl_i
+        r_dat, p_dat, err_dat = profiler.profile(cntmap_data,
+                                                 stddev=np.sqrt(cntmap_tot),
+                                                 stat='POISSON', counts2brightness=True, residual=True)
+        r_tot, p_tot, err_tot = profiler.profile(cntmap_tot,
+                                                 stddev=np.sqrt(cntmap_tot),
+                                                 stat='POISSON', counts2brightness=True, residual=True)
+        r_cl, p_cl, err_cl = profiler.profile(cntmap_cl,
+                                              stddev=np.sqrt(cntmap_cl),
+                                              stat='POISSON', counts2brightness=True, residual=True)
+        p_cl_mc = MC_model['cluster_profile']
+        Nmc = p_cl_mc.shape[0]
         p_cl_up    = np.percentile(p_cl_mc, (100-conf)/2.0, axis=0)
         p_cl_lo    = np.percentile(p_cl_mc, 100 - (100-conf)/2.0, axis=0)
         
@@ -502,38 +528,18 @@ def modelplot(data, modbest, MC_model, header, Ebins, outdir,
     
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        r_dat, p_dat, err_dat = map_tools.radial_profile_cts(cntmap_data,
-                                                             [coord.icrs.ra.to_value('deg'),
-                                                              coord.icrs.dec.to_value('deg')],
-                                                             stddev=np.sqrt(cntmap_tot),
-                                                             header=header,
-                                                             binsize=profile_reso.to_value('deg'),
-                                                             stat='POISSON', counts2brightness=True,
-                                                             residual=True)
-        r_tot, p_tot, err_tot = map_tools.radial_profile_cts(cntmap_tot,
-                                                             [coord.icrs.ra.to_value('deg'),
-                                                              coord.icrs.dec.to_value('deg')],
-                                                             stddev=np.sqrt(cntmap_tot),
-                                                             header=header,
-                                                             binsize=profile_reso.to_value('deg'),
-                                                             stat='POISSON', counts2brightness=True,
-                                                             residual=True)
-        r_cl, p_cl, err_cl = map_tools.radial_profile_cts(cntmap_cl,
-                                                          [coord.icrs.ra.to_value('deg'),
-                                                           coord.icrs.dec.to_value('deg')],
-                                                          stddev=np.sqrt(cntmap_tot),
-                                                          header=header,
-                                                          binsize=profile_reso.to_value('deg'),
-                                                          stat='POISSON', counts2brightness=True,
-                                                          residual=True)
-        r_bk, p_bk, err_bk = map_tools.radial_profile_cts(cntmap_bk,
-                                                          [coord.icrs.ra.to_value('deg'),
-                                                           coord.icrs.dec.to_value('deg')],
-                                                          stddev=np.sqrt(cntmap_tot),
-                                                          header=header,
-                                                          binsize=profile_reso.to_value('deg'),
-                                                          stat='POISSON', counts2brightness=True,
-                                                          residual=True)
+        r_dat, p_dat, err_dat = profiler.profile(cntmap_data,
+                                                 stddev=np.sqrt(cntmap_tot),
+                                                 stat='POISSON', counts2brightness=True, residual=True)
+        r_tot, p_tot, err_tot = profiler.profile(cntmap_tot,
+                                                 stddev=np.sqrt(cntmap_tot),
+                                                 stat='POISSON', counts2brightness=True, residual=True)
+        r_cl, p_cl, err_cl = profiler.profile(cntmap_cl,
+                                              stddev=np.sqrt(cntmap_tot),
+                                              stat='POISSON', counts2brightness=True, residual=True)
+        r_bk, p_bk, err_bk = profiler.profile(cntmap_bk,
+                                              stddev=np.sqrt(cntmap_tot),
+                                              stat='POISSON', counts2brightness=True, residual=True)
     fig = plt.figure(figsize=(8,6))
     gs = GridSpec(2,1, height_ratios=[3,1], hspace=0)
     ax1 = plt.subplot(gs[0])
@@ -594,30 +600,15 @@ def modelplot(data, modbest, MC_model, header, Ebins, outdir,
 
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
-            r_dat, p_dat, err_dat = map_tools.radial_profile_cts(cntmap_data,
-                                                                 [coord.icrs.ra.to_value('deg'),
-                                                                  coord.icrs.dec.to_value('deg')],
-                                                                 stddev=np.sqrt(cntmap_tot),
-                                                                 header=header,
-                                                                 binsize=profile_reso.to_value('deg'),
-                                                                 stat='POISSON', counts2brightness=True,
-                                                                 residual=True)
-            r_tot, p_tot, err_tot = map_tools.radial_profile_cts(cntmap_tot,
-                                                                 [coord.icrs.ra.to_value('deg'),
-                                                                  coord.icrs.dec.to_value('deg')],
-                                                                 stddev=np.sqrt(cntmap_tot),
-                                                                 header=header,
-                                                                 binsize=profile_reso.to_value('deg'),
-                                                                 stat='POISSON', counts2brightness=True,
-                                                                 residual=True)
-            r_cl, p_cl, err_cl = map_tools.radial_profile_cts(cntmap_cl,
-                                                              [coord.icrs.ra.to_value('deg'),
-                                                               coord.icrs.dec.to_value('deg')],
-                                                              stddev=np.sqrt(cntmap_cl),
-                                                              header=header,
-                                                              binsize=profile_reso.to_value('deg'),
-                                                              stat='POISSON', counts2brightness=True,
-                                                              residual=True)
+            r_dat, p_dat, err_dat = profiler.profile(cntmap_data,
+                                                     stddev=np.sqrt(cntmap_tot),
+                                                     stat='POISSON', counts2brightness=True, residual=True)
+            r_tot, p_tot, err_tot = profiler.profile(cntmap_tot,
+                                                     stddev=np.sqrt(cntmap_tot),
+                                                     stat='POISSON', counts2brightness=True, residual=True)
+            r_cl, p_cl, err_cl = profiler.profile(cntmap_cl,
+                                                  stddev=np.sqrt(cntmap_cl),
+                                                  stat='POISSON', counts2brightness=True, residual=True)
         
         fig = plt.figure(figsize=(8,6))
         gs = GridSpec(2,1, height_ratios=[3,1], hspace=0)
@@ -680,38 +671,18 @@ def modelplot(data, modbest, MC_model, header, Ebins, outdir,
     
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
-            r_dat, p_dat, err_dat = map_tools.radial_profile_cts(cntmap_data,
-                                                                 [coord.icrs.ra.to_value('deg'),
-                                                                  coord.icrs.dec.to_value('deg')],
-                                                                 stddev=np.sqrt(cntmap_tot),
-                                                                 header=header,
-                                                                 binsize=profile_reso.to_value('deg'),
-                                                                 stat='POISSON', counts2brightness=True,
-                                                                 residual=True)
-            r_tot, p_tot, err_tot = map_tools.radial_profile_cts(cntmap_tot,
-                                                                 [coord.icrs.ra.to_value('deg'),
-                                                                  coord.icrs.dec.to_value('deg')],
-                                                                 stddev=np.sqrt(cntmap_tot),
-                                                                 header=header,
-                                                                 binsize=profile_reso.to_value('deg'),
-                                                                 stat='POISSON', counts2brightness=True,
-                                                                 residual=True)
-            r_cl, p_cl, err_cl = map_tools.radial_profile_cts(cntmap_cl,
-                                                              [coord.icrs.ra.to_value('deg'),
-                                                               coord.icrs.dec.to_value('deg')],
-                                                              stddev=np.sqrt(cntmap_tot),
-                                                              header=header,
-                                                              binsize=profile_reso.to_value('deg'),
-                                                              stat='POISSON', counts2brightness=True,
-                                                              residual=True)
-            r_bk, p_bk, err_bk = map_tools.radial_profile_cts(cntmap_bk,
-                                                              [coord.icrs.ra.to_value('deg'),
-                                                               coord.icrs.dec.to_value('deg')],
-                                                              stddev=np.sqrt(cntmap_tot),
-                                                              header=header,
-                                                              binsize=profile_reso.to_value('deg'),
-                                                              stat='POISSON', counts2brightness=True,
-                                                              residual=True)
+            r_dat, p_dat, err_dat = profiler.profile(cntmap_data,
+                                                     stddev=np.sqrt(cntmap_tot),
+                                                     stat='POISSON', counts2brightness=True, residual=True)
+            r_tot, p_tot, err_tot = profiler.profile(cntmap_tot,
+                                                     stddev=np.sqrt(cntmap_tot),
+                                                     stat='POISSON', counts2brightness=True, residual=True)
+            r_cl, p_cl, err_cl = profiler.profile(cntmap_cl,
+                                                  stddev=np.sqrt(cntmap_tot),
+                                                  stat='POISSON', counts2brightness=True, residual=True)
+            r_bk, p_bk, err_bk = profiler.profile(cntmap_bk,
+                                                  stddev=np.sqrt(cntmap_tot),
+                                                  stat='POISSON', counts2brightness=True, residual=True)
         fig = plt.figure(figsize=(8,6))
         gs = GridSpec(2,1, height_ratios=[3,1], hspace=0)
         ax1 = plt.subplot(gs[0])
@@ -778,17 +749,10 @@ def modelplot(data, modbest, MC_model, header, Ebins, outdir,
     background_spec = np.sum(np.sum(mask*modbest['background'], axis=1), axis=1)
     
     #----- Get the MC
-    Nmc = MC_model['cluster'].shape[0]
-    cluster_mc_spec    = np.zeros((Nmc, len(Ebins)))
-    background_mc_spec = np.zeros((Nmc, len(Ebins)))
-    tot_mc_spec        = np.zeros((Nmc, len(Ebins)))
-
-    for i in range(Nmc):
-        cluster_mci_spec    = np.sum(np.sum(mask*MC_model['cluster'][i,:,:,:], axis=1), axis=1)
-        background_mci_spec = np.sum(np.sum(mask*MC_model['background'][i,:,:,:], axis=1), axis=1)
-        cluster_mc_spec[i, :]    = cluster_mci_spec
-        background_mc_spec[i, :] = background_mci_spec
-        tot_mc_spec[i, :]        = background_mci_spec + cluster_mci_spec
+    cluster_mc_spec    = MC_model['cluster_spectrum']
+    background_mc_spec = MC_model['background_spectrum']
+    tot_mc_spec        = cluster_mc_spec + background_mc_spec
+    Nmc = cluster_mc_spec.shape[0]
 
     cluster_up_spec    = np.percentile(cluster_mc_spec, (100-conf)/2.0, axis=0)
     cluster_lo_spec    = np.percentile(cluster_mc_spec, 100 - (100-conf)/2.0, axis=0)
@@ -875,7 +839,7 @@ def modelplot(data, modbest, MC_model, header, Ebins, outdir,
 # Read the data
 #==================================================
 
-def read_data(input_files):
+def read_data(input_files, memmap=True):
     """
     Read the data to extract the necessary information
     
@@ -883,6 +847,8 @@ def read_data(input_files):
     ----------
     - input_files (str list): file where the data is stored
     and file where the grid model is stored
+    - memmap (bool): map the model grids from the file rather than
+    loading them in memory
 
     Output
     ------
@@ -902,8 +868,8 @@ def read_data(input_files):
     hdu = fits.open(input_files[1])
     sample_spa = hdu[1].data
     sample_spe = hdu[2].data
-    models_bk  = hdu[3].data
-    models_cl  = hdu[4].data
+    models_bk  = mcmc_common.read_grid_hdu(hdu, 3, memmap=memmap)
+    models_cl  = mcmc_common.read_grid_hdu(hdu, 4, memmap=memmap)
     hdu.close()
 
     gridshape = models_cl.shape
@@ -1029,6 +995,61 @@ def lnlike(params, data, modgrid, par_min, par_max, gauss=True):
     return lnL + prior
 
 
+#==================================================
+# MCMC: Defines log likelihood for a batch of walkers
+#==================================================
+
+def lnlike_batch(params, data, modgrid, par_min, par_max, gauss=True):
+    '''
+    Return the log likelihood for a batch of walkers, as used
+    by emcee with vectorize=True
+
+    Parameters
+    ----------
+    - params (ndarray): the parameters as Nwalker x Npar
+    - data (Table): the data flux and errors
+    - modgrid (Table): grid of model for different scaling to be interpolated
+    - par_min (list): the minimum value for params
+    - par_max (list): the maximum value for params
+    - gauss (bool): use a gaussian approximation for errors
+
+    Output
+    ------
+    - lnlike (array): the value of the log likelihood for each walker
+    '''
+
+    params = np.atleast_2d(params)
+
+    #---------- Get the prior
+    prior = mcmc_common.lnprior_batch(params, par_min, par_max)
+    lnL   = np.zeros(len(params)) - np.inf
+    good  = np.isfinite(prior)
+    if np.sum(good) == 0:
+        return lnL
+    
+    #---------- Get the test model for walkers within the prior
+    test_model = model_specimg_batch(modgrid, params[good])
+    
+    #---------- Compute the likelihood
+    # Gaussian likelihood
+    if gauss:
+        sigma = np.sqrt(test_model['cluster']+test_model['background'])
+        chi2 = (data - test_model['cluster']-test_model['background'])**2/sigma**2
+        lnL_good = -0.5*np.nansum(chi2, axis=(1,2,3))
+
+    # Poisson with Bkg
+    else:        
+        L_i1 = test_model['cluster']+test_model['background']
+        L_i2 = data*np.log(test_model['cluster']+test_model['background'])
+        lnL_good = -np.nansum(L_i1 - L_i2, axis=(1,2,3))
+        
+    # In case of NaN, goes to infinity
+    lnL_good[np.isnan(lnL_good)] = -np.inf
+    lnL[good] = lnL_good
+    
+    return lnL + prior
+
+
 #==================================================
 # MCMC: Defines model
 #==================================================
@@ -1047,23 +1068,48 @@ def model_specimg(modgrid, params):
     - output_model (array): the output model in units of the input expected
     '''
 
-    # Interpolate for flatten grid of parameters
-    outf_cl = interpn((modgrid['spa_val'], modgrid['spe_val'],
-                       modgrid['e_val'], modgrid['y_val'], modgrid['x_val']),
-                      modgrid['models_cl'],
-                      (params[1], params[2], modgrid['eef_val'], modgrid['yyf_val'], modgrid['xxf_val']))
+    # Interpolate along the (spatial, spectral) parameter axes only
+    out_cl = mcmc_common.interp_grid2d(modgrid['spa_val'], modgrid['spe_val'],
+                                       modgrid['models_cl'], params[1], params[2])
+    out_bk = mcmc_common.interp_grid2d(modgrid['spa_val'], modgrid['spe_val'],
+                                       modgrid['models_bk'], params[1], params[2])
+    
+    # Add normalization parameter and save
+    output_model = {'cluster':params[0]*out_cl, 'background':out_bk}
+    
+    return output_model
+
+
+#==================================================
+# MCMC: Defines model for a batch of walkers
+#==================================================
+
+def model_specimg_batch(modgrid, params):
+    '''
+    Gamma ray model for the MCMC, computed for a batch of walkers
+    at once as a stacked weighted sum of the grid models
+
+    Parameters
+    ----------
+    - modgrid (array): grid of models
+    - param (ndarray): the parameters to sample in the model, as Nwalker x Npar
+
+    Output
+    ------
+    - output_model (array): the output models in units of the input expected,
+    with the walkers along the first axis
+    '''
 
-    outf_bk = interpn((modgrid['spa_val'], modgrid['spe_val'],
-                       modgrid['e_val'], modgrid['y_val'], modgrid['x_val']),
-                      modgrid['models_bk'],
-                      (params[1], params[2], modgrid['eef_val'], modgrid['yyf_val'], modgrid['xxf_val']))
+    params = np.atleast_2d(params)
 
-    # Reshape according to xx
-    out_cl = np.reshape(outf_cl, modgrid['xx_val'].shape)
-    out_bk = np.reshape(outf_bk, modgrid['xx_val'].shape)
+    # Interpolate along the (spatial, spectral) parameter axes only
+    out_cl = mcmc_common.interp_grid2d_batch(modgrid['spa_val'], modgrid['spe_val'],
+                                             modgrid['models_cl'], params[:,1], params[:,2])
+    out_bk = mcmc_common.interp_grid2d_batch(modgrid['spa_val'], modgrid['spe_val'],
+                                             modgrid['models_bk'], params[:,1], params[:,2])
     
     # Add normalization parameter and save
-    output_model = {'cluster':params[0]*out_cl, 'background':out_bk}
+    output_model = {'cluster':params[:,0,None,None,None]*out_cl, 'background':out_bk}
     
     return output_model
 
@@ -1082,6 +1128,11 @@ def run_constraint(input_files,
                    GaussLike=False,
                    reset_mcmc=False,
                    run_mcmc=True,
+                   adaptive=False,
+                   ntau=50.0,
+                   check_every=100,
+                   vectorize=False,
+                   nproc=1,
                    FWHM=0.1*u.deg,
                    theta=1.0*u.deg,
                    coord=None,
@@ -1101,6 +1152,13 @@ def run_constraint(input_files,
     - GaussLike (bool): use gaussian approximation of the likelihood
     - reset_mcmc (bool): reset the existing MCMC chains?
     - run_mcmc (bool): run the MCMC sampling?  
+    - adaptive (bool): run the MCMC by chunks until the chains are longer than ntau
+    autocorrelation times (nsteps is then the maximum), and set the burnin and
+    thinning from the autocorrelation time
+    - ntau (float): required chain length in unit of autocorrelation time
+    - check_every (int): number of steps between two convergence checks
+    - vectorize (bool): evaluate the likelihood for all walkers at once
+    - nproc (int): number of processes used to evaluate the likelihood
     - FWHM (quantity): size of the FWHM to be used for smoothing
     - theta (quantity): containment angle for plots
     - coord (SkyCoord): source coordinates for extraction
@@ -1125,17 +1183,12 @@ def run_constraint(input_files,
     par_max = [np.inf, np.amax(modgrid['spa_val']), np.amax(modgrid['spe_val'])]
 
     #========== Names
-    sampler_file   = subdir+'/MCMC_sampler.pkl'
+    chains_file    = subdir+'/MCMC_chains.h5'
     chainstat_file = subdir+'/MCMC_chainstat.txt'
+    autocorr_file  = subdir+'/MCMC_autocorr.txt'
     chainplot_file = subdir+'/MCMC_chainplot'
 
     #========== Start running MCMC definition and sampling    
-    #---------- Check if a MCMC sampler was already recorded
-    sampler_exist = os.path.exists(sampler_file)
-    if sampler_exist:
-        sampler = mcmc_common.load_object(sampler_file)
-        print('    Existing sampler: '+sampler_file)
-    
     #---------- MCMC parameters
     ndim = len(par0)
     
@@ -1146,36 +1199,50 @@ def run_constraint(input_files,
     print('    burnin              = '+str(burnin))
     print('    conf                = '+str(conf))
     print('    reset_mcmc          = '+str(reset_mcmc))
+    print('    adaptive            = '+str(adaptive))
     print('    Gaussian likelihood = '+str(GaussLike))
+    print('    vectorize           = '+str(vectorize))
+    print('    nproc               = '+str(nproc))
 
     #---------- Defines the start
-    if sampler_exist:
-        if reset_mcmc:
-            print('--- Reset MCMC even though sampler already exists')
-            pos = [par0 + 1e-2*np.random.randn(ndim) for i in range(nwalkers)]
-            sampler.reset()
-            sampler = emcee.EnsembleSampler(nwalkers, ndim, lnlike,
-                                            args=[data, modgrid, par_min, par_max, GaussLike])
-        else:
-            print('--- Start from already existing sampler')
-            pos = sampler.chain[:,-1,:]
+    if vectorize:
+        lnfunc = lnlike_batch
     else:
-        print('--- No pre-existing sampler, start from scratch')
+        lnfunc = lnlike
+    
+    config = {'data':[mcmc_common.file_signature(f) for f in input_files],
+              'par_min':par_min, 'par_max':par_max, 'GaussLike':GaussLike}
+    backend, resume = mcmc_common.chains_backend(chains_file, nwalkers, ndim, reset=reset_mcmc,
+                                                 config=config)
+    sampler = emcee.EnsembleSampler(nwalkers, ndim, lnfunc,
+                                    args=[data, modgrid, par_min, par_max, GaussLike],
+                                    vectorize=vectorize, backend=backend)
+    if resume:
+        print('--- Continue the chains recorded in '+chains_file+' ('+str(backend.iteration)+' steps)')
+        pos = backend.get_last_sample()
+    else:
+        print('--- No chains to continue, start from scratch')
         pos = [par0 + 1e-2*np.random.randn(ndim) for i in range(nwalkers)]
-        sampler = emcee.EnsembleSampler(nwalkers, ndim, lnlike,
-                                        args=[data, modgrid, par_min, par_max, GaussLike])
         
     #---------- Run the MCMC
+    tau_history = None
     if run_mcmc:
-        print('--- Runing '+str(nsteps)+' MCMC steps')
-        sampler.run_mcmc(pos, nsteps, progress=True)
-
-    #---------- Save the MCMC after the run
-    mcmc_common.save_object(sampler, sampler_file)
+        if adaptive:
+            print('--- Runing up to '+str(nsteps)+' MCMC steps, until convergence')
+            tau_history = mcmc_common.run_ensemble_adaptive(sampler, pos, nsteps, nproc=nproc,
+                                                            check_every=check_every, ntau=ntau)
+        else:
+            print('--- Runing '+str(nsteps)+' MCMC steps')
+            mcmc_common.run_ensemble(sampler, pos, nsteps, nproc=nproc)
 
     #---------- Burnin
-    param_chains = sampler.chain[:, burnin:, :]
-    lnL_chains = sampler.lnprobability[:, burnin:]
+    thin = 1
+    if adaptive:
+        burnin, thin = mcmc_common.autocorr_diagnostics(sampler, ntau=ntau, tau_history=tau_history,
+                                                        parname=parname, outfile=autocorr_file)
+        print('--- Burnin and thinning from the autocorrelation time: '+str(burnin)+', '+str(thin))
+    param_chains = sampler.chain[:, burnin::thin, :]
+    lnL_chains = sampler.lnprobability[:, burnin::thin]
     
     #---------- Get the parameter statistics
     par_best, par_percentile = mcmc_common.chains_statistics(param_chains, lnL_chains,
@@ -1183,8 +1250,9 @@ def run_constraint(input_files,
                                                              outfile=chainstat_file)
     
     #---------- Get the well-sampled models
-    MC_model   = get_mc_model(modgrid, param_chains, Nmc=Nmc)
     Best_model = model_specimg(modgrid, par_best)
+    MC_model   = get_mc_model(modgrid, param_chains, Best_model, Nmc=Nmc,
+                              coord=coord, theta=theta, profile_reso=profile_reso)
 
     #---------- Plots and results
     mcmc_common.chains_plots(param_chains, parname, chainplot_file,
@@ -9,9 +9,8 @@ This file contains the modules which perform the MCMC spectral imaging constrain
 import pickle
 import copy
 import os
+import hashlib
 import numpy as np
-from scipy.interpolate import interp1d
-from scipy.interpolate import interpn
 from scipy.ndimage.filters import gaussian_filter
 import matplotlib.pyplot as plt
 import matplotlib
@@ -38,6 +37,395 @@ from kesacco.Tools import make_cluster_template
 from kesacco.Tools import cubemaking
 
 
+#==================================================
+# Cluster model cube
+#==================================================
+
+def make_cluster_cube(cpipe, subdir, cluster, extij, includeIC=False):
+    """
+    Compute the cluster templates, the xml model, and the IRF folded
+    model cube of the cluster alone, for the current cluster model
+        
+    Parameters
+    ----------
+    - cpipe (kesacco object): a kesacco object
+    - subdir (str): full path to the working subdirectory
+    - cluster (minot object): the cluster model
+    - extij (str): extension used to tag the files
+    - includeIC (bool): include inverse Compton in the model
+
+    Output
+    ------
+    - The cluster map, spectrum, xml model and cube files
+
+    """
+    
+    #---------- Cluster templates
+    make_cluster_template.make_map(cluster,
+                                   subdir+'/Model_Cluster_Map_'+extij+'.fits',
+                                   Egmin=cpipe.obs_setup.get_emin(),Egmax=cpipe.obs_setup.get_emax(),
+                                   includeIC=includeIC,
+                                   cache_dir=cpipe.template_cache_dir,
+                                   cache_size=cpipe.template_cache_size)
+    make_cluster_template.make_spectrum(cluster,
+                                        subdir+'/Model_Cluster_Spectrum_'+extij+'.txt',
+                                        energy=np.logspace(-1,5,1000)*u.GeV,
+                                        includeIC=includeIC,
+                                        cache_dir=cpipe.template_cache_dir,
+                                        cache_size=cpipe.template_cache_size)
+
+    #---------- xml model
+    model_tot = gammalib.GModels(cpipe.output_dir+'/Ana_Model_Input_Stack.xml')
+    clencounter = 0
+    for i in range(len(model_tot)):
+        if model_tot[i].name() == cluster.name:
+            spefn = subdir+'/Model_Cluster_Spectrum_'+extij+'.txt'
+            model_tot[i].spectral().filename(spefn)
+            spafn = subdir+'/Model_Cluster_Map_'+extij+'.fits'
+            model_tot[i].spatial(gammalib.GModelSpatialDiffuseMap(spafn))
+            clencounter += 1
+    if clencounter != 1:
+        raise ValueError('No cluster encountered in the input stack model')
+
+    # Keep the cluster alone
+    model_tot = cpipe._edit_models(model_tot, xmlout=subdir+'/Model_Cluster_'+extij+'.xml',
+                                   keep=[cluster.name])
+    
+    #---------- Compute the 3D cluster cube            
+    cubemaking.model_cube(cpipe.output_dir,
+                          cpipe.map_reso, cpipe.map_coord, cpipe.map_fov,
+                          cpipe.spec_emin, cpipe.spec_emax, cpipe.spec_enumbins,
+                          cpipe.spec_ebinalg,
+                          edisp=cpipe.spec_edisp,
+                          stack=cpipe.method_stack,
+                          silent=True, inmemory=True,
+                          logfile=subdir+'/Model_Cluster_Cube_log_'+extij+'.txt',
+                          inmodel_usr=model_tot,
+                          outmap_usr=subdir+'/Model_Cluster_Cube_'+extij+'.fits')
+
+
+#==================================================
+# Cluster model cubes, factorized
+#==================================================
+
+def make_cluster_cube_factorized(cpipe, subdir, cluster, spectral_value, exti,
+                                 includeIC=False):
+    """
+    Compute the IRF folded model cube of the cluster alone for the 
+    current spatial model and a reference spectral index, and obtain
+    the cubes for all the spectral indices by reweighting its energy
+    bins with the ratio of the bin integrated spectra.
+        
+    Parameters
+    ----------
+    - cpipe (kesacco object): a kesacco object
+    - subdir (str): full path to the working subdirectory
+    - cluster (minot object): the cluster model
+    - spectral_value (np array): the spectral index values
+    - exti (str): extension used to tag the files, completed by 
+    the spectral index number
+    - includeIC (bool): include inverse Compton in the model
+
+    Output
+    ------
+    - The reference cluster files and the cube files for all spectral indices
+
+    """
+
+    #---------- Reference cube
+    extref = exti+'_REF'
+    cluster.spectrum_crp_model = {'name':'PowerLaw', 'Index':spectral_value[len(spectral_value)//2]}
+    make_cluster_cube(cpipe, subdir, cluster, extref, includeIC=includeIC)
+
+    hdul = fits.open(subdir+'/Model_Cluster_Cube_'+extref+'.fits')
+    cube_ref = np.array(hdul[0].data)
+    ebounds = hdul['EBOUNDS']
+    emin = ebounds.data['E_MIN']*u.Unit(ebounds.columns['E_MIN'].unit)
+    emax = ebounds.data['E_MAX']*u.Unit(ebounds.columns['E_MAX'].unit)
+    flux_ref = bin_integrated_spectrum(cluster, emin, emax)
+
+    #---------- Spectral variants, reweighting the energy bins
+    for jmod in range(len(spectral_value)):
+        extij = exti+'_'+str(jmod)
+        cluster.spectrum_crp_model = {'name':'PowerLaw', 'Index':spectral_value[jmod]}
+        flux_j = bin_integrated_spectrum(cluster, emin, emax)
+        
+        ratio = np.zeros(len(flux_ref))
+        wpos = flux_ref > 0
+        ratio[wpos] = flux_j[wpos] / flux_ref[wpos]
+        
+        hdul[0].data = cube_ref * ratio[:,np.newaxis,np.newaxis]
+        hdul.writeto(subdir+'/Model_Cluster_Cube_'+extij+'.fits', overwrite=True)
+    hdul.close()
+
+
+#==================================================
+# Cluster spectrum integrated in energy bins
+#==================================================
+
+def bin_integrated_spectrum(cluster, emin, emax, Nsample=11):
+    """
+    Compute the pion decay spectrum of the cluster integrated
+    over energy bins
+        
+    Parameters
+    ----------
+    - cluster (minot object): the cluster model
+    - emin (quantity array): the lower edge of the energy bins
+    - emax (quantity array): the upper edge of the energy bins
+    - Nsample (int): number of energies per bin for the integration
+
+    Output
+    ------
+    - flux (np array): the integrated flux in each bin, in cm-2 s-1
+
+    """
+
+    Nbin = len(emin)
+    
+    # Energy sampling of each bin, all bins computed at once
+    lin = np.linspace(0, 1, Nsample)
+    energy = emin.to_value('GeV')[:,np.newaxis] * (emax/emin).to_value('')[:,np.newaxis]**lin[np.newaxis,:]
+    eng, spec = cluster.get_gamma_spectrum(energy.flatten()*u.GeV,
+                                           Rmin=None, Rmax=cluster.R_truncation,
+                                           Rmin_los=None, NR500_los=5.0,
+                                           type_integral='spherical')
+    spec = spec.to_value('GeV-1 cm-2 s-1').reshape(Nbin, Nsample)
+
+    # Integration
+    flux = np.zeros(Nbin)
+    for ie in range(Nbin):
+        wgood = spec[ie,:] > 0
+        if np.sum(wgood) > 1:
+            flux[ie] = trapz_loglog(spec[ie,wgood], energy[ie,wgood])
+    
+    return flux
+
+
+#==================================================
+# Background model cube
+#==================================================
+
+def make_background_cube(cpipe, subdir, spectral_shift, extj):
+    """
+    Compute the xml model and the IRF folded model cube of the 
+    background alone, with its spectral index shifted
+        
+    Parameters
+    ----------
+    - cpipe (kesacco object): a kesacco object
+    - subdir (str): full path to the working subdirectory
+    - spectral_shift (float): the value added to the spectral index
+    - extj (str): extension used to tag the files
+
+    Output
+    ------
+    - index (float): the spectral index of the input model
+    - pivot (quantity): the pivot energy of the input model
+    - The xml model and cube files
+
+    """
+    
+    #---------- xml model
+    model_tot = gammalib.GModels(cpipe.output_dir+'/Ana_Model_Input_Stack.xml')
+    bkencounter = 0
+    for i in range(len(model_tot)):
+        if model_tot[i].name() == 'BackgroundModel':
+            index = model_tot[i].spectral().index()
+            pivot = model_tot[i].spectral().pivot().MeV()*u.MeV
+            model_tot[i].spectral().index(model_tot[i].spectral().index() + spectral_shift)
+            bkencounter += 1
+            
+    if bkencounter != 1:
+        raise ValueError('No background encountered in the input stack model')
+    
+    # Keep the background alone
+    model_tot = cpipe._edit_models(model_tot, xmlout=subdir+'/Model_Background_'+extj+'.xml',
+                                   keep=['BackgroundModel'])
+
+    #---------- Compute the 3D background cube            
+    cubemaking.model_cube(cpipe.output_dir,
+                          cpipe.map_reso, cpipe.map_coord, cpipe.map_fov,
+                          cpipe.spec_emin, cpipe.spec_emax, cpipe.spec_enumbins,
+                          cpipe.spec_ebinalg,
+                          edisp=cpipe.spec_edisp,
+                          stack=cpipe.method_stack,
+                          silent=True, inmemory=True,
+                          logfile=subdir+'/Model_Background_Cube_log_'+extj+'.txt',
+                          inmodel_usr=model_tot,
+                          outmap_usr=subdir+'/Model_Background_Cube_'+extj+'.fits')
+
+    return index, pivot
+
+
+#==================================================
+# Point source model cube
+#==================================================
+
+def make_ps_cube(cpipe, subdir, ips, spectral_shift, extj):
+    """
+    Compute the xml model and the IRF folded model cube of a 
+    point source alone, with its spectral index shifted
+        
+    Parameters
+    ----------
+    - cpipe (kesacco object): a kesacco object
+    - subdir (str): full path to the working subdirectory
+    - ips (int): the index of the point source
+    - spectral_shift (float): the value added to the spectral index
+    - extj (str): extension used to tag the files
+
+    Output
+    ------
+    - index (float): the spectral index of the input model
+    - pivot (quantity): the pivot energy of the input model
+    - The xml model and cube files
+
+    """
+
+    psname = cpipe.compact_source.name[ips]
+    
+    #---------- xml model
+    model_tot = gammalib.GModels(cpipe.output_dir+'/Ana_Model_Input_Stack.xml')
+    psencounter = 0
+    for i in range(len(model_tot)):
+        if model_tot[i].name() == psname:
+            index = model_tot[i].spectral().index()
+            pivot = model_tot[i].spectral().pivot().MeV()*u.MeV
+            model_tot[i].spectral().index(model_tot[i].spectral().index() + spectral_shift)
+            psencounter += 1
+
+    if psencounter != 1:
+        raise ValueError('No point source encountered in the input stack model')
+
+    # Keep the point source alone
+    model_tot = cpipe._edit_models(model_tot, xmlout=subdir+'/Model_'+psname+'_'+extj+'.xml',
+                                   keep=[psname])
+    
+    #---------- Compute the 3D point source cube            
+    cubemaking.model_cube(cpipe.output_dir,
+                          cpipe.map_reso, cpipe.map_coord, cpipe.map_fov,
+                          cpipe.spec_emin, cpipe.spec_emax, cpipe.spec_enumbins,
+                          cpipe.spec_ebinalg,
+                          edisp=cpipe.spec_edisp,
+                          stack=cpipe.method_stack,
+                          silent=True, inmemory=True,
+                          logfile=subdir+'/Model_'+psname+'_Cube_log_'+extj+'.txt',
+                          inmodel_usr=model_tot,
+                          outmap_usr=subdir+'/Model_'+psname+'_Cube_'+extj+'.fits')
+
+    return index, pivot
+
+
+#==================================================
+# Power law index shift integrated in energy bins
+#==================================================
+
+def powerlaw_shift_ratio(emin, emax, index, shift, pivot):
+    """
+    Compute, in each energy bin, the ratio between the integral of a
+    power law with shifted index, (E/pivot)^(index+shift), and the 
+    integral of the reference power law, (E/pivot)^index
+        
+    Parameters
+    ----------
+    - emin (quantity array): the lower edge of the energy bins
+    - emax (quantity array): the upper edge of the energy bins
+    - index (float): the reference index, i.e. dN/dE ~ E^index
+    - shift (float): the value added to the index
+    - pivot (quantity): the pivot energy
+
+    Output
+    ------
+    - ratio (np array): the ratio of the bin integrals
+
+    """
+
+    xmin = (emin/pivot).to_value('')
+    xmax = (emax/pivot).to_value('')
+
+    integral = []
+    for gamma in [index+shift, index]:
+        if np.abs(gamma+1) < 1e-8:
+            integral.append(np.log(xmax/xmin))
+        else:
+            integral.append((xmax**(gamma+1) - xmin**(gamma+1))/(gamma+1))
+
+    return integral[0]/integral[1]
+
+
+#==================================================
+# Grid of cubes with spectral index shifts
+#==================================================
+
+def build_shifted_cubes(make_cube, cube_prefix, spectral_value, label,
+                        analytic=True, edisp=False, tol=0.01):
+    """
+    Build the model cubes of a component for a list of spectral 
+    index shifts. With analytic=True, a single reference cube is 
+    computed with ctools, and the shifted cubes are obtained by 
+    reweighting its energy bins. In the case of energy dispersion, 
+    the largest shift is also computed with ctools, and all cubes are
+    computed with ctools if the difference exceeds the tolerance.
+        
+    Parameters
+    ----------
+    - make_cube (function): function of (spectral_shift, extj) that
+    computes the cube file cube_prefix+extj+'.fits' and returns the
+    reference index and pivot energy
+    - cube_prefix (str): full path prefix of the cube files
+    - spectral_value (np array): the spectral index shifts
+    - label (str): name of the component, for printing
+    - analytic (bool): use the analytic reweighting
+    - edisp (bool): is energy dispersion used in the cubes
+    - tol (float): tolerance on the maximum relative difference 
+    between the reweighted and ctools cubes
+
+    Output
+    ------
+    - The cube files cube_prefix+'TMP_'+str(jmod)+'.fits'
+
+    """
+
+    npt = len(spectral_value)
+    
+    #---------- Each cube computed with ctools
+    if not analytic:
+        for jmod in range(npt):
+            print('--- Building '+label+' template '+str(1+jmod)+'/'+str(npt))
+            make_cube(spectral_value[jmod], 'TMP_'+str(jmod))
+        return
+
+    #---------- Reference cube, reweighted in energy
+    print('--- Building '+label+' reference template')
+    index, pivot = make_cube(0.0, 'TMP_REF')
+
+    hdul = fits.open(cube_prefix+'TMP_REF.fits')
+    cube_ref = np.array(hdul[0].data)
+    ebounds = hdul['EBOUNDS']
+    emin = ebounds.data['E_MIN']*u.Unit(ebounds.columns['E_MIN'].unit)
+    emax = ebounds.data['E_MAX']*u.Unit(ebounds.columns['E_MAX'].unit)
+    for jmod in range(npt):
+        ratio = powerlaw_shift_ratio(emin, emax, index, spectral_value[jmod], pivot)
+        hdul[0].data = cube_ref * ratio[:,np.newaxis,np.newaxis]
+        hdul.writeto(cube_prefix+'TMP_'+str(jmod)+'.fits', overwrite=True)
+    hdul.close()
+
+    #---------- Check in the case of energy dispersion
+    if edisp:
+        jcheck = np.argmax(np.abs(spectral_value))
+        make_cube(spectral_value[jcheck], 'TMP_CHECK')
+        cube_full = fits.getdata(cube_prefix+'TMP_CHECK.fits')
+        cube_fast = fits.getdata(cube_prefix+'TMP_'+str(jcheck)+'.fits')
+        max_rel_diff = np.amax(np.abs(cube_fast - cube_full)) / np.amax(np.abs(cube_full))
+        print('    '+label+' analytic reweighting, maximum relative difference: '+str(max_rel_diff))
+        
+        if max_rel_diff > tol:
+            print('WARNING: the analytic reweighting of the '+label+' exceeds the tolerance with')
+            print('         energy dispersion. Each template is computed with ctools.')
+            build_shifted_cubes(make_cube, cube_prefix, spectral_value, label, analytic=False)
+
+
 #==================================================
 # Build model grid
 #==================================================
@@ -54,7 +442,14 @@ def build_model_grid(cpipe,
                      ps_spectral_value,
                      ps_spectral_idx,
                      includeIC=False,
-                     rm_tmp=False):
+                     rm_tmp=False,
+                     float32=False,
+                     factorized=False,
+                     factorized_check=False,
+                     analytic_shift=False,
+                     analytic_tol=0.01,
+                     nproc=1,
+                     resume=False):
     """
     Build a grid of models for the cluster and background
         
@@ -77,6 +472,18 @@ def build_model_grid(cpipe,
     for the point source
     - includeIC (bool): include inverse Compton in the model
     - rm_tmp (bool): remove temporary files
+    - float32 (bool): store the model grids in single precision
+    - factorized (bool): compute the cluster cube once per spatial model,
+    and obtain the spectral variants by reweighting its energy bins with 
+    the ratio of the bin integrated spectra
+    - factorized_check (bool): compare the factorized cluster cubes to the
+    full computation for a few grid nodes
+    - analytic_shift (bool): compute the background and point source 
+    cubes once, and obtain the index shifts by reweighting the energy bins
+    - analytic_tol (float): tolerance on the relative difference with 
+    respect to ctools for the analytic shifts, checked with energy dispersion
+    - nproc (int): number of processes used to compute the grid nodes
+    - resume (bool): only compute the grid nodes missing from a previous run
 
     Output
     ------
@@ -94,199 +501,116 @@ def build_model_grid(cpipe,
     bkg_spectral_npt = len(bkg_spectral_value)
     ps_spectral_npt = len(ps_spectral_value)
     
-    #===== Loop over all cluster models to be tested
+    #===== The grid is incomplete until all nodes are computed, the
+    # parameters of the run are kept for the checks of a resumed grid
+    if os.path.exists(subdir+'/Grid_Parameters.npy'):
+        os.remove(subdir+'/Grid_Parameters.npy')
+    np.save(subdir+'/Grid_Parameters_Pending.npy',
+            [cpipe.cluster, spatial_value, spectral_value], allow_pickle=True)
+    
+    #===== Grid nodes for the cluster models
+    if factorized and includeIC:
+        print('WARNING: the inverse Compton map depends on the spectrum, the cluster grid cannot')
+        print('         be factorized. Each cluster template is computed (factorized=False).')
+        factorized = False
+    if factorized and cpipe.spec_edisp:
+        print('WARNING: with energy dispersion, the reweighting of the energy bins is approximate.')
+        print('         Use factorized_check=True to validate the grid.')
+    
+    def cluster_node(workdir, imod, jmod):
+        cluster_tmp.density_crp_model  = {'name':'User',
+                                          'radius':rad, 'profile':prof_ini.value ** spatial_value[imod]}
+        if factorized:
+            make_cluster_cube_factorized(cpipe, workdir, cluster_tmp, spectral_value, 'TMP_'+str(imod),
+                                         includeIC=includeIC)
+        else:
+            cluster_tmp.spectrum_crp_model = {'name':'PowerLaw', 'Index':spectral_value[jmod]}
+            make_cluster_cube(cpipe, workdir, cluster_tmp, 'TMP_'+str(imod)+'_'+str(jmod),
+                              includeIC=includeIC)
+
+    profile_hash = hashlib.md5(prof_ini.value.tobytes()).hexdigest()
+    nodes = []
     for imod in range(spatial_npt):
-        for jmod in range(spectral_npt):
-            print('--- Building cluster template '+str(1+jmod+imod*spectral_npt)+'/'+str(spatial_npt*spectral_npt))
-            
-            #---------- Indexing
-            spatial_i = spatial_value[imod]            
-            spectral_j   = spectral_value[jmod]
-            extij = 'TMP_'+str(imod)+'_'+str(jmod)
-            
-            #---------- Compute the model spectrum, map, and xml model file
-            # Re-scaling        
-            cluster_tmp.density_crp_model  = {'name':'User',
-                                              'radius':rad, 'profile':prof_ini.value ** spatial_i}
-            cluster_tmp.spectrum_crp_model = {'name':'PowerLaw', 'Index':spectral_j}
-            
-            # Cluster model
-            make_cluster_template.make_map(cluster_tmp,
-                                           subdir+'/Model_Cluster_Map_'+extij+'.fits',
-                                           Egmin=cpipe.obs_setup.get_emin(),Egmax=cpipe.obs_setup.get_emax(),
-                                           includeIC=includeIC)
-            make_cluster_template.make_spectrum(cluster_tmp,
-                                                subdir+'/Model_Cluster_Spectrum_'+extij+'.txt',
-                                                energy=np.logspace(-1,5,1000)*u.GeV,
-                                                includeIC=includeIC)
-
-            # xml model
-            model_tot = gammalib.GModels(cpipe.output_dir+'/Ana_Model_Input_Stack.xml')
-            clencounter = 0
-            for i in range(len(model_tot)):
-                if model_tot[i].name() == cluster_tmp.name:
-                    spefn = subdir+'/Model_Cluster_Spectrum_'+extij+'.txt'
-                    model_tot[i].spectral().filename(spefn)
-                    spafn = subdir+'/Model_Cluster_Map_'+extij+'.fits'
-                    model_tot[i].spatial(gammalib.GModelSpatialDiffuseMap(spafn))
-                    clencounter += 1
-            if clencounter != 1:
-                raise ValueError('No cluster encountered in the input stack model')
-            model_tot.save(subdir+'/Model_Cluster_'+extij+'.xml')
-
-            # Remove background and point sources
-            cpipe._rm_source_xml(subdir+'/Model_Cluster_'+extij+'.xml',
-                                 subdir+'/Model_Cluster_'+extij+'.xml',
-                                 'BackgroundModel')
-            
-            for i in range(len(cpipe.compact_source.name)):
-                cpipe._rm_source_xml(subdir+'/Model_Cluster_'+extij+'.xml',
-                                     subdir+'/Model_Cluster_'+extij+'.xml',
-                                     cpipe.compact_source.name[i])
-            
-            #---------- Compute the 3D cluster cube            
-            modcube = cubemaking.model_cube(cpipe.output_dir,
-                                            cpipe.map_reso, cpipe.map_coord, cpipe.map_fov,
-                                            cpipe.spec_emin, cpipe.spec_emax, cpipe.spec_enumbins,
-                                            cpipe.spec_ebinalg,
-                                            edisp=cpipe.spec_edisp,
-                                            stack=cpipe.method_stack,
-                                            silent=True,
-                                            logfile=subdir+'/Model_Cluster_Cube_log_'+extij+'.txt',
-                                            inmodel_usr=subdir+'/Model_Cluster_'+extij+'.xml',
-                                            outmap_usr=subdir+'/Model_Cluster_Cube_'+extij+'.fits')
-    
-    #===== Loop over all background models to be tested
-    for jmod in range(bkg_spectral_npt):
-        print('--- Building background template '+str(1+jmod)+'/'+str(bkg_spectral_npt))
-            
-        #---------- Indexing
-        spectral_j   = bkg_spectral_value[jmod]
-        extij = 'TMP_'+str(jmod)
-
-        #---------- xml model
-        model_tot = gammalib.GModels(cpipe.output_dir+'/Ana_Model_Input_Stack.xml')
-        bkencounter = 0
-        for i in range(len(model_tot)):
-            if model_tot[i].name() == 'BackgroundModel':
-                model_tot[i].spectral().index(model_tot[i].spectral().index() + spectral_j)
-                bkencounter += 1
-                
-        if bkencounter != 1:
-            raise ValueError('No background encountered in the input stack model')
-        model_tot.save(subdir+'/Model_Background_'+extij+'.xml')
-        
-        # Remove Cluster and point sources
-        cpipe._rm_source_xml(subdir+'/Model_Background_'+extij+'.xml',
-                             subdir+'/Model_Background_'+extij+'.xml',
-                             cpipe.cluster.name)
+        # Factorized grid: one node per spatial model, reweighted in energy
+        if factorized:
+            nodes.append(('Cluster_TMP_'+str(imod),
+                          'spatial='+str(spatial_value[imod])+' spectral='+
+                          ','.join([str(val) for val in spectral_value])+' profile='+profile_hash,
+                          lambda workdir, imod=imod: cluster_node(workdir, imod, None)))
+        # Full grid: one node per spatial and spectral model
+        else:
+            for jmod in range(spectral_npt):
+                nodes.append(('Cluster_TMP_'+str(imod)+'_'+str(jmod),
+                              'spatial='+str(spatial_value[imod])+' spectral='+str(spectral_value[jmod])+
+                              ' profile='+profile_hash,
+                              lambda workdir, imod=imod, jmod=jmod: cluster_node(workdir, imod, jmod)))
+
+    #===== Grid nodes for the background models
+    if analytic_shift:
+        nodes.append(('Background',
+                      'shift='+','.join([str(val) for val in bkg_spectral_value]),
+                      lambda workdir: build_shifted_cubes(lambda shift, extj: make_background_cube(cpipe, workdir,
+                                                                                                   shift, extj),
+                                                          workdir+'/Model_Background_Cube_',
+                                                          bkg_spectral_value, 'background',
+                                                          analytic=True, edisp=cpipe.spec_edisp,
+                                                          tol=analytic_tol)))
+    else:
+        for jmod in range(bkg_spectral_npt):
+            nodes.append(('Background_TMP_'+str(jmod),
+                          'shift='+str(bkg_spectral_value[jmod]),
+                          lambda workdir, jmod=jmod: make_background_cube(cpipe, workdir, bkg_spectral_value[jmod],
+                                                                          'TMP_'+str(jmod))))
         
-        for i in range(len(cpipe.compact_source.name)):
-            cpipe._rm_source_xml(subdir+'/Model_Background_'+extij+'.xml',
-                                 subdir+'/Model_Background_'+extij+'.xml',
-                                 cpipe.compact_source.name[i])
-
-        #---------- Compute the 3D background cube            
-        modcube = cubemaking.model_cube(cpipe.output_dir,
-                                        cpipe.map_reso, cpipe.map_coord, cpipe.map_fov,
-                                        cpipe.spec_emin, cpipe.spec_emax, cpipe.spec_enumbins,
-                                        cpipe.spec_ebinalg,
-                                        edisp=cpipe.spec_edisp,
-                                        stack=cpipe.method_stack,
-                                        silent=True,
-                                        logfile=subdir+'/Model_Background_Cube_log_'+extij+'.txt',
-                                        inmodel_usr=subdir+'/Model_Background_'+extij+'.xml',
-                                        outmap_usr=subdir+'/Model_Background_Cube_'+extij+'.fits')
-    
-    #===== Loop over all point source models to be tested
+    #===== Grid nodes for the point source models
     for ips in range(len(cpipe.compact_source.name)):
-        print('------ Point source '+cpipe.compact_source.name[ips])
-        for jmod in range(ps_spectral_npt):
-            print('--- Building point source template '+str(1+jmod)+'/'+str(bkg_spectral_npt))
-            
-            #---------- Indexing
-            spectral_j   = ps_spectral_value[jmod]
-            extij = 'TMP_'+str(jmod)
-
-            #---------- xml model
-            model_tot = gammalib.GModels(cpipe.output_dir+'/Ana_Model_Input_Stack.xml')
-            psencounter = 0
-            for i in range(len(model_tot)):
-                if model_tot[i].name() == cpipe.compact_source.name[ips]:
-                    model_tot[i].spectral().index(model_tot[i].spectral().index() + spectral_j)
-                    psencounter += 1
-
-            if psencounter != 1:
-                raise ValueError('No point source encountered in the input stack model')
-            model_tot.save(subdir+'/Model_'+cpipe.compact_source.name[ips]+'_'+extij+'.xml')
+        psname = cpipe.compact_source.name[ips]
+        if analytic_shift:
+            nodes.append((psname,
+                          'shift='+','.join([str(val) for val in ps_spectral_value]),
+                          lambda workdir, ips=ips, psname=psname:
+                          build_shifted_cubes(lambda shift, extj: make_ps_cube(cpipe, workdir, ips, shift, extj),
+                                              workdir+'/Model_'+psname+'_Cube_',
+                                              ps_spectral_value, 'point source',
+                                              analytic=True, edisp=cpipe.spec_edisp, tol=analytic_tol)))
+        else:
+            for jmod in range(ps_spectral_npt):
+                nodes.append((psname+'_TMP_'+str(jmod),
+                              'shift='+str(ps_spectral_value[jmod]),
+                              lambda workdir, ips=ips, jmod=jmod: make_ps_cube(cpipe, workdir, ips,
+                                                                               ps_spectral_value[jmod],
+                                                                               'TMP_'+str(jmod))))
+
+    #===== Compute the nodes
+    config = mcmc_common.grid_configuration(cpipe, includeIC=includeIC,
+                                            factorized=factorized, analytic_shift=analytic_shift,
+                                            analytic_tol=analytic_tol)
+    mcmc_common.run_grid_nodes(nodes, subdir, nproc=nproc, resume=resume, config=config)
+
+    #===== Validation of the factorized grid against the full computation for a few nodes
+    if factorized and factorized_check:
+        check_nodes = sorted(set([(0, 0), (0, spectral_npt-1),
+                                  (spatial_npt//2, spectral_npt//2),
+                                  (spatial_npt-1, 0), (spatial_npt-1, spectral_npt-1)]))
+        check = Table(names=['spatial_idx', 'spectral_idx', 'max_rel_diff', 'tot_rel_diff'],
+                      dtype=[int, int, float, float])
         
-            # Remove Cluster and background
-            cpipe._rm_source_xml(subdir+'/Model_'+cpipe.compact_source.name[ips]+'_'+extij+'.xml',
-                                 subdir+'/Model_'+cpipe.compact_source.name[ips]+'_'+extij+'.xml',
-                                 cpipe.cluster.name)
-            
-            cpipe._rm_source_xml(subdir+'/Model_'+cpipe.compact_source.name[ips]+'_'+extij+'.xml',
-                                 subdir+'/Model_'+cpipe.compact_source.name[ips]+'_'+extij+'.xml',
-                                 'BackgroundModel')
-
-            for jps in range(len(cpipe.compact_source.name)):
-                if jps != ips:
-                    cpipe._rm_source_xml(subdir+'/Model_'+cpipe.compact_source.name[ips]+'_'+extij+'.xml',
-                                         subdir+'/Model_'+cpipe.compact_source.name[ips]+'_'+extij+'.xml',
-                                         cpipe.compact_source.name[jps])
-            
-            #---------- Compute the 3D background cube            
-            modcube = cubemaking.model_cube(cpipe.output_dir,
-                                            cpipe.map_reso, cpipe.map_coord, cpipe.map_fov,
-                                            cpipe.spec_emin, cpipe.spec_emax, cpipe.spec_enumbins,
-                                            cpipe.spec_ebinalg,
-                                            edisp=cpipe.spec_edisp,
-                                            stack=cpipe.method_stack,
-                                            silent=True,
-                                            logfile=subdir+'/Model_'+cpipe.compact_source.name[ips]+'_Cube_log_'+extij+'.txt',
-                                            inmodel_usr=subdir+'/Model_'+cpipe.compact_source.name[ips]+'_'+extij+'.xml',
-                                            outmap_usr=subdir+'/Model_'+cpipe.compact_source.name[ips]+'_Cube_'+extij+'.fits')
-    
-    #===== Build the grid
-    # Get the grid info
-    hdul = fits.open(subdir+'/Model_Cluster_Cube_TMP_'+str(0)+'_'+str(0)+'.fits')
-    head = hdul[0].header
-    hdul.close()
-    
-    Npixx = head['NAXIS1']
-    Npixy = head['NAXIS2']
-    NpixE = head['NAXIS3']
-
-    # Build the cluster grid
-    modgrid_cl = np.zeros((spatial_npt, spectral_npt, NpixE, Npixy, Npixx))
-    for imod in range(spatial_npt):
-        for jmod in range(spectral_npt):
+        for (imod, jmod) in check_nodes:
+            print('--- Checking factorized cluster template '+str(imod)+', '+str(jmod))
             extij = 'TMP_'+str(imod)+'_'+str(jmod)
-            hdul = fits.open(subdir+'/Model_Cluster_Cube_'+extij+'.fits')
-            modgrid_cl[imod,jmod,:,:,:] = hdul[0].data
-            hdul.close()
-    grid_cl_hdu = fits.ImageHDU(modgrid_cl)
+            cluster_tmp.density_crp_model  = {'name':'User',
+                                              'radius':rad, 'profile':prof_ini.value ** spatial_value[imod]}
+            cluster_tmp.spectrum_crp_model = {'name':'PowerLaw', 'Index':spectral_value[jmod]}
+            make_cluster_cube(cpipe, subdir, cluster_tmp, extij+'_CHECK', includeIC=includeIC)
+
+            cube_full = fits.getdata(subdir+'/Model_Cluster_Cube_'+extij+'_CHECK.fits')
+            cube_fact = fits.getdata(subdir+'/Model_Cluster_Cube_'+extij+'.fits')
+            max_rel_diff = np.amax(np.abs(cube_fact - cube_full)) / np.amax(np.abs(cube_full))
+            tot_rel_diff = (np.sum(cube_fact) - np.sum(cube_full)) / np.sum(cube_full)
+            check.add_row([imod, jmod, max_rel_diff, tot_rel_diff])
             
-    # Build the background grid
-    modgrid_bk = np.zeros((bkg_spectral_npt, NpixE, Npixy, Npixx))
-    for jmod in range(bkg_spectral_npt):
-        extij = 'TMP_'+str(jmod)
-        hdul = fits.open(subdir+'/Model_Background_Cube_'+extij+'.fits')
-        modgrid_bk[jmod,:,:,:] = hdul[0].data
-        hdul.close()
-    grid_bk_hdu = fits.ImageHDU(modgrid_bk)
-
-    # Build the background grid
-    gridlist_ps_hdu = []
-    for ips in range(len(cpipe.compact_source.name)):
-        modgrid_ps = np.zeros((ps_spectral_npt, NpixE, Npixy, Npixx))
-        for jmod in range(ps_spectral_npt):
-            extij = 'TMP_'+str(jmod)
-            hdul = fits.open(subdir+'/Model_'+cpipe.compact_source.name[ips]+'_Cube_'+extij+'.fits')
-            modgrid_ps[jmod,:,:,:] = hdul[0].data
-            hdul.close()
-            grid_ps_hdu = fits.ImageHDU(modgrid_ps)
-        gridlist_ps_hdu.append(grid_ps_hdu)
+        print(check)
+        check.write(subdir+'/Grid_Factorized_Check.txt', format='ascii', overwrite=True)
 
     #===== Save in a table
     scal_spa = Table()
@@ -307,21 +631,54 @@ def build_model_grid(cpipe,
     ps_scal_spe['ps_spectral_idx'] = ps_spectral_idx
     ps_scal_spe['ps_spectral_val'] = ps_spectral_value
     ps_scal_spe_hdu = fits.BinTableHDU(ps_scal_spe)
+
+    #===== Build the grid, written cube by cube in the file
+    if float32:
+        grid_dtype = np.float32
+    else:
+        grid_dtype = np.float64
+    # Written in a temporary file, moved once complete
+    grid_file = subdir+'/Grid_Sampling.fits.tmp'+str(os.getpid())
     
+    def read_cube(filename):
+        hdul = fits.open(filename)
+        cube = np.array(hdul[0].data)
+        hdul.close()
+        return cube
+
     hdul = fits.HDUList()
     hdul.append(scal_spa_hdu)
     hdul.append(scal_spe_hdu)
-    hdul.append(grid_cl_hdu)
-    hdul.append(bk_scal_spe_hdu)
-    hdul.append(grid_bk_hdu)
-    hdul.append(ps_scal_spe_hdu)
+    hdul.writeto(grid_file, overwrite=True)
+    
+    # Cluster grid
+    mcmc_common.append_grid_hdu(grid_file, (spatial_npt, spectral_npt),
+                                lambda node: read_cube(subdir+'/Model_Cluster_Cube_TMP_'+
+                                                       str(node[0])+'_'+str(node[1])+'.fits'),
+                                dtype=grid_dtype)
+
+    # Background grid
+    with fits.open(grid_file, mode='append') as hdul:
+        hdul.append(bk_scal_spe_hdu)
+    mcmc_common.append_grid_hdu(grid_file, (bkg_spectral_npt,),
+                                lambda node: read_cube(subdir+'/Model_Background_Cube_TMP_'+
+                                                       str(node[0])+'.fits'),
+                                dtype=grid_dtype)
+
+    # Point source grids
+    with fits.open(grid_file, mode='append') as hdul:
+        hdul.append(ps_scal_spe_hdu)
     for ips in range(len(cpipe.compact_source.name)):
-        hdul.append(gridlist_ps_hdu[ips])
-    hdul.writeto(subdir+'/Grid_Sampling.fits', overwrite=True)
+        psname = cpipe.compact_source.name[ips]
+        mcmc_common.append_grid_hdu(grid_file, (ps_spectral_npt,),
+                                    lambda node: read_cube(subdir+'/Model_'+psname+'_Cube_TMP_'+
+                                                           str(node[0])+'.fits'),
+                                    dtype=grid_dtype)
+
+    os.replace(grid_file, subdir+'/Grid_Sampling.fits')
 
     #===== Save the properties of the last computation run
-    np.save(subdir+'/Grid_Parameters.npy',
-            [cpipe.cluster, spatial_value, spectral_value], allow_pickle=True)
+    os.replace(subdir+'/Grid_Parameters_Pending.npy', subdir+'/Grid_Parameters.npy')
     
     #===== remove TMP files
     if rm_tmp:
@@ -334,51 +691,48 @@ def build_model_grid(cpipe,
 # Get models from the parameter space
 #==================================================
 
-def get_mc_model(modgrid, param_chains, Nmc=100):
+def get_mc_model(modgrid, param_chains, modbest, Nmc=100,
+                 coord=None, theta=1*u.deg, profile_reso=0.05*u.deg,
+                 batch_size=20):
     """
-    Get models randomly sampled from the parameter space
+    Get models randomly sampled from the parameter space. The models are
+    computed by batches and reduced on the fly to the quantities used in
+    the plots, so that the memory does not depend on Nmc.
         
     Parameters
     ----------
     - modgrid (array): grid of model
     - param_chains (ndarray): array of chains parametes
+    - modbest (dict): best fit model, used for the profile weights
     - Nmc (int): number of models
+    - coord (SkyCoord): coordinates of the cluster
+    - theta (quantity): angle used for spectral extraction
+    - profile_reso (quantity): bin used for profile extraction
+    - batch_size (int): number of models computed at once
 
     Output
     ------
-    - MC_model (ndarray): Nmc x N_eng array
+    - MC_model (dict): the 'cluster_profile' (Nmc x N_bin),
+    'cluster_spectrum' (Nmc x N_eng) of each sample
 
     """
 
-    par_flat = param_chains.reshape(param_chains.shape[0]*param_chains.shape[1],
-                                    param_chains.shape[2])
-    
-    Nsample = len(par_flat[:,0])-1
-    
-    MC_model_cluster = np.zeros((Nmc, modgrid['xx_val'].shape[0],
-                                 modgrid['xx_val'].shape[1], modgrid['xx_val'].shape[2]))
-    MC_model_background = np.zeros((Nmc, modgrid['xx_val'].shape[0],
-                                    modgrid['xx_val'].shape[1], modgrid['xx_val'].shape[2]))
-    MC_model_ps = []
-    for ips in range(len(modgrid['models_ps_list'])):
-        MC_model_ps.append(np.zeros((Nmc, modgrid['xx_val'].shape[0],
-                                     modgrid['xx_val'].shape[1], modgrid['xx_val'].shape[2])))
-    MC_model_total = np.zeros((Nmc, modgrid['xx_val'].shape[0],
-                               modgrid['xx_val'].shape[1], modgrid['xx_val'].shape[2]))
-    
-    for i in range(Nmc):
-        param_MC = par_flat[np.random.randint(0, high=Nsample), :] # randomly taken from chains
-        mods = model_specimg(modgrid, param_MC)
-        MC_model_cluster[i,:,:,:]    = mods['cluster']
-        MC_model_background[i,:,:,:] = mods['background']
-        for ips in range(len(modgrid['models_ps_list'])):
-            MC_model_ps[ips][i,:,:,:] = mods['point_sources'][ips]
-        MC_model_total[i,:,:,:] = mods['total']
-
-    MC_models = {'cluster':MC_model_cluster,
-                 'background':MC_model_background,
-                 'point_sources':MC_model_ps,
-                 'total':MC_model_total}
+    header, proj, coord, radmap, profiler = mcmc_common.map_geometry(modgrid['header'], coord=coord,
+                                                                     profile_reso=profile_reso)
+    mask = np.where(radmap > theta.to_value('deg'), 0.0, 1.0)
+    stddev_cl = np.sqrt(np.sum(modbest['cluster'], axis=0))
+
+    def cluster_profile(mods):
+        r_cl, p_cl, err_cl = profiler.profile(np.sum(mods['cluster'], axis=1),
+                                              stddev=stddev_cl,
+                                              stat='POISSON', counts2brightness=True, residual=True)
+        return p_cl
+
+    reductions = {'cluster_profile':cluster_profile,
+                  'cluster_spectrum':lambda mods: np.sum(mods['cluster']*mask, axis=(2,3))}
+
+    MC_models = mcmc_common.posterior_predictive(lambda params: model_specimg_batch(modgrid, params),
+                                                 param_chains, reductions, Nmc=Nmc, batch_size=batch_size)
     
     return MC_models
 
@@ -397,7 +751,7 @@ def modelplot(data, modbest, MC_model, header, Ebins, outdir,
     ----------
     - data (dict): data file
     - modbest (dict): best fit model
-    - MC_model (dict): Monte Carlo models computed with get_mc_model
+    - MC_model (dict): Monte Carlo statistics computed with get_mc_model
     - header (str): map header
     - Ebins (ndarray): Energy bins 
     - outdir (str): path to output directory
@@ -416,18 +770,7 @@ def modelplot(data, modbest, MC_model, header, Ebins, outdir,
     #========== Get needed information
     reso = header['CDELT2']
     sigma_sm = (FWHM/(2*np.sqrt(2*np.log(2)))).to_value('deg')/reso
-    header['NAXIS'] = 2
-    del header['NAXIS3']
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        proj = WCS(header)
-        ra_map, dec_map = map_tools.get_radec_map(header)
-
-    if coord is None:
-        coord = SkyCoord(np.median(ra_map)*u.deg, np.median(dec_map)*u.deg, frame='icrs')
-
-    radmap = map_tools.greatcircle(ra_map, dec_map,
-                                   coord.ra.to_value('deg'), coord.dec.to_value('deg'))
+    header, proj, coord, radmap, profiler = mcmc_common.map_geometry(header, coord=coord, profile_reso=profile_reso)
     
     #========== Plot 1: map, Data - model, stack
     fig = plt.figure(0, figsize=(18, 4))
@@ -514,42 +857,17 @@ def modelplot(data, modbest, MC_model, header, Ebins, outdir,
 
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        r_dat, p_dat, err_dat = map_tools.radial_profile_cts(cntmap_data,
-                                                             [coord.icrs.ra.to_value('deg'),
-                                                              coord.icrs.dec.to_value('deg')],
-                                                             stddev=np.sqrt(cntmap_tot),
-                                                             header=header,
-                                                             binsize=profile_reso.to_value('deg'),
-                                                             stat='POISSON', counts2brightness=True,
-                                                             residual=True)
-        r_tot, p_tot, err_tot = map_tools.radial_profile_cts(cntmap_tot,
-                                                             [coord.icrs.ra.to_value('deg'),
-                                                              coord.icrs.dec.to_value('deg')],
-                                                             stddev=np.sqrt(cntmap_tot),
-                                                             header=header,
-                                                             binsize=profile_reso.to_value('deg'),
-                                                             stat='POISSON', counts2brightness=True,
-                                                             residual=True)
-        r_cl, p_cl, err_cl = map_tools.radial_profile_cts(cntmap_cl,
-                                                          [coord.icrs.ra.to_value('deg'),
-                                                           coord.icrs.dec.to_value('deg')],
-                                                          stddev=np.sqrt(cntmap_cl),
-                                                          header=header,
-                                                          binsize=profile_reso.to_value('deg'),
-                                                          stat='POISSON', counts2brightness=True,
-                                                          residual=True)
-        Nmc = MC_model['cluster'].shape[0]
-        p_cl_mc = np.zeros((Nmc, len(p_cl)))
-        for i in range(Nmc):
-            r_cl_i, p_cl_i, err_cl_i = map_tools.radial_profile_cts(np.sum(MC_model['cluster'][i,:,:,:],axis=0),
-                                                                    [coord.icrs.ra.to_value('deg'),
-                                                                     coord.icrs.dec.to_value('deg')],
-                                                                    stddev=np.sqrt(cntmap_cl),
-                                                                    header=header,
-                                                                    binsize=profile_reso.to_value('deg'),
-                                                                    stat='POISSON', counts2brightness=True,
-                                                                    residual=True)
-            p_cl_mc[i, :]    = p_cl_i
+        r_dat, p_dat, err_dat = profiler.profile(cntmap_data,
+                                                 stddev=np.sqrt(cntmap_tot),
+                                                 stat='POISSON', counts2brightness=True, residual=True)
+        r_tot, p_tot, err_tot = profiler.profile(cntmap_tot,
+                                                 stddev=np.sqrt(cntmap_tot),
+                                                 stat='POISSON', counts2brightness=True, residual=True)
+        r_cl, p_cl, err_cl = profiler.profile(cntmap_cl,
+                                              stddev=np.sqrt(cntmap_cl),
+                                              stat='POISSON', counts2brightness=True, residual=True)
+        p_cl_mc = MC_model['cluster_profile']
+        Nmc = p_cl_mc.shape[0]
         p_cl_up    = np.percentile(p_cl_mc, (100-conf)/2.0, axis=0)
         p_cl_lo    = np.percentile(p_cl_mc, 100 - (100-conf)/2.0, axis=0)
 
@@ -614,48 +932,23 @@ def modelplot(data, modbest, MC_model, header, Ebins, outdir,
     
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        r_dat, p_dat, err_dat = map_tools.radial_profile_cts(cntmap_data,
-                                                             [coord.icrs.ra.to_value('deg'),
-                                                              coord.icrs.dec.to_value('deg')],
-                                                             stddev=np.sqrt(cntmap_tot),
-                                                             header=header,
-                                                             binsize=profile_reso.to_value('deg'),
-                                                             stat='POISSON', counts2brightness=True,
-                                                             residual=True)
-        r_tot, p_tot, err_tot = map_tools.radial_profile_cts(cntmap_tot,
-                                                             [coord.icrs.ra.to_value('deg'),
-                                                              coord.icrs.dec.to_value('deg')],
-                                                             stddev=np.sqrt(cntmap_tot),
-                                                             header=header,
-                                                             binsize=profile_reso.to_value('deg'),
-                                                             stat='POISSON', counts2brightness=True,
-                                                             residual=True)
-        r_cl, p_cl, err_cl = map_tools.radial_profile_cts(cntmap_cl,
-                                                          [coord.icrs.ra.to_value('deg'),
-                                                           coord.icrs.dec.to_value('deg')],
-                                                          stddev=np.sqrt(cntmap_tot),
-                                                          header=header,
-                                                          binsize=profile_reso.to_value('deg'),
-                                                          stat='POISSON', counts2brightness=True,
-                                                          residual=True)
-        r_bk, p_bk, err_bk = map_tools.radial_profile_cts(cntmap_bk,
-                                                          [coord.icrs.ra.to_value('deg'),
-                                                           coord.icrs.dec.to_value('deg')],
-                                                          stddev=np.sqrt(cntmap_tot),
-                                                          header=header,
-                                                          binsize=profile_reso.to_value('deg'),
-                                                          stat='POISSON', counts2brightness=True,
-                                                          residual=True)
+        r_dat, p_dat, err_dat = profiler.profile(cntmap_data,
+                                                 stddev=np.sqrt(cntmap_tot),
+                                                 stat='POISSON', counts2brightness=True, residual=True)
+        r_tot, p_tot, err_tot = profiler.profile(cntmap_tot,
+                                                 stddev=np.sqrt(cntmap_tot),
+                                                 stat='POISSON', counts2brightness=True, residual=True)
+        r_cl, p_cl, err_cl = profiler.profile(cntmap_cl,
+                                              stddev=np.sqrt(cntmap_tot),
+                                              stat='POISSON', counts2brightness=True, residual=True)
+        r_bk, p_bk, err_bk = profiler.profile(cntmap_bk,
+                                              stddev=np.sqrt(cntmap_tot),
+                                              stat='POISSON', counts2brightness=True, residual=True)
         p_ps = []
         for ips in range(len(modbest['point_sources'])):
-            r_psi, p_psi, err_psi = map_tools.radial_profile_cts(cntmap_ps[ips],
-                                                                 [coord.icrs.ra.to_value('deg'),
-                                                                  coord.icrs.dec.to_value('deg')],
-                                                                 stddev=np.sqrt(cntmap_tot),
-                                                                 header=header,
-                                                                 binsize=profile_reso.to_value('deg'),
-                                                                 stat='POISSON', counts2brightness=True,
-                                                                 residual=True)
+            r_psi, p_psi, err_psi = profiler.profile(cntmap_ps[ips],
+                                                     stddev=np.sqrt(cntmap_tot),
+                                                     stat='POISSON', counts2brightness=True, residual=True)
             p_ps.append(p_psi)
                   
     fig = plt.figure(figsize=(8,6))
@@ -722,30 +1015,15 @@ def modelplot(data, modbest, MC_model, header, Ebins, outdir,
 
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
-            r_dat, p_dat, err_dat = map_tools.radial_profile_cts(cntmap_data,
-                                                                 [coord.icrs.ra.to_value('deg'),
-                                                                  coord.icrs.dec.to_value('deg')],
-                                                                 stddev=np.sqrt(cntmap_tot),
-                                                                 header=header,
-                                                                 binsize=profile_reso.to_value('deg'),
-                                                                 stat='POISSON', counts2brightness=True,
-                                                                 residual=True)
-            r_tot, p_tot, err_tot = map_tools.radial_profile_cts(cntmap_tot,
-                                                                 [coord.icrs.ra.to_value('deg'),
-                                                                  coord.icrs.dec.to_value('deg')],
-                                                                 stddev=np.sqrt(cntmap_tot),
-                                                                 header=header,
-                                                                 binsize=profile_reso.to_value('deg'),
-                                                                 stat='POISSON', counts2brightness=True,
-                                                                 residual=True)
-            r_cl, p_cl, err_cl = map_tools.radial_profile_cts(cntmap_cl,
-                                                              [coord.icrs.ra.to_value('deg'),
-                                                               coord.icrs.dec.to_value('deg')],
-                                                              stddev=np.sqrt(cntmap_cl),
-                                                              header=header,
-                                                              binsize=profile_reso.to_value('deg'),
-                                                              stat='POISSON', counts2brightness=True,
-                                                              residual=True)
+            r_dat, p_dat, err_dat = profiler.profile(cntmap_data,
+                                                     stddev=np.sqrt(cntmap_tot),
+                                                     stat='POISSON', counts2brightness=True, residual=True)
+            r_tot, p_tot, err_tot = profiler.profile(cntmap_tot,
+                                                     stddev=np.sqrt(cntmap_tot),
+                                                     stat='POISSON', counts2brightness=True, residual=True)
+            r_cl, p_cl, err_cl = profiler.profile(cntmap_cl,
+                                                  stddev=np.sqrt(cntmap_cl),
+                                                  stat='POISSON', counts2brightness=True, residual=True)
         
         fig = plt.figure(figsize=(8,6))
         gs = GridSpec(2,1, height_ratios=[3,1], hspace=0)
@@ -811,49 +1089,24 @@ def modelplot(data, modbest, MC_model, header, Ebins, outdir,
     
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
-            r_dat, p_dat, err_dat = map_tools.radial_profile_cts(cntmap_data,
-                                                                 [coord.icrs.ra.to_value('deg'),
-                                                                  coord.icrs.dec.to_value('deg')],
-                                                                 stddev=np.sqrt(cntmap_tot),
-                                                                 header=header,
-                                                                 binsize=profile_reso.to_value('deg'),
-                                                                 stat='POISSON', counts2brightness=True,
-                                                                 residual=True)
-            r_tot, p_tot, err_tot = map_tools.radial_profile_cts(cntmap_tot,
-                                                                 [coord.icrs.ra.to_value('deg'),
-                                                                  coord.icrs.dec.to_value('deg')],
-                                                                 stddev=np.sqrt(cntmap_tot),
-                                                                 header=header,
-                                                                 binsize=profile_reso.to_value('deg'),
-                                                                 stat='POISSON', counts2brightness=True,
-                                                                 residual=True)
-            r_cl, p_cl, err_cl = map_tools.radial_profile_cts(cntmap_cl,
-                                                              [coord.icrs.ra.to_value('deg'),
-                                                               coord.icrs.dec.to_value('deg')],
-                                                              stddev=np.sqrt(cntmap_tot),
-                                                              header=header,
-                                                              binsize=profile_reso.to_value('deg'),
-                                                              stat='POISSON', counts2brightness=True,
-                                                              residual=True)
-            r_bk, p_bk, err_bk = map_tools.radial_profile_cts(cntmap_bk,
-                                                              [coord.icrs.ra.to_value('deg'),
-                                                               coord.icrs.dec.to_value('deg')],
-                                                              stddev=np.sqrt(cntmap_tot),
-                                                              header=header,
-                                                              binsize=profile_reso.to_value('deg'),
-                                                              stat='POISSON', counts2brightness=True,
-                                                              residual=True)
+            r_dat, p_dat, err_dat = profiler.profile(cntmap_data,
+                                                     stddev=np.sqrt(cntmap_tot),
+                                                     stat='POISSON', counts2brightness=True, residual=True)
+            r_tot, p_tot, err_tot = profiler.profile(cntmap_tot,
+                                                     stddev=np.sqrt(cntmap_tot),
+                                                     stat='POISSON', counts2brightness=True, residual=True)
+            r_cl, p_cl, err_cl = profiler.profile(cntmap_cl,
+                                                  stddev=np.sqrt(cntmap_tot),
+                                                  stat='POISSON', counts2brightness=True, residual=True)
+            r_bk, p_bk, err_bk = profiler.profile(cntmap_bk,
+                                                  stddev=np.sqrt(cntmap_tot),
+                                                  stat='POISSON', counts2brightness=True, residual=True)
             
             p_ps = []
             for ips in range(len(modbest['point_sources'])):
-                r_psi, p_psi, err_psi = map_tools.radial_profile_cts(cntmap_ps[ips],
-                                                                     [coord.icrs.ra.to_value('deg'),
-                                                                      coord.icrs.dec.to_value('deg')],
-                                                                     stddev=np.sqrt(cntmap_tot),
-                                                                     header=header,
-                                                                     binsize=profile_reso.to_value('deg'),
-                                                                     stat='POISSON', counts2brightness=True,
-                                                                     residual=True)
+                r_psi, p_psi, err_psi = profiler.profile(cntmap_ps[ips],
+                                                         stddev=np.sqrt(cntmap_tot),
+                                                         stat='POISSON', counts2brightness=True, residual=True)
                 p_ps.append(p_psi)
 
         fig = plt.figure(figsize=(8,6))
@@ -931,11 +1184,8 @@ def modelplot(data, modbest, MC_model, header, Ebins, outdir,
         pointsource_spec.append(np.sum(np.sum(mask*modbest['point_sources'][ips], axis=1), axis=1))
     
     #----- Get the MC
-    Nmc = MC_model['cluster'].shape[0]
-    cluster_mc_spec    = np.zeros((Nmc, len(Ebins)))
-    for i in range(Nmc):
-        cluster_mci_spec    = np.sum(np.sum(mask*MC_model['cluster'][i,:,:,:], axis=1), axis=1)
-        cluster_mc_spec[i, :]    = cluster_mci_spec
+    cluster_mc_spec = MC_model['cluster_spectrum']
+    Nmc = cluster_mc_spec.shape[0]
     cluster_up_spec    = np.percentile(cluster_mc_spec, (100-conf)/2.0, axis=0)
     cluster_lo_spec    = np.percentile(cluster_mc_spec, 100 - (100-conf)/2.0, axis=0)
 
@@ -1024,7 +1274,7 @@ def modelplot(data, modbest, MC_model, header, Ebins, outdir,
 # Read the data
 #==================================================
 
-def read_data(input_files):
+def read_data(input_files, memmap=True):
     """
     Read the data to extract the necessary information
     
@@ -1032,6 +1282,8 @@ def read_data(input_files):
     ----------
     - input_files (str list): file where the data is stored
     and file where the grid model is stored
+    - memmap (bool): map the model grids from the file rather than
+    loading them in memory
 
     Output
     ------
@@ -1053,14 +1305,14 @@ def read_data(input_files):
     
     sample_spa    = hdul[1].data
     sample_spe    = hdul[2].data
-    models_cl     = hdul[3].data
+    models_cl     = mcmc_common.read_grid_hdu(hdul, 3, memmap=memmap)
     bk_sample_spe = hdul[4].data
-    models_bk     = hdul[5].data
+    models_bk     = mcmc_common.read_grid_hdu(hdul, 5, memmap=memmap)
     ps_sample_spe = hdul[6].data
     models_ps_list = []
     for ips in range(Nps):
-        models_ps_list.append(hdul[7+ips].data)
-    hdu.close()
+        models_ps_list.append(mcmc_common.read_grid_hdu(hdul, 7+ips, memmap=memmap))
+    hdul.close()
 
     gridshape = models_cl.shape
     
@@ -1187,6 +1439,60 @@ def lnlike(params, data, modgrid, par_min, par_max, gauss=True):
     return lnL + prior
 
 
+#==================================================
+# MCMC: Defines log likelihood for a batch of walkers
+#==================================================
+
+def lnlike_batch(params, data, modgrid, par_min, par_max, gauss=True):
+    '''
+    Return the log likelihood for a batch of walkers, as used
+    by emcee with vectorize=True
+
+    Parameters
+    ----------
+    - params (ndarray): the parameters as Nwalker x Npar
+    - data (Table): the data flux and errors
+    - modgrid (Table): grid of model for different scaling to be interpolated
+    - par_min (list): the minimum value for params
+    - par_max (list): the maximum value for params
+    - gauss (bool): use a gaussian approximation for errors
+
+    Output
+    ------
+    - lnlike (array): the value of the log likelihood for each walker
+    '''
+
+    params = np.atleast_2d(params)
+
+    #---------- Get the prior
+    prior = mcmc_common.lnprior_batch(params, par_min, par_max)
+    lnL   = np.zeros(len(params)) - np.inf
+    good  = np.isfinite(prior)
+    if np.sum(good) == 0:
+        return lnL
+    
+    #---------- Get the test model for walkers within the prior
+    test_model = model_specimg_batch(modgrid, params[good])
+    
+    #---------- Compute the likelihood
+    # Gaussian likelihood
+    if gauss:
+        chi2 = (data - test_model['total'])**2/np.sqrt(test_model['total'])**2
+        lnL_good = -0.5*np.nansum(chi2, axis=(1,2,3))
+
+    # Poisson with Bkg
+    else:        
+        L_i1 = test_model['total']
+        L_i2 = data*np.log(test_model['total'])
+        lnL_good = -np.nansum(L_i1 - L_i2, axis=(1,2,3))
+        
+    # In case of NaN, goes to infinity
+    lnL_good[np.isnan(lnL_good)] = -np.inf
+    lnL[good] = lnL_good
+    
+    return lnL + prior
+
+
 #==================================================
 # MCMC: Defines model
 #==================================================
@@ -1211,23 +1517,20 @@ def model_specimg(modgrid, params):
     # 7, 8    -> Norm, spec ps2
     # ...
 
-    # Cluster component
-    outf_cl = interpn((modgrid['spa_val'], modgrid['spe_val'],
-                       modgrid['e_val'], modgrid['y_val'], modgrid['x_val']),
-                      modgrid['models_cl'],
-                      (params[1], params[2], modgrid['eef_val'], modgrid['yyf_val'], modgrid['xxf_val']))
-    out_cl = np.reshape(outf_cl, modgrid['xx_val'].shape)
+    # Cluster component: only the (spatial, spectral) axes are interpolated
+    out_cl = mcmc_common.interp_grid2d(modgrid['spa_val'], modgrid['spe_val'],
+                                       modgrid['models_cl'], params[1], params[2])
     out_cl = params[0]*out_cl
     
     # Background component
-    f_bk = interp1d(modgrid['bk_spe_val'], modgrid['models_bk'], axis=0)
-    out_bk = params[3] * f_bk(params[4])
+    out_bk = params[3] * mcmc_common.interp_grid1d(modgrid['bk_spe_val'], modgrid['models_bk'], params[4])
     
     # Point sources component
     out_ps = []
     for ips in range(len(modgrid['models_ps_list'])):
-        f_ps = interp1d(modgrid['ps_spe_val'], modgrid['models_ps_list'][ips], axis=0)
-        out_ps.append(params[5+ips*2] * f_ps(params[6+ips*2]))
+        out_ps.append(params[5+ips*2] * mcmc_common.interp_grid1d(modgrid['ps_spe_val'],
+                                                                  modgrid['models_ps_list'][ips],
+                                                                  params[6+ips*2]))
         
     # Add normalization parameter and save
     tot_ps = out_cl*0
@@ -1240,6 +1543,193 @@ def model_specimg(modgrid, params):
     return output_model
 
 
+#==================================================
+# MCMC: Defines model for a batch of walkers
+#==================================================
+
+def model_specimg_batch(modgrid, params):
+    '''
+    Gamma ray model for the MCMC, computed for a batch of walkers
+    at once as a stacked weighted sum of the grid models
+
+    Parameters
+    ----------
+    - modgrid (array): grid of models
+    - param (ndarray): the parameters to sample in the model, as Nwalker x Npar
+
+    Output
+    ------
+    - output_model (array): the output models in units of the input expected,
+    with the walkers along the first axis
+    '''
+
+    params = np.atleast_2d(params)
+    
+    # Cluster component
+    out_cl = mcmc_common.interp_grid2d_batch(modgrid['spa_val'], modgrid['spe_val'],
+                                             modgrid['models_cl'], params[:,1], params[:,2])
+    out_cl = params[:,0,None,None,None]*out_cl
+    
+    # Background component
+    out_bk = mcmc_common.interp_grid1d_batch(modgrid['bk_spe_val'], modgrid['models_bk'], params[:,4])
+    out_bk = params[:,3,None,None,None]*out_bk
+    
+    # Point sources component
+    out_ps = []
+    for ips in range(len(modgrid['models_ps_list'])):
+        out_psi = mcmc_common.interp_grid1d_batch(modgrid['ps_spe_val'], modgrid['models_ps_list'][ips],
+                                                  params[:,6+ips*2])
+        out_ps.append(params[:,5+ips*2,None,None,None]*out_psi)
+        
+    # Add normalization parameter and save
+    total = out_cl + out_bk
+    for ips in range(len(modgrid['models_ps_list'])):
+        total = total + out_ps[ips]
+
+    output_model = {'cluster':out_cl, 'background':out_bk, 'point_sources':out_ps, 'total':total}
+
+    return output_model
+
+
+#==================================================
+# MCMC: Linear amplitudes and shape parameters
+#==================================================
+
+def linear_parameters(Nps):
+    '''
+    Give the index of the parameters which enter the model linearly
+    (cluster, background and point source normalizations), and of the
+    other (shape) parameters.
+
+    Parameters
+    ----------
+    - Nps (int): the number of point sources
+
+    Output
+    ------
+    - lin_idx (list): index of the amplitudes, in the order cluster,
+    background, point sources
+    - shape_idx (list): index of the shape parameters
+    '''
+
+    lin_idx   = [0, 3] + [5+ips*2 for ips in range(Nps)]
+    shape_idx = [1, 2, 4] + [6+ips*2 for ips in range(Nps)]
+
+    return lin_idx, shape_idx
+
+
+#==================================================
+# MCMC: Defines unit amplitude templates for a batch of walkers
+#==================================================
+
+def model_templates_batch(modgrid, params):
+    '''
+    Gamma ray model of each component with unit amplitude, computed
+    for a batch of walkers given the shape parameters
+
+    Parameters
+    ----------
+    - modgrid (array): grid of models
+    - param (ndarray): the shape parameters, as Nwalker x Nshape
+
+    Output
+    ------
+    - templates (ndarray): the models as Nwalker x Ncomp x (cube shape),
+    the components being the cluster, the background and the point sources
+    '''
+
+    params = np.atleast_2d(params)
+    lin_idx, shape_idx = linear_parameters(len(modgrid['models_ps_list']))
+
+    par_full = np.ones((len(params), len(lin_idx)+len(shape_idx)))
+    par_full[:,shape_idx] = params
+    models = model_specimg_batch(modgrid, par_full)
+
+    templates = np.stack([models['cluster'], models['background']]+models['point_sources'], axis=1)
+
+    return templates
+
+
+#==================================================
+# MCMC: log likelihood with the amplitudes profiled out
+#==================================================
+
+def lnlike_profiled_batch(params, data, modgrid, par_min, par_max, gauss=True, marginalize=False,
+                          seed=0):
+    '''
+    Return the log likelihood for a batch of walkers as a function of the
+    shape parameters only. For each walker, the likelihood is maximized
+    (or Laplace-marginalized) over the amplitudes of the cluster, background
+    and point sources, which enter the model linearly. The amplitudes are
+    returned together with the likelihood, so that emcee records them as blobs.
+    When marginalizing, the amplitudes are drawn with a generator seeded from
+    the seed and the parameters, so that the draws are reproducible and do not
+    depend on the process evaluating the walkers.
+
+    Parameters
+    ----------
+    - params (ndarray): the shape parameters as Nwalker x Nshape
+    - data (Table): the data flux and errors
+    - modgrid (Table): grid of model for different scaling to be interpolated
+    - par_min (list): the minimum value for the shape params
+    - par_max (list): the maximum value for the shape params
+    - gauss (bool): use a gaussian approximation for errors
+    - marginalize (bool): marginalize over the amplitudes rather than maximize
+    - seed (int): the seed of the amplitude draws
+
+    Output
+    ------
+    - lnlike (list): for each walker, the value of the log likelihood and
+    the amplitudes (cluster, background, point sources)
+    '''
+
+    params = np.atleast_2d(params)
+    Ncomp  = 2 + len(modgrid['models_ps_list'])
+
+    #---------- Get the prior
+    prior = mcmc_common.lnprior_batch(params, par_min, par_max)
+    lnL   = np.zeros(len(params)) - np.inf
+    amp   = np.zeros((len(params), Ncomp)) + np.nan
+    good  = np.isfinite(prior)
+
+    #---------- Profile the amplitudes for walkers within the prior
+    if np.sum(good) > 0:
+        templates = model_templates_batch(modgrid, params[good])
+        rng = None
+        if marginalize:
+            entropy = np.frombuffer(np.ascontiguousarray(params[good], dtype=np.float64).tobytes(),
+                                    dtype=np.uint32)
+            rng = np.random.default_rng(np.random.SeedSequence([seed]+entropy.tolist()))
+        lnL_good, amp[good] = mcmc_common.profile_linear_amplitudes(templates, data, gauss=gauss,
+                                                                    marginalize=marginalize, rng=rng)
+        lnL_good[np.isnan(lnL_good)] = -np.inf
+        lnL[good] = lnL_good
+
+    lnL = lnL + prior
+
+    return [(lnL[i], amp[i]) for i in range(len(params))]
+
+
+def lnlike_profiled(params, data, modgrid, par_min, par_max, gauss=True, marginalize=False,
+                    seed=0):
+    '''
+    Same as lnlike_profiled_batch, for a single walker
+
+    Parameters
+    ----------
+    - params (list): the shape parameters
+    - see lnlike_profiled_batch for the other parameters
+
+    Output
+    ------
+    - lnlike (float): the value of the log likelihood
+    - amp (array): the amplitudes (cluster, background, point sources)
+    '''
+
+    return lnlike_profiled_batch(params, data, modgrid, par_min, par_max,
+                                 gauss=gauss, marginalize=marginalize, seed=seed)[0]
+
+
 #==================================================
 # MCMC: run the fit
 #==================================================
@@ -1254,6 +1744,12 @@ def run_constraint(input_files,
                    GaussLike=False,
                    reset_mcmc=False,
                    run_mcmc=True,
+                   adaptive=False,
+                   ntau=50.0,
+                   check_every=100,
+                   vectorize=False,
+                   nproc=1,
+                   amplitudes='sample',
                    FWHM=0.1*u.deg,
                    theta=1.0*u.deg,
                    coord=None,
@@ -1273,6 +1769,18 @@ def run_constraint(input_files,
     - GaussLike (bool): use gaussian approximation of the likelihood
     - reset_mcmc (bool): reset the existing MCMC chains?
     - run_mcmc (bool): run the MCMC sampling?
+    - adaptive (bool): run the MCMC by chunks until the chains are longer than ntau
+    autocorrelation times (nsteps is then the maximum), and set the burnin and
+    thinning from the autocorrelation time
+    - ntau (float): required chain length in unit of autocorrelation time
+    - check_every (int): number of steps between two convergence checks
+    - vectorize (bool): evaluate the likelihood for all walkers at once
+    - nproc (int): number of processes used to evaluate the likelihood
+    - amplitudes (str): the amplitudes of the cluster, background and point sources, which
+    enter the model linearly, are either sampled with the other parameters ('sample'), or
+    maximized ('profile') or Laplace-marginalized ('marginalize') over at each likelihood call,
+    so that the sampler explores only the shape parameters. In the latter case, the amplitudes
+    recorded along the chains are the best fit ones, or drawn from the Laplace approximation.
     - FWHM (quantity): size of the FWHM to be used for smoothing
     - theta (quantity): containment angle for plots
     - coord (SkyCoord): source coordinates for extraction
@@ -1308,20 +1816,24 @@ def run_constraint(input_files,
         par_max.append(np.inf)
         par_max.append(np.amax(modgrid['ps_spe_val']))
 
+    #========== Parameters explored by the sampler
+    lin_idx, shape_idx = linear_parameters(len(modgrid['models_ps_list']))
+    if amplitudes == 'sample':
+        mcmc_idx = list(range(len(par0)))
+    elif amplitudes in ['profile', 'marginalize']:
+        mcmc_idx = shape_idx
+    else:
+        raise ValueError("The amplitudes should be 'sample', 'profile' or 'marginalize'.")
+
     #========== Names
-    sampler_file   = subdir+'/MCMC_sampler.pkl'
+    chains_file    = subdir+'/MCMC_chains.h5'
     chainstat_file = subdir+'/MCMC_chainstat.txt'
+    autocorr_file  = subdir+'/MCMC_autocorr.txt'
     chainplot_file = subdir+'/MCMC_chainplot'
     
     #========== Start running MCMC definition and sampling    
-    #---------- Check if a MCMC sampler was already recorded
-    sampler_exist = os.path.exists(sampler_file)
-    if sampler_exist:
-        sampler = mcmc_common.load_object(sampler_file)
-        print('    Existing sampler: '+sampler_file)
-    
     #---------- MCMC parameters
-    ndim = len(par0)
+    ndim = len(mcmc_idx)
     if nwalkers < 2*ndim:
         print('nwalkers should be at least twice the number of parameters.')
         print('nwalkers --> '+str(ndim*2))
@@ -1335,45 +1847,85 @@ def run_constraint(input_files,
     print('    burnin              = '+str(burnin))
     print('    conf                = '+str(conf))
     print('    reset_mcmc          = '+str(reset_mcmc))
+    print('    adaptive            = '+str(adaptive))
     print('    Gaussian likelihood = '+str(GaussLike))
+    print('    amplitudes          = '+amplitudes)
+    print('    vectorize           = '+str(vectorize))
+    print('    nproc               = '+str(nproc))
 
     #---------- Defines the start
-    if sampler_exist:
-        if reset_mcmc:
-            print('--- Reset MCMC even though sampler already exists')
-            pos = [par0 + 1e-2*np.random.randn(ndim) for i in range(nwalkers)]
-            sampler.reset()
-            sampler = emcee.EnsembleSampler(nwalkers, ndim, lnlike,
-                                            args=[data, modgrid, par_min, par_max, GaussLike])
+    if amplitudes == 'sample':
+        if vectorize:
+            lnfunc = lnlike_batch
         else:
-            print('--- Start from already existing sampler')
-            pos = sampler.chain[:,-1,:]
+            lnfunc = lnlike
+        lnargs = [data, modgrid, par_min, par_max, GaussLike]
     else:
-        print('--- No pre-existing sampler, start from scratch')
-        pos = [par0 + 1e-2*np.random.randn(ndim) for i in range(nwalkers)]
-        sampler = emcee.EnsembleSampler(nwalkers, ndim, lnlike,
-                                        args=[data, modgrid, par_min, par_max, GaussLike])
+        if vectorize:
+            lnfunc = lnlike_profiled_batch
+        else:
+            lnfunc = lnlike_profiled
+        lnargs = [data, modgrid, [par_min[i] for i in mcmc_idx], [par_max[i] for i in mcmc_idx],
+                  GaussLike, amplitudes == 'marginalize']
+    
+    config = {'data':[mcmc_common.file_signature(f) for f in input_files],
+              'par_min':par_min, 'par_max':par_max, 'GaussLike':GaussLike, 'amplitudes':amplitudes}
+    backend, resume = mcmc_common.chains_backend(chains_file, nwalkers, ndim, reset=reset_mcmc,
+                                                 config=config)
+    sampler = emcee.EnsembleSampler(nwalkers, ndim, lnfunc,
+                                    args=lnargs,
+                                    vectorize=vectorize, backend=backend)
+    if resume:
+        print('--- Continue the chains recorded in '+chains_file+' ('+str(backend.iteration)+' steps)')
+        pos = backend.get_last_sample()
+    else:
+        print('--- No chains to continue, start from scratch')
+        pos = [par0[mcmc_idx] + 1e-2*np.random.randn(ndim) for i in range(nwalkers)]
     
     #---------- Run the MCMC
+    tau_history = None
     if run_mcmc:
-        print('--- Runing '+str(nsteps)+' MCMC steps')
-        sampler.run_mcmc(pos, nsteps, progress=True)
-
-    #---------- Save the MCMC after the run
-    mcmc_common.save_object(sampler, sampler_file)
+        if adaptive:
+            print('--- Runing up to '+str(nsteps)+' MCMC steps, until convergence')
+            tau_history = mcmc_common.run_ensemble_adaptive(sampler, pos, nsteps, nproc=nproc,
+                                                            check_every=check_every, ntau=ntau)
+        else:
+            print('--- Runing '+str(nsteps)+' MCMC steps')
+            mcmc_common.run_ensemble(sampler, pos, nsteps, nproc=nproc)
 
     #---------- Burnin
-    param_chains = sampler.chain[:, burnin:, :]
-    lnL_chains = sampler.lnprobability[:, burnin:]
+    thin = 1
+    if adaptive:
+        burnin, thin = mcmc_common.autocorr_diagnostics(sampler, ntau=ntau, tau_history=tau_history,
+                                                        parname=[parname[i] for i in mcmc_idx],
+                                                        outfile=autocorr_file)
+        print('--- Burnin and thinning from the autocorrelation time: '+str(burnin)+', '+str(thin))
+    param_chains = sampler.chain[:, burnin::thin, :]
+    lnL_chains = sampler.lnprobability[:, burnin::thin]
+
+    # Put back the amplitudes recorded along the chains
+    if amplitudes != 'sample':
+        amp_chains = np.swapaxes(sampler.get_blobs(), 0, 1)[:, burnin::thin, :]
+        par_chains_full = np.zeros(param_chains.shape[0:2]+(len(par0),))
+        par_chains_full[:,:,shape_idx] = param_chains
+        par_chains_full[:,:,lin_idx]   = amp_chains
+        param_chains = par_chains_full
     
     #---------- Get the parameter statistics
+    # The recorded amplitudes are draws when marginalizing: profile them at the best shape parameters
+    par_best = None
+    if amplitudes != 'sample':
+        par_best = param_chains[lnL_chains == np.amax(lnL_chains)][0]
+        templates = model_templates_batch(modgrid, par_best[shape_idx])
+        par_best[lin_idx] = mcmc_common.profile_linear_amplitudes(templates, data, gauss=GaussLike)[1][0]
     par_best, par_percentile = mcmc_common.chains_statistics(param_chains, lnL_chains,
                                                              parname=parname, conf=conf, show=True,
-                                                             outfile=chainstat_file)
+                                                             outfile=chainstat_file, par_best=par_best)
     
     #---------- Get the well-sampled models
-    MC_model   = get_mc_model(modgrid, param_chains, Nmc=Nmc)
     Best_model = model_specimg(modgrid, par_best)
+    MC_model   = get_mc_model(modgrid, param_chains, Best_model, Nmc=Nmc,
+                              coord=coord, theta=theta, profile_reso=profile_reso)
 
     #---------- Plots and results
     
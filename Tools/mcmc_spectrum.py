@@ -9,6 +9,8 @@ This file contains the modules which perform the MCMC constraint.
 import pickle
 import copy
 import os
+import time
+import hashlib
 import numpy as np
 from scipy.interpolate import interp1d
 import matplotlib.pyplot as plt
@@ -26,6 +28,7 @@ import corner
 from minot.model_tools import trapz_loglog
 from kesacco.Tools import plotting
 from kesacco.Tools import mcmc_common
+from kesacco.Tools import utilities
 
 
 #==================================================
@@ -65,27 +68,26 @@ def get_global_prop(MC_eng, MC_model, Best_model, Dlum, rout_file,
     Nmc = MC_model.shape[0]
     eng_flux = np.logspace(np.log10(Emin), np.log10(Emax), 100)
     
-    L1_mc = np.zeros(Nmc)
-    L2_mc = np.zeros(Nmc)
-    F1_mc = np.zeros(Nmc)
-    F2_mc = np.zeros(Nmc)
+    # Interpolate all the models (MC and best fit) over the requiered range at once.
+    # The cubic spline is linear in the data, so its basis matrix (N_flux x N_eng)
+    # is computed once and applied to all the models with a single product.
+    itp_matrix = interp1d(np.log10(MC_eng), np.eye(len(MC_eng)), kind='cubic', axis=0)(np.log10(eng_flux))
     
-    for i in range(Nmc):
-        # Interpolate the model over the requiered range
-        itpval = np.log10(MC_model[i,:]/(MC_eng*1e3)**2)
-        itpval[MC_model[i,:] <= 0] = -100
-        itpl = interp1d(np.log10(MC_eng), itpval, kind='cubic')
-        model_i = 10**itpl(np.log10(eng_flux)) # MeV-1 s-1 cm-2
-        
-        # compute the integral
-        F1_i = trapz_loglog(model_i, eng_flux*1e3)          # ph/s/cm2
-        F2_i = trapz_loglog((eng_flux*1e3)*model_i, eng_flux*1e3) # MeV/s/cm2
-        
-        # store the Luminosity and flux
-        F1_mc[i] = F1_i
-        F2_mc[i] = F2_i
-        L1_mc[i] = F1_i * (4*np.pi*Dlum**2) # ph/s
-        L2_mc[i] = F2_i * (4*np.pi*Dlum**2) # MeV/s
+    models = np.vstack([MC_model, Best_model])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        itpval = np.log10(models/(MC_eng*1e3)**2)
+    itpval[models <= 0] = -100
+    model_flux = 10**np.dot(itpval, itp_matrix.T) # MeV-1 s-1 cm-2, (Nmc+1) x N_flux
+    
+    # compute the integrals along the energy axis
+    F1_all = trapz_loglog(model_flux, eng_flux*1e3, axis=1)                  # ph/s/cm2
+    F2_all = trapz_loglog((eng_flux*1e3)*model_flux, eng_flux*1e3, axis=1)   # MeV/s/cm2
+    
+    # store the Luminosity and flux
+    F1_mc = F1_all[0:Nmc]
+    F2_mc = F2_all[0:Nmc]
+    L1_mc = F1_mc * (4*np.pi*Dlum**2) # ph/s
+    L2_mc = F2_mc * (4*np.pi*Dlum**2) # MeV/s
 
     MeV2erg = (1.0*u.MeV).to_value('erg')
     F1_perc = np.percentile(F1_mc, [(100-conf)/2.0, 50, 100 - (100-conf)/2.0])           # ph/s/cm2
@@ -96,12 +98,8 @@ def get_global_prop(MC_eng, MC_model, Best_model, Dlum, rout_file,
     L3_perc = np.percentile(L2_mc*MeV2erg, [(100-conf)/2.0, 50, 100 - (100-conf)/2.0])   # erg/s
 
     # Get also the best model
-    itpval = np.log10(Best_model/(MC_eng*1e3)**2)
-    itpval[Best_model <= 0] = -100
-    itpl = interp1d(np.log10(MC_eng), itpval, kind='cubic')
-    model_b = 10**itpl(np.log10(eng_flux)) # MeV-1 cm-2 s-1
-    F1_B = trapz_loglog(model_b, eng_flux*1e3)
-    F2_B = trapz_loglog((eng_flux*1e3)*model_b, eng_flux*1e3)
+    F1_B = F1_all[Nmc]
+    F2_B = F2_all[Nmc]
     F3_B = F2_B*MeV2erg
     L1_B = F1_B * (4*np.pi*Dlum**2) # ph/s
     L2_B = F2_B * (4*np.pi*Dlum**2) # MeV/s
@@ -269,13 +267,13 @@ def modelplot(data, cluster_test, par_best, param_chains, MC_eng, MC_model, conf
 # Get models from the parameter space
 #==================================================
 
-def get_mc_model(eng_mc, param_chains, cluster_test, Nmc=100):
+def get_mc_model(emulator, param_chains, Nmc=100):
     """
     Get models randomly sampled from the parameter space
         
     Parameters
     ----------
-    - eng_mc (array): an array of energy
+    - emulator (dict): spectral emulator at the requested energies
     - param_chains (ndarray): array of chains parametes
     - Nmc (int): number of models
 
@@ -294,11 +292,8 @@ def get_mc_model(eng_mc, param_chains, cluster_test, Nmc=100):
     
     Nsample = len(par_flat[:,0])-1
     
-    MC_model = np.zeros((Nmc, len(eng_mc)))
-    
-    for i in range(Nmc):
-        param_MC = par_flat[np.random.randint(0, high=Nsample), :] # randomly taken from chains
-        MC_model[i,:] = model_dNdEdSdt(cluster_test, eng_mc, param_MC)
+    param_MC = par_flat[np.random.randint(0, high=Nsample, size=Nmc), :] # randomly taken from chains
+    MC_model = emulator_model(emulator, param_MC)
     
     return MC_model
 
@@ -351,9 +346,55 @@ def read_data(specfile):
     data['e2dnde_err']    = e2dnde_err.to_value('MeV cm-2 s-1')
     data['norm_scan']     = norm_scan
     data['dloglike_scan'] = dloglike_scan
+
+    # Likelihood scan versus model flux, sorted as in scipy interp1d, with the
+    # slopes used for the linear interpolation and extrapolation
+    scan_flux = norm_scan*data['ref_e2dnde'][:,np.newaxis]
+    isort = np.argsort(scan_flux, axis=1, kind='mergesort')
+    scan_flux = np.take_along_axis(scan_flux, isort, axis=1)
+    scan_dloglike = np.take_along_axis(np.array(dloglike_scan, dtype=float), isort, axis=1)
+    data['scan_flux']     = scan_flux
+    data['scan_dloglike'] = scan_dloglike
+    data['scan_slope']    = np.diff(scan_dloglike, axis=1)/np.diff(scan_flux, axis=1)
     
     return data
 
+
+#==================================================
+# Interpolate the likelihood scan
+#==================================================
+
+def interp_lnlike_scan(data, model):
+    """
+    Interpolate the likelihood scan of each energy bin at the model flux,
+    for all bins (and walkers) at once. This is equivalent to a linear
+    scipy interp1d(fill_value='extrapolate') for each bin: the bracketing
+    scan points are found as searchsorted would (number of scan fluxes
+    below the model), and the segment slope is reused beyond the scan.
+    
+    Parameters
+    ----------
+    - data (Table): the data, as given by read_data
+    - model (array): the model flux as Nbin or Nwalker x Nbin, MeV cm-2 s-1
+
+    Output
+    ------
+    - lnL_i (array): the log likelihood in each bin, same shape as model
+
+    """
+
+    flux     = np.asarray(data['scan_flux'])
+    dloglike = np.asarray(data['scan_dloglike'])
+    slope    = np.asarray(data['scan_slope'])
+    Nbin, Nscan = flux.shape
+
+    model = np.asarray(model, dtype=float)
+    idx = np.sum(flux < model[...,np.newaxis], axis=-1)
+    ilo = np.clip(idx, 1, Nscan-1) - 1
+    ibin = np.arange(Nbin)
+    
+    return slope[ibin, ilo]*(model - flux[ibin, ilo]) + dloglike[ibin, ilo]
+
     
 #==================================================
 # MCMC: Defines log prior
@@ -388,7 +429,7 @@ def lnprior(params, par_min, par_max):
 # MCMC: Defines log likelihood
 #==================================================
 
-def lnlike(params, cluster, data, par_min, par_max,
+def lnlike(params, emulator, data, par_min, par_max,
            gauss=True):
     '''
     Return the log likelihood for the given parameters
@@ -396,7 +437,7 @@ def lnlike(params, cluster, data, par_min, par_max,
     Parameters
     ----------
     - params (list): the parameters
-    - cluster (ClusterModel object): cluster test modeling object
+    - emulator (dict): spectral emulator at the data energies
     - data (Table): the data flux and errors
     - par_min (list): the minimum value for params
     - par_max (list): the maximum value for params
@@ -421,7 +462,7 @@ def lnlike(params, cluster, data, par_min, par_max,
         import pdb
         pdb.set_trace()
         
-    test_model = model_dNdEdSdt(cluster, data['e_ref'], params)
+    test_model = emulator_model(emulator, params)
     
     #---------- Compute the Gaussian likelihood
     # Gaussian likelihood
@@ -431,14 +472,8 @@ def lnlike(params, cluster, data, par_min, par_max,
         
     # Likelihood taking into account true bin lnL
     else:
-        Nbin = len(data['e_ref'])
-        lnL_i = np.zeros(Nbin)
-        for i in range(Nbin):
-            # Interpolate the likelihood scan at the location of the model flux
-            f = interp1d(data['norm_scan'][i,:]*data['ref_e2dnde'][i], data['dloglike_scan'][i,:],
-                         fill_value='extrapolate') # extrapolate tested to work well on few sample
-            lnL_i[i] = f(test_model[i])
-            
+        # Interpolate the likelihood scan at the location of the model flux
+        lnL_i = interp_lnlike_scan(data, test_model) # extrapolate tested to work well on few sample
         lnL = np.sum(lnL_i)
 
     # In case of NaN, goes to infinity
@@ -448,6 +483,62 @@ def lnlike(params, cluster, data, par_min, par_max,
     return lnL + prior
 
 
+#==================================================
+# MCMC: Defines log likelihood for a batch of walkers
+#==================================================
+
+def lnlike_batch(params, emulator, data, par_min, par_max,
+                 gauss=True):
+    '''
+    Return the log likelihood for a batch of walkers, as used
+    by emcee with vectorize=True. The model, the prior and the
+    likelihood are evaluated for the whole batch at once.
+
+    Parameters
+    ----------
+    - params (ndarray): the parameters as Nwalker x Npar
+    - emulator (dict): spectral emulator at the data energies
+    - data (Table): the data flux and errors
+    - par_min (list): the minimum value for params
+    - par_max (list): the maximum value for params
+    - gauss (bool): use a gaussian approximation for errors
+
+    Output
+    ------
+    - lnlike (array): the value of the log likelihood for each walker
+    '''
+
+    params = np.atleast_2d(params)
+
+    #---------- Get the prior
+    prior = mcmc_common.lnprior_batch(params, par_min, par_max)
+    lnL   = np.zeros(len(params)) - np.inf
+    good  = np.isfinite(prior)
+    if np.sum(good) == 0:
+        return lnL
+
+    #---------- Get the test model for walkers within the prior
+    test_model = emulator_model(emulator, params[good])
+
+    #---------- Compute the Gaussian likelihood
+    # Gaussian likelihood
+    if gauss:
+        chi2 = (np.array(data['e2dnde']) - test_model)**2 / np.array(data['e2dnde_err'])**2
+        lnL_good = -0.5*np.nansum(chi2, axis=1)
+        
+    # Likelihood taking into account true bin lnL
+    else:
+        # Interpolate the likelihood scan at the location of the model flux
+        lnL_i = interp_lnlike_scan(data, test_model) # extrapolate tested to work well on few sample
+        lnL_good = np.sum(lnL_i, axis=1)
+
+    # In case of NaN, goes to infinity
+    lnL_good[np.isnan(lnL_good)] = -np.inf
+    lnL[good] = lnL_good
+        
+    return lnL + prior
+
+
 #==================================================
 # MCMC: Defines model
 #==================================================
@@ -482,6 +573,158 @@ def model_dNdEdSdt(cluster, energy, params):
     return output_model
 
 
+#==================================================
+# Spectral model emulator
+#==================================================
+
+def build_emulator(cluster, energy, index_min, index_max, index_npt=61,
+                   cache_file=None, Ncheck=5, report_file=None):
+    '''
+    Tabulate the gamma-ray spectrum of the cluster for X_crp = 1 on a grid
+    of CRp spectral index. Since the model is linear in X_crp, the spectrum
+    for any parameter is then obtained by scaling the tabulated spectra and
+    interpolating them in log space along the index axis (see emulator_model).
+    The table is cached and reused as long as the cluster, the energies and
+    the index grid do not change.
+
+    Parameters
+    ----------
+    - cluster (ClusterModel object): cluster modeling object
+    - energy (array, GeV): energy at which to compute the model
+    - index_min, index_max (float): range of the CRp index
+    - index_npt (int): number of CRp index values
+    - cache_file (str): npz file where the table is cached, None for no cache
+    - Ncheck (int): number of index values used to check the accuracy
+    - report_file (str): file where to write the accuracy report
+
+    Output
+    ------
+    - emulator (dict): the energy, the index grid and the log of the models
+    '''
+
+    cluster = copy.deepcopy(cluster)
+    energy = np.asarray(energy, dtype=float)
+    index_grid = np.linspace(index_min, index_max, index_npt)
+    cluster.X_crp_E            = {'X':1.0, 'R_norm':cluster.R500}
+    cluster.spectrum_crp_model = {'name':'PowerLaw', 'Index':index_grid[0]}
+
+    md5 = hashlib.md5()
+    utilities.hash_update(md5, [cluster, energy, index_grid], set())
+    key = md5.hexdigest()
+
+    #---------- Read the cache
+    if cache_file is not None and os.path.isfile(cache_file):
+        cache = np.load(cache_file)
+        if str(cache['key']) == key:
+            print('--- Spectral emulator read from '+cache_file)
+            return {'energy':cache['energy'], 'index':cache['index'], 'lnmodel':cache['lnmodel']}
+
+    #---------- Tabulate the models
+    print('--- Building the spectral emulator ('+str(index_npt)+' minot spectra)')
+    lnmodel = np.zeros((index_npt, len(energy)))
+    for i in range(index_npt):
+        model = model_dNdEdSdt(cluster, energy, [1.0, index_grid[i]])
+        lnmodel[i,:] = np.log(np.maximum(model, np.finfo(float).tiny))
+    emulator = {'energy':energy, 'index':index_grid, 'lnmodel':lnmodel}
+
+    if cache_file is not None:
+        tmpfile = cache_file+'.tmp'+str(os.getpid())+'.npz'
+        np.savez(tmpfile, key=key, energy=energy, index=index_grid, lnmodel=lnmodel)
+        os.replace(tmpfile, cache_file)
+
+    #---------- Check the accuracy
+    if Ncheck > 0:
+        emulator_accuracy(cluster, emulator, Ncheck=Ncheck, outfile=report_file)
+
+    return emulator
+
+
+#==================================================
+# Spectral model emulator: evaluation
+#==================================================
+
+def emulator_model(emulator, params):
+    '''
+    Gamma ray model computed with the emulator, for one set of parameters
+    or for a batch of walkers.
+
+    Parameters
+    ----------
+    - emulator (dict): the emulator from build_emulator
+    - params (array): the parameters, as Npar or Nwalker x Npar
+
+    Output
+    ------
+    - output_model (array): the output model in MeV /cm2 / s, as Neng or Nwalker x Neng
+    '''
+
+    params_2d = np.atleast_2d(params)
+    idx, wgt = mcmc_common.grid_interp_weights_batch(emulator['index'], params_2d[:,1])
+    lnmodel = (wgt[:,0,None]*emulator['lnmodel'][idx[:,0]] +
+               wgt[:,1,None]*emulator['lnmodel'][idx[:,1]])
+    output_model = params_2d[:,0,None]*np.exp(lnmodel)
+
+    if np.ndim(params) == 1:
+        return output_model[0]
+    return output_model
+
+
+#==================================================
+# Spectral model emulator: accuracy
+#==================================================
+
+def emulator_accuracy(cluster, emulator, Ncheck=5, outfile=None):
+    '''
+    Compare the emulator to the direct minot computation, halfway between
+    the index grid nodes where the interpolation error is the largest,
+    and compare the time needed for one model.
+
+    Parameters
+    ----------
+    - cluster (ClusterModel object): cluster modeling object
+    - emulator (dict): the emulator from build_emulator
+    - Ncheck (int): number of index values to check
+    - outfile (str): file where to write the report
+
+    Output
+    ------
+    - max_error (float): the maximum relative error
+    '''
+
+    index_mid = 0.5*(emulator['index'][1:] + emulator['index'][:-1])
+    index_check = index_mid[np.unique(np.linspace(0, len(index_mid)-1, Ncheck).astype(int))]
+
+    report = ['Spectral emulator accuracy ('+str(len(emulator['index']))+' index values in ['
+              +str(emulator['index'][0])+', '+str(emulator['index'][-1])+'])']
+    max_error = 0.0
+    t_direct = 0.0
+    for index in index_check:
+        t0 = time.time()
+        direct = model_dNdEdSdt(cluster, emulator['energy'], [1.0, index])
+        t_direct += time.time() - t0
+        emul = emulator_model(emulator, [1.0, index])
+        wpos = direct > 0
+        error = np.amax(np.abs(emul[wpos]/direct[wpos] - 1)) if np.sum(wpos) > 0 else 0.0
+        max_error = max(max_error, error)
+        report.append('   index = '+'{:.4f}'.format(index)+': max relative error = '+'{:.2e}'.format(error))
+
+    t0 = time.time()
+    for i in range(100):
+        emulator_model(emulator, [1.0, index_check[0]])
+    t_emul = (time.time() - t0)/100
+    report.append('   max relative error = '+'{:.2e}'.format(max_error))
+    report.append('   time per model: minot = '+'{:.2e}'.format(t_direct/len(index_check))+' s, emulator = '
+                  +'{:.2e}'.format(t_emul)+' s')
+
+    for line in report:
+        print(line)
+    if outfile is not None:
+        with open(outfile, 'w') as f:
+            f.write('\n'.join(report)+'\n')
+
+    return max_error
+
+
 #==================================================
 # MCMC: run the fit
 #==================================================
@@ -496,8 +739,14 @@ def run_constraint(cluster_test,
                    GaussLike=False,
                    reset_mcmc=False,
                    run_mcmc=True,
+                   adaptive=False,
+                   ntau=50.0,
+                   check_every=100,
+                   vectorize=False,
+                   nproc=1,
                    Emin=50,
-                   Emax=10e3):
+                   Emax=10e3,
+                   emulator_npt=61):
     """
     Run the MCMC constraints to the spectrum
         
@@ -513,7 +762,15 @@ def run_constraint(cluster_test,
     - GaussLike (bool): use gaussian approximation of the likelihood
     - reset_mcmc (bool): reset the existing MCMC chains?
     - run_mcmc (bool): run the MCMC sampling?                            
+    - adaptive (bool): run the MCMC by chunks until the chains are longer than ntau
+    autocorrelation times (nsteps is then the maximum), and set the burnin and
+    thinning from the autocorrelation time
+    - ntau (float): required chain length in unit of autocorrelation time
+    - check_every (int): number of steps between two convergence checks
+    - vectorize (bool): evaluate the likelihood for all walkers at once
+    - nproc (int): number of processes used to evaluate the likelihood
     - Emin/Emax (flaot, GeV): Energy min and max for flux/luminosity computation
+    - emulator_npt (int): number of CRp index values tabulated by the spectral emulator
 
     Output
     ------
@@ -532,22 +789,29 @@ def run_constraint(cluster_test,
     par_max = [np.inf, 5.0]
 
     #========== Names
-    sampler_file   = cluster_test.output_dir+'/Ana_MCMC_spectrum_sampler.pkl'
+    chains_file    = cluster_test.output_dir+'/Ana_MCMC_spectrum_chains.h5'
     chainstat_file = cluster_test.output_dir+'/Ana_MCMC_spectrum_chainstat.txt'
+    autocorr_file  = cluster_test.output_dir+'/Ana_MCMC_spectrum_autocorr.txt'
     chainplot_file = cluster_test.output_dir+'/Ana_MCMC_spectrum'
     global_file    = cluster_test.output_dir+'/Ana_MCMC_spectrum_globalprop.txt'
+    emulator_file  = cluster_test.output_dir+'/Ana_MCMC_spectrum_emulator.npz'
+    emureport_file = cluster_test.output_dir+'/Ana_MCMC_spectrum_emulator.txt'
 
     
     #========== Start running MCMC definition and sampling
-    #---------- Check if a MCMC sampler was already recorded
-    sampler_exist = os.path.exists(sampler_file)
-    if sampler_exist:
-        sampler = mcmc_common.load_object(sampler_file)
-        print('    Existing sampler: '+sampler_file)
-        
     #---------- Read the data
     data = read_data(spectrum_file)
     
+    #---------- Spectral emulator, at the data and Monte Carlo energies
+    MC_eng   = np.logspace(-1, 5, 50) # GeV
+    Ndat     = len(data['e_ref'])
+    emulator = build_emulator(cluster_test, np.append(data['e_ref'], MC_eng), par_min[1], par_max[1],
+                              index_npt=emulator_npt, cache_file=emulator_file, report_file=emureport_file)
+    emulator_dat = {'energy':emulator['energy'][:Ndat], 'index':emulator['index'],
+                    'lnmodel':emulator['lnmodel'][:,:Ndat]}
+    emulator_mc  = {'energy':emulator['energy'][Ndat:], 'index':emulator['index'],
+                    'lnmodel':emulator['lnmodel'][:,Ndat:]}
+    
     #---------- MCMC parameters
     ndim = len(par0)
     
@@ -558,36 +822,50 @@ def run_constraint(cluster_test,
     print('    burnin              = '+str(burnin))
     print('    conf                = '+str(conf))
     print('    reset mcmc          = '+str(reset_mcmc))
+    print('    adaptive            = '+str(adaptive))
     print('    Gaussian likelihood = '+str(GaussLike))
+    print('    vectorize           = '+str(vectorize))
+    print('    nproc               = '+str(nproc))
 
     #---------- Defines the start
-    if sampler_exist:
-        if reset_mcmc:
-            print('--- Reset MCMC even though sampler already exists')
-            pos = [par0 + 1e-2*np.random.randn(ndim) for i in range(nwalkers)]
-            sampler.reset()
-            sampler = emcee.EnsembleSampler(nwalkers, ndim, lnlike,
-                                            args=[cluster_test, data, par_min, par_max, GaussLike])
-        else:
-            print('--- Start from already existing sampler')
-            pos = sampler.chain[:,-1,:]
+    if vectorize:
+        lnfunc = lnlike_batch
     else:
-        print('--- No pre-existing sampler, start from scratch')
+        lnfunc = lnlike
+    
+    config = {'data':mcmc_common.file_signature(spectrum_file), 'emulator':emulator_dat,
+              'par_min':par_min, 'par_max':par_max, 'GaussLike':GaussLike}
+    backend, resume = mcmc_common.chains_backend(chains_file, nwalkers, ndim, reset=reset_mcmc,
+                                                 config=config)
+    sampler = emcee.EnsembleSampler(nwalkers, ndim, lnfunc,
+                                    args=[emulator_dat, data, par_min, par_max, GaussLike],
+                                    vectorize=vectorize, backend=backend)
+    if resume:
+        print('--- Continue the chains recorded in '+chains_file+' ('+str(backend.iteration)+' steps)')
+        pos = backend.get_last_sample()
+    else:
+        print('--- No chains to continue, start from scratch')
         pos = [par0 + 1e-2*np.random.randn(ndim) for i in range(nwalkers)]
-        sampler = emcee.EnsembleSampler(nwalkers, ndim, lnlike,
-                                        args=[cluster_test, data, par_min, par_max, GaussLike])
         
     #---------- Run the MCMC
+    tau_history = None
     if run_mcmc:
-        print('--- Runing '+str(nsteps)+' MCMC steps')
-        sampler.run_mcmc(pos, nsteps, progress=True)
-
-    #---------- Save the MCMC after the run
-    mcmc_common.save_object(sampler, sampler_file)
+        if adaptive:
+            print('--- Runing up to '+str(nsteps)+' MCMC steps, until convergence')
+            tau_history = mcmc_common.run_ensemble_adaptive(sampler, pos, nsteps, nproc=nproc,
+                                                            check_every=check_every, ntau=ntau)
+        else:
+            print('--- Runing '+str(nsteps)+' MCMC steps')
+            mcmc_common.run_ensemble(sampler, pos, nsteps, nproc=nproc)
 
     #---------- Burnin
-    param_chains = sampler.chain[:, burnin:, :]
-    lnL_chains = sampler.lnprobability[:, burnin:]
+    thin = 1
+    if adaptive:
+        burnin, thin = mcmc_common.autocorr_diagnostics(sampler, ntau=ntau, tau_history=tau_history,
+                                                        parname=parname, outfile=autocorr_file)
+        print('--- Burnin and thinning from the autocorrelation time: '+str(burnin)+', '+str(thin))
+    param_chains = sampler.chain[:, burnin::thin, :]
+    lnL_chains = sampler.lnprobability[:, burnin::thin]
 
     #---------- Get the parameter statistics
     par_best, par_percentile = mcmc_common.chains_statistics(param_chains, lnL_chains,
@@ -595,8 +873,7 @@ def run_constraint(cluster_test,
                                                              outfile=chainstat_file)
     
     #---------- Get the well-sampled models
-    MC_eng     = np.logspace(-1, 5, 50) # GeV
-    MC_model   = get_mc_model(MC_eng, param_chains, cluster_test, Nmc=Nmc)
+    MC_model   = get_mc_model(emulator_mc, param_chains, Nmc=Nmc)
     Best_model = model_dNdEdSdt(cluster_test, MC_eng, par_best)
 
     #---------- Plots and results
@@ -0,0 +1,266 @@
+"""
+This file contains a small stage executor used to run the analysis
+pipeline as a dependency graph. Each stage records a fingerprint of
+its inputs, so that only the stages whose inputs changed are executed
+again, and independent stages can run concurrently.
+
+"""
+
+#==================================================
+# Requested imports
+#==================================================
+
+import os
+import json
+import time
+import hashlib
+import multiprocessing
+from xml.etree import ElementTree
+
+from kesacco.Tools import utilities
+
+
+#==================================================
+# Stage definition
+#==================================================
+
+def make_stage(name, function, depends=[], inputs=[], params=None, outputs=[]):
+    """
+    Define a pipeline stage.
+
+    Parameters
+    ----------
+    - name (str): the name of the stage
+    - function (callable): function without argument running the stage
+    - depends (str list): name of the stages that should run before
+    - inputs (str list): files read by the stage (not produced by other stages)
+    - params: any object defining the stage configuration
+    - outputs (str list): files produced by the stage. A stage without
+    declared outputs is never considered up to date.
+
+    Outputs
+    --------
+    - stage (dict): the stage definition
+    """
+
+    stage = {'name':name,
+             'function':function,
+             'depends':list(depends),
+             'inputs':list(inputs),
+             'params':params,
+             'outputs':list(outputs)}
+
+    return stage
+
+
+#==================================================
+# Fingerprint of a stage
+#==================================================
+
+def stage_fingerprint(stage, upstream):
+    """
+    Compute the fingerprint of a stage, as a hash of its parameters,
+    of its input files (path, size, modification time) and of the
+    fingerprints of the stages it depends on.
+
+    Parameters
+    ----------
+    - stage (dict): the stage definition
+    - upstream (dict): fingerprints of the stages it depends on
+
+    Outputs
+    --------
+    - fingerprint (str): the hash
+    """
+
+    md5 = hashlib.md5()
+    utilities.hash_update(md5, stage['params'], set())
+
+    for filename in stage['inputs']:
+        if os.path.isfile(filename):
+            info = os.stat(filename)
+            md5.update((filename+' '+str(info.st_size)+' '+str(info.st_mtime_ns)).encode())
+        else:
+            md5.update((filename+' missing').encode())
+
+    for name in sorted(upstream.keys()):
+        md5.update((name+' '+upstream[name]).encode())
+
+    return md5.hexdigest()
+
+
+#==================================================
+# Event files of an observation definition file
+#==================================================
+
+def obsdef_event_files(xmlfile):
+    """
+    List the event files of an observation definition xml file (the
+    EventList parameters), so that they can be declared as stage inputs
+    together with the xml file. Relative paths are taken with respect
+    to the directory of the xml file, as in GammaLib.
+
+    Parameters
+    ----------
+    - xmlfile (str): the observation definition xml file
+
+    Outputs
+    --------
+    - files (str list): the event files, empty if the xml file does not exist
+    """
+
+    if not os.path.isfile(xmlfile):
+        return []
+
+    files = []
+    for par in ElementTree.parse(xmlfile).getroot().iter('parameter'):
+        if par.get('name') == 'EventList' and par.get('file') is not None:
+            filename = par.get('file')
+            if not os.path.isabs(filename):
+                filename = os.path.join(os.path.dirname(xmlfile), filename)
+            files.append(filename)
+
+    return files
+
+
+#==================================================
+# Run the stages
+#==================================================
+
+def run_stages(stages, record_file, nproc=1, reset=False, silent=False):
+    """
+    Run a list of stages according to their dependencies. A stage is
+    skipped when its fingerprint did not change since the last successful
+    run and all its outputs exist. The stages which do not declare any
+    output are always executed. The stages that depend on a stage that
+    was executed are executed again as well, since the outputs it reads
+    changed.
+
+    Parameters
+    ----------
+    - stages (dict list): the stages, as defined by make_stage
+    - record_file (str): json file where the fingerprints are recorded.
+    If None, nothing is recorded and all the stages are executed.
+    - nproc (int): maximum number of stages running at the same time.
+    The stages run in forked processes when nproc > 1, so they should
+    communicate via files only.
+    - reset (bool): run all the stages, whatever the records
+    - silent (bool): print information or not
+
+    Outputs
+    --------
+    - executed (str list): the name of the stages that were executed
+    """
+
+    #----- Check the graph
+    names = [stage['name'] for stage in stages]
+    if len(set(names)) != len(names):
+        raise ValueError('The stage names should be unique.')
+    for stage in stages:
+        for dep in stage['depends']:
+            if dep not in names:
+                raise ValueError('The stage '+stage['name']+' depends on '+dep+', which is not defined.')
+
+    #----- Read the previous records
+    records = {}
+    if record_file is not None and os.path.isfile(record_file) and not reset:
+        with open(record_file, 'r') as f:
+            records = json.load(f)
+
+    #----- Loop until all the stages are done
+    fingerprints = {}
+    executed = []
+    running = {}
+    todo = list(names)
+    stage_dict = {stage['name']:stage for stage in stages}
+    ctx = multiprocessing.get_context('fork')
+
+    while len(todo) > 0 or len(running) > 0:
+        #----- Launch (or skip) the stages that are ready
+        ntodo = len(todo)
+        for name in list(todo):
+            stage = stage_dict[name]
+            if not all([dep in fingerprints for dep in stage['depends']]):
+                continue
+            if nproc > 1 and len(running) >= nproc:
+                break
+
+            upstream = {dep:fingerprints[dep] for dep in stage['depends']}
+            fingerprint = stage_fingerprint(stage, upstream)
+            todo.remove(name)
+
+            outputs_ok = len(stage['outputs']) > 0 and all([os.path.isfile(f) for f in stage['outputs']])
+            upstream_run = any([dep in executed for dep in stage['depends']])
+            if records.get(name) == fingerprint and outputs_ok and not upstream_run:
+                if not silent:
+                    print('----- Stage '+name+': inputs unchanged, skipped')
+                fingerprints[name] = fingerprint
+                continue
+
+            if not silent:
+                print('----- Stage '+name+': running')
+            _write_records(record_file, records, name, None) # invalid until it succeeds
+            if nproc > 1:
+                proc = ctx.Process(target=stage['function'])
+                proc.start()
+                running[name] = (proc, fingerprint)
+            else:
+                stage['function']()
+                fingerprints[name] = fingerprint
+                executed.append(name)
+                _write_records(record_file, records, name, fingerprint)
+
+        if len(running) == 0 and len(todo) == ntodo and ntodo > 0:
+            raise ValueError('The stage dependencies contain a cycle: '+str(todo))
+
+        #----- Collect the finished stages
+        if len(running) > 0:
+            time.sleep(0.1)
+        for name in list(running.keys()):
+            proc, fingerprint = running[name]
+            if proc.is_alive():
+                continue
+            proc.join()
+            del running[name]
+            if proc.exitcode != 0:
+                for other in running.keys():
+                    running[other][0].join()
+                raise RuntimeError('The stage '+name+' failed (exit code '+str(proc.exitcode)+').')
+            fingerprints[name] = fingerprint
+            executed.append(name)
+            _write_records(record_file, records, name, fingerprint)
+
+    return executed
+
+
+#==================================================
+# Write the records
+#==================================================
+
+def _write_records(record_file, records, name, fingerprint):
+    """
+    Update the record of a stage and write the records atomically.
+
+    Parameters
+    ----------
+    - record_file (str): json file where the fingerprints are recorded
+    - records (dict): the fingerprints of all stages
+    - name (str): the stage to update
+    - fingerprint (str): the new fingerprint, None to remove the record
+
+    Outputs
+    --------
+    The record file is written
+    """
+
+    if record_file is None:
+        return
+    
+    if fingerprint is None:
+        records.pop(name, None)
+    else:
+        records[name] = fingerprint
+    tmpfile = record_file+'.tmp'+str(os.getpid())
+    with open(tmpfile, 'w') as f:
+        json.dump(records, f, indent=1, sort_keys=True)
+    os.replace(tmpfile, record_file)
@@ -0,0 +1,161 @@
+"""
+This file contains a radial profiler, which precomputes the radial bin
+of each pixel for a given map header and center, so that the profiles
+of many maps (e.g. Monte Carlo models) sharing the same grid are obtained
+with a single np.bincount pass. It reproduces the binning and statistics
+of minot.ClusterTools.map_tools.radial_profile_cts.
+
+"""
+
+#==================================================
+# Requested imports
+#==================================================
+
+import numpy as np
+from astropy.wcs import WCS
+
+
+#==================================================
+# Radial profiler
+#==================================================
+
+class RadialProfiler(object):
+    """
+    Radial profiler for a fixed map grid and center.
+
+    Attributes
+    ----------
+    - shape (tuple): the map shape (Ny, Nx)
+    - nbin (int): the number of radial bins
+    - r_ctr (1D array): the center of the radial bins (deg)
+    - bin_index (1D array): the radial bin of each flattened pixel, -1 if none
+    - pixarea (float): the pixel area (deg2)
+
+    Methods
+    ----------
+    - profile(image, stddev=None, stat='GAUSSIAN', counts2brightness=False, residual=True):
+    compute the profile of one map (Ny, Nx) or of a stack of maps (N, Ny, Nx)
+    """
+
+    def __init__(self, header, center, binsize):
+        """
+        Precompute the radial bins.
+
+        Parameters
+        ----------
+        - header (fits header): header that contains the astrometry
+        - center (tupple): R.A. and Dec. of the center in degrees
+        - binsize (float): the radial bin size in degrees
+        """
+
+        w = WCS(header).celestial
+        self.shape = (header['NAXIS2'], header['NAXIS1'])
+
+        #----- Distance to the center
+        coord_x, coord_y = np.meshgrid(np.arange(self.shape[1]), np.arange(self.shape[0]), indexing='xy')
+        ra_map, dec_map = w.wcs_pix2world(coord_x, coord_y, 0)
+        arg2 = (np.sin((center[1]-dec_map)*np.pi/180.0/2.0))**2
+        arg3 = np.cos(dec_map*np.pi/180.0) * np.cos(center[1]*np.pi/180.0)
+        arg4 = (np.sin((center[0]-ra_map)*np.pi/180.0/2.0))**2
+        dist_map = 180.0/np.pi*2 * np.arcsin(np.sqrt(arg2 + arg3 * arg4))
+        dist_max = np.max(dist_map)
+
+        #----- Binning, as in radial_profile_cts
+        self.nbin = int(np.ceil(dist_max/binsize))
+        r_in  = np.linspace(0, dist_max, self.nbin+1)
+        r_out = r_in + (np.roll(r_in, -1) - r_in)
+        r_in  = r_in[0:-1]
+        r_out = r_out[0:-1]
+        self.r_ctr = (r_in + r_out)/2.0
+
+        dist = dist_map.ravel()
+        idx = np.searchsorted(r_in, dist, side='right') - 1
+        idx = np.clip(idx, 0, self.nbin-1)
+        self.bin_index = np.where((dist >= r_in[idx]) * (dist < r_out[idx]), idx, -1)
+
+        self.pixarea = np.abs(w.wcs.cdelt[0]) * np.abs(w.wcs.cdelt[1])
+
+
+    def _bin_sum(self, values, valid):
+        """
+        Sum the valid pixels of each map in each radial bin.
+
+        Parameters
+        ----------
+        - values (2D array): the flattened maps (N, Npix)
+        - valid (2D array): the pixels to account for (N, Npix)
+
+        Outputs
+        --------
+        - sums (2D array): the sum in each bin (N, Nbin)
+        """
+
+        nmap = values.shape[0]
+        use = valid * (self.bin_index >= 0)[np.newaxis,:]
+        index = (self.bin_index[np.newaxis,:] + self.nbin*np.arange(nmap)[:,np.newaxis])[use]
+        sums = np.bincount(index, weights=values[use], minlength=nmap*self.nbin)
+
+        return sums.reshape(nmap, self.nbin)
+
+
+    def profile(self, image, stddev=None, stat='GAUSSIAN', counts2brightness=False, residual=True):
+        """
+        Compute the radial profile of maps in units proportional to counts,
+        as radial_profile_cts.
+
+        Parameters
+        ----------
+        - image (2D or 3D array): the map (Ny, Nx) or a stack of maps (N, Ny, Nx)
+        - stddev (2D or 3D array): the standard deviation map, common to all the maps
+        if 2D. In case of Poisson statistics, stddev = sqrt(expected counts)
+        - stat (string): 'GAUSSIAN' or 'POISSON'
+        - counts2brightness (bool): normalize by the solid angle
+        - residual (bool): is the map a residual map? If yes, the data will be taken as
+        residual+model in poisson counts
+
+        Outputs
+        --------
+        - r_ctr (1D array): the center of the radial bins
+        - p (1D or 2D array): the profile, (Nbin) or (N, Nbin)
+        - err (1D or 2D array): the uncertainty
+        """
+
+        single = image.ndim == 2
+        img = np.reshape(image, (-1, self.shape[0]*self.shape[1])).astype(np.float64)
+        if stddev is None:
+            std = np.ones_like(img)
+        else:
+            std = np.broadcast_to(np.reshape(stddev, (-1, self.shape[0]*self.shape[1])), img.shape)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            valid = (std > 0) * (np.isnan(std) == False) * (np.isnan(img) == False)
+            npix = self._bin_sum(np.ones_like(img), valid)
+
+            if stat == 'GAUSSIAN':
+                sum_w  = self._bin_sum(1.0/std**2, valid)
+                sum_iw = self._bin_sum(img/std**2, valid)
+                val     = np.where(npix > 0, npix*sum_iw/sum_w, np.nan)
+                val_err = np.where(npix > 0, npix/np.sqrt(sum_w), np.nan)
+            elif stat == 'POISSON':
+                cts     = self._bin_sum(img, valid)
+                cts_exp = self._bin_sum(std**2, valid)
+                if residual:
+                    cts_dat = cts + cts_exp
+                else:
+                    cts_dat = cts + 0.0
+                log_ratio = np.log(cts_dat/cts_exp)
+                log_ratio[np.abs(log_ratio) == np.inf] = 0
+                sig     = np.sign(cts_dat-cts_exp)*np.sqrt(2*(cts_dat*log_ratio+cts_exp-cts_dat))
+                val     = np.where(npix > 0, cts, 0.0)
+                val_err = np.where(npix > 0, cts/sig, 0.0)
+            else:
+                raise ValueError('The statistics should be GAUSSIAN or POISSON.')
+
+            if counts2brightness:
+                val     = np.where(npix > 0, val/(npix*self.pixarea), np.nan)
+                val_err = np.where(npix > 0, val_err/(npix*self.pixarea), np.nan)
+
+        if single:
+            return self.r_ctr, val[0], val_err[0]
+        else:
+            return self.r_ctr, val, val_err
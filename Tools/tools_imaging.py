@@ -12,6 +12,7 @@ import cscripts
 import numpy as np
 import astropy.units as u
 from astropy.io import fits
+from astropy.wcs import WCS
 from minot.ClusterTools import map_tools
 from kesacco.Tools import tools_onoff
 
@@ -343,6 +344,70 @@ def resmap(inobs, inmodel, output_map,
     return rmap
 
 
+#==================================================
+# Residual maps, native
+#==================================================
+
+def residual_maps(cntcube, modcube, outmaps=None,
+                  algos=('SIGNIFICANCE', 'SUB', 'SUBDIV', 'SUBDIVSQRT')):
+    """
+    Compute the residual maps from a counts cube and a model cube
+    in NumPy, summing over the energy bins as csresmap does. All the
+    algorithms are computed from the same cubes, read once.
+    
+    Parameters
+    ----------
+    - cntcube (string): the counts cube (e.g. Ana_Countscube.fits)
+    - modcube (string): the model cube (e.g. Ana_Model_Cube.fits)
+    - outmaps (dict): output fits file for each algorithm, if any (None for no file)
+    - algos (str list): the algorithms, among SIGNIFICANCE, SUB, SUBDIV
+    and SUBDIVSQRT
+
+    Outputs
+    --------
+    - create the residual map fits files
+    - residuals (dict): the residual map for each algorithm
+    - model (2d array): the model counts map
+    - header (fits header): the map header
+    """
+
+    hdul = fits.open(cntcube)
+    counts = np.sum(hdul[0].data, axis=0).astype(np.float64)
+    header = fits.PrimaryHDU(data=counts, header=WCS(hdul[0].header).celestial.to_header()).header
+    hdul.close()
+    model = np.sum(fits.getdata(modcube, 0), axis=0).astype(np.float64)
+    if model.shape != counts.shape:
+        raise ValueError('The counts and model cubes do not have the same shape.')
+
+    if outmaps is None:
+        outmaps = {}
+
+    wpos = model > 0
+    safe = np.where(wpos, model, 1.0)
+    
+    residuals = {}
+    for algo in algos:
+        if algo == 'SUB':
+            res = counts - model
+        elif algo == 'SUBDIV':
+            res = np.where(wpos, (counts - model) / safe, 0.0)
+        elif algo == 'SUBDIVSQRT':
+            res = np.where(wpos, (counts - model) / np.sqrt(safe), 0.0)
+        elif algo == 'SIGNIFICANCE':
+            logterm = counts * np.log(np.where(counts > 0, counts, 1.0) / safe)
+            dev = np.where(counts > 0, logterm + model - counts, model)
+            dev = np.where(wpos, dev, 0.0)
+            res = np.sign(counts - model) * np.sqrt(2.0*np.clip(dev, 0, None))
+        else:
+            raise ValueError('The residual algorithm '+algo+' is not available.')
+        residuals[algo] = res
+        
+        if algo in outmaps:
+            fits.PrimaryHDU(data=res, header=header).writeto(outmaps[algo], overwrite=True)
+
+    return residuals, model, header
+
+
 #==================================================
 # Build exclusion map for OFF region
 #==================================================
@@ -6,9 +6,15 @@ utilities in various modules
 #==================================================
 # Requested imports
 #==================================================
+import types
+import hashlib
 from astropy.units.quantity import Quantity as Qtype
 from astropy.coordinates.sky_coordinate import SkyCoord
 from astropy.coordinates import cartesian_to_spherical
+from astropy.coordinates import BaseCoordinateFrame, ICRS
+from astropy.cosmology import Cosmology
+from astropy.io import fits
+from astropy.time import Time
 import astropy.units as u
 from scipy.optimize import minimize
 import numpy as np
@@ -179,4 +185,87 @@ def squeeze_fov(center_fov, fov_ini, center_cluster, theta_cluster, extra=1.1):
     return fov
 
 
+#==================================================
+# Hash the content of an object
+#==================================================
+
+def hash_update(md5, obj, visited):
+    """
+    Update a hash with the content of an object, recursively
+    in the case of containers and objects. Only canonical values are
+    hashed (e.g. coordinates as ICRS R.A. and Dec. in degrees, quantities
+    as value and unit, headers as text), never a representation which may
+    contain memory addresses, so that the hash of a given content is the
+    same in any process and can be used as a key across runs.
+    
+    Parameters
+    ----------
+    - md5 (hashlib object): the hash to be updated
+    - obj: the object to hash
+    - visited (set): id of the containers already hashed, to avoid cycles
+
+    Outputs
+    --------
+    The hash is updated in place. A TypeError is raised for the objects
+    which cannot be hashed reproducibly (e.g. functions).
+    """
 
+    if isinstance(obj, (SkyCoord, BaseCoordinateFrame)):
+        if isinstance(obj, SkyCoord):
+            icrs = obj.icrs
+        else:
+            icrs = obj.transform_to(ICRS())
+        md5.update(b'<SkyCoord>')
+        hash_update(md5, np.asarray(icrs.ra.to_value('deg'), dtype=np.float64), visited)
+        hash_update(md5, np.asarray(icrs.dec.to_value('deg'), dtype=np.float64), visited)
+    elif isinstance(obj, fits.Header):
+        md5.update(b'<Header>')
+        md5.update(obj.tostring().encode())
+    elif isinstance(obj, u.Quantity):
+        md5.update(('<Quantity '+obj.unit.to_string()+'>').encode())
+        hash_update(md5, np.asarray(obj.value), visited)
+    elif isinstance(obj, u.UnitBase):
+        md5.update(('<Unit '+obj.to_string()+'>').encode())
+    elif isinstance(obj, Time):
+        md5.update(('<Time '+obj.scale+'>').encode())
+        hash_update(md5, np.asarray(obj.jd1, dtype=np.float64), visited)
+        hash_update(md5, np.asarray(obj.jd2, dtype=np.float64), visited)
+    elif isinstance(obj, Cosmology):
+        mapping = obj.to_format('mapping')
+        md5.update(('<Cosmology '+type(obj).__name__+'>').encode())
+        hash_update(md5, {key:mapping[key] for key in mapping.keys() if key != 'cosmology'}, visited)
+    elif isinstance(obj, np.ndarray):
+        md5.update((str(obj.dtype)+str(obj.shape)).encode())
+        if obj.dtype.hasobject:
+            for item in obj.ravel():
+                hash_update(md5, item, visited)
+        else:
+            md5.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, (str, bytes, bool, int, float, complex, np.number, np.bool_, type(None))):
+        md5.update(repr(obj).encode())
+    elif id(obj) in visited:
+        md5.update(b'<cycle>')
+    elif isinstance(obj, dict):
+        visited.add(id(obj))
+        for key in sorted(obj.keys(), key=str):
+            md5.update(repr(key).encode())
+            hash_update(md5, obj[key], visited)
+    elif isinstance(obj, (list, tuple)):
+        visited.add(id(obj))
+        md5.update(('<'+type(obj).__name__+' '+str(len(obj))+'>').encode())
+        for item in obj:
+            hash_update(md5, item, visited)
+    elif isinstance(obj, (set, frozenset)):
+        keys = []
+        for item in obj:
+            md5_item = hashlib.md5()
+            hash_update(md5_item, item, set(visited))
+            keys.append(md5_item.hexdigest())
+        md5.update(('<set '+' '.join(sorted(keys))+'>').encode())
+    elif isinstance(obj, (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType,
+                          types.MethodType)) or not hasattr(obj, '__dict__'):
+        raise TypeError('Objects of type '+type(obj).__name__+' cannot be hashed reproducibly.')
+    else:
+        visited.add(id(obj))
+        md5.update(('<'+type(obj).__name__+'>').encode())
+        hash_update(md5, vars(obj), visited)
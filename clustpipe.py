@@ -87,6 +87,10 @@ class ClusterPipe(Common, CTAsim, CTAana):
         # The working output directory
         self.output_dir    = output_dir
         cluster.output_dir = output_dir
+        # Directory where the cluster templates are cached (None: no cache)
+        self.template_cache_dir  = None
+        # Maximum size of the template cache, in bytes
+        self.template_cache_size = 2e9
         
         #========== Sky model
         # The cluster object as a minot object
@@ -151,4 +155,17 @@ class ClusterPipe(Common, CTAsim, CTAana):
         self.mcmc_conf     = 68.0
         # Number of points for Monte Carlo resampling
         self.mcmc_Nmc      = 100
+        # Evaluate the likelihood for all walkers at once (emcee vectorize)
+        self.mcmc_vectorize = False
+        # Number of processes used for the MCMC sampling (shared memory model grids)
+        self.mcmc_nproc = 1
+        # Run the MCMC until the chains are longer than mcmc_ntau autocorrelation times
+        # (mcmc_nsteps is then the maximum), burnin and thinning being set accordingly
+        self.mcmc_adaptive = False
+        # Required chain length in unit of autocorrelation time (adaptive mode)
+        self.mcmc_ntau = 50.0
+        # Number of MCMC steps between two convergence checks (adaptive mode)
+        self.mcmc_check_every = 100
+        # Number of processes used to compute the MCMC model grids (ctools runs)
+        self.mcmc_grid_nproc = 1
         
@@ -33,10 +33,10 @@ from kesacco.Tools import mcmc_spectrum
 from kesacco.Tools import mcmc_profile
 from kesacco.Tools import mcmc_spectralimaging1
 from kesacco.Tools import mcmc_spectralimaging2
+from kesacco.Tools import pipeline_stages
+from kesacco.Tools import radial_profile
 from kesacco       import clustpipe_ana_plot
 
-from minot.ClusterTools.map_tools import radial_profile_cts
-
 
 #==================================================
 # Cluster class
@@ -87,7 +87,9 @@ class CTAana(object):
                      do_spec=True,
                      do_timing=False,
                      do_expected_output=True,
-                     do_plot=True):
+                     do_plot=True,
+                     nproc=1,
+                     reset=True):
         """
         Run the standard cluster analysis. This pipeline runs the main
         sub-modules one by one and provides the results in the end. Some
@@ -104,6 +106,11 @@ class CTAana(object):
         - do_expected_output (bool): compute the expected outputs 
         according to the known input simulation
         - do_plot (bool): make the plots
+        - nproc (int): maximum number of independent sub-modules running
+        at the same time (e.g. imaging and spectral analysis)
+        - reset (bool): run all the sub-modules. If False, the sub-modules
+        whose inputs did not change since the last run (as recorded in
+        Ana_Stages.json) are skipped.
         
         """
 
@@ -116,38 +123,83 @@ class CTAana(object):
             self._match_cluster_to_pointing()      # Cluster template defined according to pointings
             self._match_anamap_to_pointing()       # Analysis map defined usingaccording to pointings
         
+        #----- Configuration common to all the sub-modules
+        config = {'obsID':obsID, 'cluster':self.cluster, 'compact_source':self.compact_source,
+                  'obs_setup':self.obs_setup}
+        for key in vars(self).keys():
+            if key.startswith(('method_', 'map_', 'spec_', 'time_')):
+                config[key] = vars(self)[key]
+        odir = self.output_dir
+        
         #----- Data preparation (mandatory)
-        dataprep = self.run_ana_dataprep(obsID=obsID)
+        stages = [pipeline_stages.make_stage('dataprep',
+                                             lambda: self.run_ana_dataprep(obsID=obsID, nproc=nproc),
+                                             inputs=([odir+'/Events.xml']+
+                                                     pipeline_stages.obsdef_event_files(odir+'/Events.xml')),
+                                             params=config,
+                                             outputs=[odir+'/Ana_EventsSelected.xml'])]
         
         #----- Likelihood fit
         if do_like:
-            like = self.run_ana_likelihood()
+            stages.append(pipeline_stages.make_stage('likelihood',
+                                                     self.run_ana_likelihood,
+                                                     depends=['dataprep'],
+                                                     outputs=[odir+'/Ana_Model_Output.xml']))
+        ana_dep = ['likelihood'] if do_like else ['dataprep']
         
         #----- Upper limit
         if do_upperlimit:
-            UpLim = self.run_ana_upperlimit()
+            stages.append(pipeline_stages.make_stage('upperlimit',
+                                                     self.run_ana_upperlimit,
+                                                     depends=['dataprep'],
+                                                     outputs=[odir+'/Ana_Cluster_UpLim_log.txt']))
         
         #----- Imaging analysis
         if do_img:
-            self.run_ana_imaging()
+            stages.append(pipeline_stages.make_stage('imaging',
+                                                     self.run_ana_imaging,
+                                                     depends=ana_dep,
+                                                     outputs=[odir+'/Ana_SkymapTot.fits',
+                                                              odir+'/Ana_ResmapTot_SIGNIFICANCE.fits',
+                                                              odir+'/Ana_ResmapCluster_SIGNIFICANCE.fits',
+                                                              odir+'/Ana_ResmapCluster_profile.fits']))
         
         #----- Spectral analysis
         if do_spec:
-            self.run_ana_spectral()
+            stages.append(pipeline_stages.make_stage('spectral',
+                                                     self.run_ana_spectral,
+                                                     depends=ana_dep,
+                                                     outputs=[odir+'/Ana_Spectrum_'+self.cluster.name+'.fits']))
 
         #----- Timing analysis
         if do_timing:
-            self.run_ana_timing()
+            stages.append(pipeline_stages.make_stage('timing',
+                                                     self.run_ana_timing,
+                                                     depends=ana_dep,
+                                                     outputs=[odir+'/Ana_Lightcurve_'+self.cluster.name+'.fits']))
 
         #----- Expected output computation
         if do_expected_output:
-            self.run_ana_expected_output()
+            stages.append(pipeline_stages.make_stage('expected_output',
+                                                     self.run_ana_expected_output,
+                                                     depends=['dataprep'],
+                                                     inputs=[odir+'/Sim_Model_Map.fits',
+                                                             odir+'/Sim_Model_Spectrum.txt'],
+                                                     outputs=[odir+'/Ana_Expected_Cluster_Counts.fits']))
         
         #----- Output plots
         if do_plot:
-            self.run_ana_plot(obsID=obsID,
-                              smoothing_FWHM=0.1*u.deg,
-                              profile_log=True)
+            stages.append(pipeline_stages.make_stage('plot',
+                                                     lambda: self.run_ana_plot(obsID=obsID,
+                                                                               smoothing_FWHM=0.1*u.deg,
+                                                                               profile_log=True),
+                                                     depends=[stage['name'] for stage in stages]))
+        
+        #----- Run the stages
+        if not os.path.exists(odir):
+            os.mkdir(odir)
+        pipeline_stages.run_stages(stages, odir+'/Ana_Stages.json',
+                                   nproc=nproc, reset=reset, silent=self.silent)
         
         
     #==================================================
@@ -158,7 +210,9 @@ class CTAana(object):
                          obsID=None,
                          frac_src_on_reg=0.8,
                          exclu_rad=0.2*u.deg,
-                         use_model_bkg=False):
+                         use_model_bkg=False,
+                         nproc=1,
+                         inmemory=False):
         """
         This function is used to prepare the data to the 
         analysis.
@@ -172,6 +226,12 @@ class CTAana(object):
         - exclu_rad (quantity): exclusion radius for sources in the field of 
         view in onoff analysis
         - use_model_bkg (bool): do we use background model in on off analysis
+        - nproc (int): number of processes used to compute the data cubes.
+        If larger than 1, the counts (stacked and unstacked), exposure, psf,
+        background and edisp cubes are computed concurrently, each with its own
+        log file (the unstacked counts cube log is Ana_Countscube_Unstack_log.txt)
+        - inmemory (bool): pass the selected events in memory to the binning
+        tools, instead of reading them back from Ana_EventsSelected*.fits
 
         Outputs files
         -------------
@@ -193,7 +253,8 @@ class CTAana(object):
         Outputs
         -------
         - tuple containing: model_tot, ctscube_stack, ctscube_unstack, expcube, 
-        psfcube, bkgcube, and edcube, depending on the requested analysis
+        psfcube, bkgcube, and edcube, depending on the requested analysis.
+        The cube tools are replaced by None when computed in parallel.
 
         """
 
@@ -277,6 +338,12 @@ class CTAana(object):
         if not self.silent:
             print(sel)
             print('')
+
+        # Selected events kept in memory for the binning tools
+        if inmemory:
+            obs_sel = sel.obs()
+        else:
+            obs_sel = None
         
         #----- Model
         map_template_fov = np.amin(self.cluster.map_fov.to_value('deg'))
@@ -290,46 +357,62 @@ class CTAana(object):
         outs.append(model_tot)
         
         #----- Binning (needed even if unbinned likelihood)
-        for stacklist in [True, False]: # 1 single fits for stacked, else xml +N fits
-            ctscube = cubemaking.counts_cube(self.output_dir,
-                                             self.map_reso, self.map_coord, self.map_fov,
-                                             self.spec_emin, self.spec_emax,
-                                             self.spec_enumbins, self.spec_ebinalg,
-                                             stack=stacklist,
-                                             logfile=self.output_dir+'/Ana_Countscube_log.txt',
-                                             silent=self.silent)
-            outs.append(ctscube)
+        if nproc == 1:
+            for stacklist in [True, False]: # 1 single fits for stacked, else xml +N fits
+                ctscube = cubemaking.counts_cube(self.output_dir,
+                                                 self.map_reso, self.map_coord, self.map_fov,
+                                                 self.spec_emin, self.spec_emax,
+                                                 self.spec_enumbins, self.spec_ebinalg,
+                                                 stack=stacklist,
+                                                 inobs=obs_sel,
+                                                 logfile=self.output_dir+'/Ana_Countscube_log.txt',
+                                                 silent=self.silent)
+                outs.append(ctscube)
             
-        expcube = cubemaking.exp_cube(self.output_dir,
-                                      self.map_reso, self.map_coord, self.map_fov,
-                                      self.spec_emin, self.spec_emax,
-                                      self.spec_enumbins, self.spec_ebinalg,
-                                      logfile=self.output_dir+'/Ana_Expcube_log.txt',
-                                      silent=self.silent)
-        outs.append(expcube)
-        
-        psfcube = cubemaking.psf_cube(self.output_dir,
-                                      self.map_reso, self.map_coord, self.map_fov,
-                                      self.spec_emin, self.spec_emax,
-                                      self.spec_enumbins, self.spec_ebinalg,
-                                      logfile=self.output_dir+'/Ana_Psfcube_log.txt',
-                                      silent=self.silent)
-        outs.append(psfcube)
-        
-        bkgcube = cubemaking.bkg_cube(self.output_dir,
-                                      logfile=self.output_dir+'/Ana_Bkgcube_log.txt',
-                                      silent=self.silent)
-        outs.append(bkgcube)
-        
-        if self.spec_edisp:
-            edcube = cubemaking.edisp_cube(self.output_dir,
-                                           self.map_coord, self.map_fov,
-                                           self.spec_emin, self.spec_emax,
-                                           self.spec_enumbins, self.spec_ebinalg,
-                                           logfile=self.output_dir+'/Ana_Edispcube_log.txt',
-                                           silent=self.silent)
-            outs.append(edcube)
+            expcube = cubemaking.exp_cube(self.output_dir,
+                                          self.map_reso, self.map_coord, self.map_fov,
+                                          self.spec_emin, self.spec_emax,
+                                          self.spec_enumbins, self.spec_ebinalg,
+                                          inobs=obs_sel,
+                                          logfile=self.output_dir+'/Ana_Expcube_log.txt',
+                                          silent=self.silent)
+            outs.append(expcube)
+        
+            psfcube = cubemaking.psf_cube(self.output_dir,
+                                          self.map_reso, self.map_coord, self.map_fov,
+                                          self.spec_emin, self.spec_emax,
+                                          self.spec_enumbins, self.spec_ebinalg,
+                                          inobs=obs_sel,
+                                          logfile=self.output_dir+'/Ana_Psfcube_log.txt',
+                                          silent=self.silent)
+            outs.append(psfcube)
+        
+            bkgcube = cubemaking.bkg_cube(self.output_dir,
+                                          inobs=obs_sel,
+                                          logfile=self.output_dir+'/Ana_Bkgcube_log.txt',
+                                          silent=self.silent)
+            outs.append(bkgcube)
+        
+            if self.spec_edisp:
+                edcube = cubemaking.edisp_cube(self.output_dir,
+                                               self.map_coord, self.map_fov,
+                                               self.spec_emin, self.spec_emax,
+                                               self.spec_enumbins, self.spec_ebinalg,
+                                               inobs=obs_sel,
+                                               logfile=self.output_dir+'/Ana_Edispcube_log.txt',
+                                               silent=self.silent)
+                outs.append(edcube)
         
+        else:
+            outs = outs + cubemaking.make_cubes_parallel(self.output_dir,
+                                                         self.map_reso, self.map_coord, self.map_fov,
+                                                         self.spec_emin, self.spec_emax,
+                                                         self.spec_enumbins, self.spec_ebinalg,
+                                                         edisp=self.spec_edisp,
+                                                         nproc=nproc,
+                                                         inobs=obs_sel,
+                                                         silent=self.silent)
+            
         #----- ON/OFF files
         if self.method_ana == 'ONOFF':
             # Get the radius to have frac_src_on_reg * flux tot in the on region
@@ -827,7 +910,8 @@ class CTAana(object):
                         do_SourceDet=False,
                         do_Res=True,
                         do_TS=False,
-                        profile_reso=0.05*u.deg):
+                        profile_reso=0.05*u.deg,
+                        res_native=True):
         """
         Run the imaging analysis
         
@@ -839,6 +923,8 @@ class CTAana(object):
         - do_Res (bool): compute residual
         - do_TS (bool): compute TS map
         - profile_reso (quantity): bin size for profile
+        - res_native (bool): compute the residual maps in NumPy from the counts 
+        and best fit model cubes, instead of running csresmap for each algorithm
                 
         Outputs files
         -------------
@@ -911,82 +997,101 @@ class CTAana(object):
                 print('               Other sources unaccounted for in the model may bias the residual.')
 
             #----- Total residual and keeping the cluster
-            for alg in ['SIGNIFICANCE', 'SUB', 'SUBDIV', 'SUBDIVSQRT']:
-                resmap = tools_imaging.resmap(self.output_dir+'/Ana_Countscube.fits',
-                                              self.output_dir+'/Ana_Model_Output.xml',
-                                              self.output_dir+'/Ana_ResmapTot_'+alg+'.fits',
-                                              npix, self.map_reso.to_value('deg'),
-                                              self.map_coord.icrs.ra.to_value('deg'),
-                                              self.map_coord.icrs.dec.to_value('deg'),
-                                              emin=self.spec_emin.to_value('TeV'),
-                                              emax=self.spec_emax.to_value('TeV'),
-                                              enumbins=self.spec_enumbins, ebinalg=self.spec_ebinalg,
-                                              modcube=modcube,
-                                              expcube=expcube, psfcube=psfcube,
-                                              bkgcube=bkgcube, edispcube=edispcube,
-                                              caldb=None, irf=None,
-                                              edisp=self.spec_edisp,
-                                              algo=alg,
-                                              logfile=self.output_dir+'/Ana_ResmapTot_'+alg+'_log.txt',
-                                              silent=self.silent)
+            cntcube = self.output_dir+'/Ana_Countscube.fits'
+            if res_native and not (os.path.isfile(cntcube) and os.path.isfile(modcube)
+                                   and os.path.isfile(modcubeCl)):
+                print('WARNING: the counts or model cubes are not available, the residual')
+                print('         maps are computed with csresmap.')
+                res_native = False
                 
-                resmap_cl = tools_imaging.resmap(self.output_dir+'/Ana_Countscube.fits',
-                                                 self.output_dir+'/Ana_Model_Output_Cluster.xml',
-                                                 self.output_dir+'/Ana_ResmapCluster_'+alg+'.fits',
-                                                 npix, self.map_reso.to_value('deg'),
-                                                 self.map_coord.icrs.ra.to_value('deg'),
-                                                 self.map_coord.icrs.dec.to_value('deg'),
-                                                 emin=self.spec_emin.to_value('TeV'),
-                                                 emax=self.spec_emax.to_value('TeV'),
-                                                 enumbins=self.spec_enumbins, ebinalg=self.spec_ebinalg,
-                                                 modcube=modcubeCl,
-                                                 expcube=expcube, psfcube=psfcube,
-                                                 bkgcube=bkgcube, edispcube=edispcube,
-                                                 caldb=None, irf=None,
-                                                 edisp=self.spec_edisp,
-                                                 algo=alg,
-                                                 logfile=self.output_dir+'/Ana_ResmapCluster_'+alg+'_log.txt',
-                                                 silent=self.silent)
+            if res_native:
+                algos = ['SIGNIFICANCE', 'SUB', 'SUBDIV', 'SUBDIVSQRT']
+                res_all, model, header = tools_imaging.residual_maps(cntcube, modcube,
+                                                                     {alg:self.output_dir+'/Ana_ResmapTot_'+alg+'.fits'
+                                                                      for alg in algos})
+                res_cl, clmodel, header = tools_imaging.residual_maps(cntcube, modcubeCl,
+                                                                      {alg:self.output_dir+'/Ana_ResmapCluster_'+alg+'.fits'
+                                                                       for alg in algos})
+                res_counts = res_cl['SUB']
+                
+            else:
+                for alg in ['SIGNIFICANCE', 'SUB', 'SUBDIV', 'SUBDIVSQRT']:
+                    resmap = tools_imaging.resmap(self.output_dir+'/Ana_Countscube.fits',
+                                                  self.output_dir+'/Ana_Model_Output.xml',
+                                                  self.output_dir+'/Ana_ResmapTot_'+alg+'.fits',
+                                                  npix, self.map_reso.to_value('deg'),
+                                                  self.map_coord.icrs.ra.to_value('deg'),
+                                                  self.map_coord.icrs.dec.to_value('deg'),
+                                                  emin=self.spec_emin.to_value('TeV'),
+                                                  emax=self.spec_emax.to_value('TeV'),
+                                                  enumbins=self.spec_enumbins, ebinalg=self.spec_ebinalg,
+                                                  modcube=modcube,
+                                                  expcube=expcube, psfcube=psfcube,
+                                                  bkgcube=bkgcube, edispcube=edispcube,
+                                                  caldb=None, irf=None,
+                                                  edisp=self.spec_edisp,
+                                                  algo=alg,
+                                                  logfile=self.output_dir+'/Ana_ResmapTot_'+alg+'_log.txt',
+                                                  silent=self.silent)
+                
+                    resmap_cl = tools_imaging.resmap(self.output_dir+'/Ana_Countscube.fits',
+                                                     self.output_dir+'/Ana_Model_Output_Cluster.xml',
+                                                     self.output_dir+'/Ana_ResmapCluster_'+alg+'.fits',
+                                                     npix, self.map_reso.to_value('deg'),
+                                                     self.map_coord.icrs.ra.to_value('deg'),
+                                                     self.map_coord.icrs.dec.to_value('deg'),
+                                                     emin=self.spec_emin.to_value('TeV'),
+                                                     emax=self.spec_emax.to_value('TeV'),
+                                                     enumbins=self.spec_enumbins, ebinalg=self.spec_ebinalg,
+                                                     modcube=modcubeCl,
+                                                     expcube=expcube, psfcube=psfcube,
+                                                     bkgcube=bkgcube, edispcube=edispcube,
+                                                     caldb=None, irf=None,
+                                                     edisp=self.spec_edisp,
+                                                     algo=alg,
+                                                     logfile=self.output_dir+'/Ana_ResmapCluster_'+alg+'_log.txt',
+                                                     silent=self.silent)
             
+
+                #----- Read back the maps
+                hdul       = fits.open(self.output_dir+'/Ana_ResmapCluster_SUB.fits')
+                res_counts = hdul[0].data
+                header     = hdul[0].header
+                hdul.close()
+                hdul       = fits.open(self.output_dir+'/Ana_ResmapTot_SUB.fits')
+                res_all    = hdul[0].data
+                header     = hdul[0].header
+                hdul.close()
+                hdul       = fits.open(self.output_dir+'/Ana_ResmapTot_SUBDIV.fits')
+                subdiv_all = hdul[0].data
+                header     = hdul[0].header
+                hdul.close()
+                model = res_all/subdiv_all
+                hdul       = fits.open(self.output_dir+'/Ana_ResmapCluster_SUB.fits')
+                res_clall    = hdul[0].data
+                header     = hdul[0].header
+                hdul.close()
+                hdul       = fits.open(self.output_dir+'/Ana_ResmapCluster_SUBDIV.fits')
+                subdiv_clall = hdul[0].data
+                header     = hdul[0].header
+                hdul.close()
+                clmodel = res_clall/subdiv_clall
+
             #----- Cluster profile
-            hdul       = fits.open(self.output_dir+'/Ana_ResmapCluster_SUB.fits')
-            res_counts = hdul[0].data
-            header     = hdul[0].header
-            hdul.close()
-            hdul       = fits.open(self.output_dir+'/Ana_ResmapTot_SUB.fits')
-            res_all    = hdul[0].data
-            header     = hdul[0].header
-            hdul.close()
-            hdul       = fits.open(self.output_dir+'/Ana_ResmapTot_SUBDIV.fits')
-            subdiv_all = hdul[0].data
-            header     = hdul[0].header
-            hdul.close()
-            model = res_all/subdiv_all
-            hdul       = fits.open(self.output_dir+'/Ana_ResmapCluster_SUB.fits')
-            res_clall    = hdul[0].data
-            header     = hdul[0].header
-            hdul.close()
-            hdul       = fits.open(self.output_dir+'/Ana_ResmapCluster_SUBDIV.fits')
-            subdiv_clall = hdul[0].data
-            header     = hdul[0].header
-            hdul.close()
-            clmodel = res_clall/subdiv_clall
+            profiler = radial_profile.RadialProfiler(header,
+                                                     [self.cluster.coord.icrs.ra.to_value('deg'),
+                                                      self.cluster.coord.icrs.dec.to_value('deg')],
+                                                     profile_reso.to_value('deg'))
 
             # Residual counts
-            radius, prof, err = radial_profile_cts(res_counts,
-                                                   [self.cluster.coord.icrs.ra.to_value('deg'),
-                                                    self.cluster.coord.icrs.dec.to_value('deg')],
-                                                   stddev=np.sqrt(model), header=header,
-                                                   binsize=profile_reso.to_value('deg'), stat='POISSON',
-                                                   counts2brightness=True)
+            radius, prof, err = profiler.profile(res_counts,
+                                                 stddev=np.sqrt(model),
+                                                 stat='POISSON', counts2brightness=True)
 
             # Background counts
-            radius, bkgprof, bkgerr = radial_profile_cts(clmodel,
-                                                         [self.cluster.coord.icrs.ra.to_value('deg'),
-                                                          self.cluster.coord.icrs.dec.to_value('deg')],
-                                                         stddev=np.sqrt(clmodel), header=header,
-                                                         binsize=profile_reso.to_value('deg'), stat='POISSON',
-                                                         counts2brightness=True)
+            radius, bkgprof, bkgerr = profiler.profile(clmodel,
+                                                       stddev=np.sqrt(clmodel),
+                                                       stat='POISSON', counts2brightness=True)
 
             
             tab  = Table()
@@ -1335,13 +1440,13 @@ class CTAana(object):
             header.remove('NAXIS3')
             header['NAXIS'] = 2
             
-            r_mod, p_mod, err_mod = radial_profile_cts(model_cnt_map,
-                                                       [self.cluster.coord.icrs.ra.to_value('deg'),
-                                                        self.cluster.coord.icrs.dec.to_value('deg')],
-                                                       stddev=np.sqrt(model_cnt_map), header=header,
-                                                       binsize=profile_reso.to_value('deg'),
-                                                       stat='POISSON',
-                                                       counts2brightness=True)
+            profiler = radial_profile.RadialProfiler(header,
+                                                     [self.cluster.coord.icrs.ra.to_value('deg'),
+                                                      self.cluster.coord.icrs.dec.to_value('deg')],
+                                                     profile_reso.to_value('deg'))
+            r_mod, p_mod, err_mod = profiler.profile(model_cnt_map,
+                                                     stddev=np.sqrt(model_cnt_map),
+                                                     stat='POISSON', counts2brightness=True)
             tab  = Table()
             tab['radius']  = Column(r_mod, unit='deg',
                                     description='Cluster offset (bin='+str(profile_reso.to_value('deg'))+'deg')
@@ -1402,6 +1507,11 @@ class CTAana(object):
                                          GaussLike=GaussLike,
                                          reset_mcmc=reset_mcmc,
                                          run_mcmc=run_mcmc,
+                                         adaptive=self.mcmc_adaptive,
+                                         ntau=self.mcmc_ntau,
+                                         check_every=self.mcmc_check_every,
+                                         vectorize=self.mcmc_vectorize,
+                                         nproc=self.mcmc_nproc,
                                          Emin=self.spec_emin.to_value('GeV'),
                                          Emax=self.spec_emax.to_value('GeV'))
         else:
@@ -1483,11 +1593,21 @@ class CTAana(object):
         spatial_idx   = np.linspace(0, spatial_npt-1, spatial_npt, dtype=np.int)
 
         #----- Check that parameters are fine
+        # An interrupted grid computation is resumed
+        resume_modelgrid = (reset_modelgrid is False and
+                            not os.path.exists(subdir+'/Grid_Parameters.npy') and
+                            os.path.exists(subdir+'/Grid_Parameters_Pending.npy'))
+        if resume_modelgrid:
+            print('--- reset_modelgrid is False and the previous grid is incomplete: it is resumed')
+            parfile = subdir+'/Grid_Parameters_Pending.npy'
+        else:
+            parfile = subdir+'/Grid_Parameters.npy'
+        
         if reset_modelgrid is False:
-            if not os.path.exists(subdir+'/Grid_Parameters.npy'):
+            if not os.path.exists(parfile):
                 raise ValueError('reset_modelgrid is False, but no previous run was found.')
             
-            listpar = np.load(subdir+'/Grid_Parameters.npy', allow_pickle=True)
+            listpar = np.load(parfile, allow_pickle=True)
             cluster_previous = listpar[0]
             spatial_value_previous = listpar[1]
             
@@ -1499,14 +1619,16 @@ class CTAana(object):
                 raise ValueError('reset_modelgrid=False, but the spatial_scaling_value has changed since last run')
         
         #----- Run the grid making
-        if reset_modelgrid:
+        if reset_modelgrid or resume_modelgrid:
             mcmc_profile.build_model_grid(self,
                                           subdir,
                                           rad, prof_ini,
                                           spatial_value, spatial_idx,
                                           profile_reso,
                                           includeIC=includeIC,
-                                          rm_tmp=rm_tmp)
+                                          rm_tmp=rm_tmp,
+                                          nproc=self.mcmc_grid_nproc,
+                                          resume=resume_modelgrid)
                     
         #===== Run the MCMC
         cluster_test  = copy.deepcopy(self.cluster)
@@ -1521,7 +1643,12 @@ class CTAana(object):
                                             Nmc=self.mcmc_Nmc,
                                             GaussLike=GaussLike,
                                             reset_mcmc=reset_mcmc,
-                                            run_mcmc=run_mcmc)
+                                            run_mcmc=run_mcmc,
+                                            adaptive=self.mcmc_adaptive,
+                                            ntau=self.mcmc_ntau,
+                                            check_every=self.mcmc_check_every,
+                                            vectorize=self.mcmc_vectorize,
+                                            nproc=self.mcmc_nproc)
         
             
     #==================================================
@@ -1543,6 +1670,11 @@ class CTAana(object):
                                      ps_spectral_npt=11,
                                      ps_spectral_range=[-0.5,0.5],
                                      rm_tmp=False,
+                                     grid_float32=False,
+                                     grid_factorized=False,
+                                     grid_factorized_check=False,
+                                     grid_analytic_shift=False,
+                                     amplitudes='sample',
                                      FWHM=0.1*u.deg,
                                      theta=1.0*u.deg,
                                      coord=None,
@@ -1557,7 +1689,8 @@ class CTAana(object):
         
         Parameters
         ----------
-        - reset_modelgrid (bool): recompute the grid of models even if already exist
+        - reset_modelgrid (bool): recompute the grid of models even if already exist. If False
+        and the previous grid computation was interrupted, only the missing models are computed
         - reset_mcmc (bool): reset the existing MCMC chains?
         - run_mcmc (bool): run the MCMC sampling?
         - GaussLike (bool): use guassian likelihood or true L scan
@@ -1575,6 +1708,17 @@ class CTAana(object):
         - ps_spectral_range (list of min/max): min and max value to add to the point sources
         spectra, i.e. [default+min, default+max]
         - rm_tmp (bool): remove temporary templates?
+        - grid_float32 (bool): store the model grid in single precision, to 
+        reduce the disk and memory footprint
+        - grid_factorized (bool): compute the cluster cube once per spatial model and
+        reweight its energy bins for each spectral model (bkg_marginalize=False only)
+        - grid_factorized_check (bool): compare the factorized cluster grid to the full 
+        computation for a few models
+        - grid_analytic_shift (bool): compute the background and point source cubes once and
+        reweight their energy bins for each spectral index shift (bkg_marginalize=False only)
+        - amplitudes (str): 'sample' the cluster, background and point source amplitudes
+        with the MCMC, or 'profile' / 'marginalize' them at each step, so that only the shape
+        parameters are sampled (bkg_marginalize=False only)
         - FWHM (quantity): size of the FWHM to be used for smoothing (plot)
         - theta (quantity): containment angle for plots
         - coord (SkyCoord): source coordinates for extraction (plot)
@@ -1586,6 +1730,10 @@ class CTAana(object):
         
         """
         
+        #===== Options available only with the background in the grid model
+        if bkg_marginalize and amplitudes != 'sample':
+            raise ValueError("amplitudes='"+str(amplitudes)+"' requires bkg_marginalize=False.")
+
         #===== Information
         if not self.silent:
             print('')
@@ -1647,11 +1795,21 @@ class CTAana(object):
         ps_spectral_idx   = np.linspace(0, ps_spectral_npt-1, ps_spectral_npt, dtype=np.int)
 
         #===== Check that parameters are fine
+        # An interrupted grid computation is resumed
+        resume_modelgrid = (reset_modelgrid is False and
+                            not os.path.exists(subdir+'/Grid_Parameters.npy') and
+                            os.path.exists(subdir+'/Grid_Parameters_Pending.npy'))
+        if resume_modelgrid:
+            print('--- reset_modelgrid is False and the previous grid is incomplete: it is resumed')
+            parfile = subdir+'/Grid_Parameters_Pending.npy'
+        else:
+            parfile = subdir+'/Grid_Parameters.npy'
+        
         if reset_modelgrid is False:
-            if not os.path.exists(subdir+'/Grid_Parameters.npy'):
+            if not os.path.exists(parfile):
                 raise ValueError('reset_modelgrid is False, but no previous run was found.')
             
-            listpar = np.load(subdir+'/Grid_Parameters.npy', allow_pickle=True)
+            listpar = np.load(parfile, allow_pickle=True)
             cluster_previous = listpar[0]
             spatial_value_previous = listpar[1]
             spectral_value_previous = listpar[2]
@@ -1667,14 +1825,20 @@ class CTAana(object):
                 raise ValueError('reset_modelgrid=False, but the spectral_slope_value has changed since last run')
         
         #===== Build the model grid
-        if reset_modelgrid:
+        if reset_modelgrid or resume_modelgrid:
             if bkg_marginalize:
+                if grid_factorized:
+                    print('WARNING: with bkg_marginalize=True, each model is fitted to the data')
+                    print('         and the grid cannot be factorized. grid_factorized is ignored.')
                 mcmc_spectralimaging1.build_model_grid(self,
                                                        subdir,
                                                        rad, prof_ini,
                                                        spatial_value, spatial_idx,
                                                        spectral_value, spectral_idx,
-                                                       includeIC=includeIC, rm_tmp=rm_tmp)
+                                                       includeIC=includeIC, rm_tmp=rm_tmp,
+                                                       float32=grid_float32,
+                                                       nproc=self.mcmc_grid_nproc,
+                                                       resume=resume_modelgrid)
             else:
                 mcmc_spectralimaging2.build_model_grid(self,
                                                        subdir,
@@ -1683,7 +1847,13 @@ class CTAana(object):
                                                        spectral_value, spectral_idx,
                                                        bk_spectral_value, bk_spectral_idx,
                                                        ps_spectral_value, ps_spectral_idx,
-                                                       includeIC=includeIC, rm_tmp=rm_tmp)
+                                                       includeIC=includeIC, rm_tmp=rm_tmp,
+                                                       float32=grid_float32,
+                                                       factorized=grid_factorized,
+                                                       factorized_check=grid_factorized_check,
+                                                       analytic_shift=grid_analytic_shift,
+                                                       nproc=self.mcmc_grid_nproc,
+                                                       resume=resume_modelgrid)
         
         #===== MCMC fit with cluster parameters
         if bkg_marginalize:
@@ -1698,6 +1868,11 @@ class CTAana(object):
                                                  GaussLike=GaussLike,
                                                  reset_mcmc=reset_mcmc,
                                                  run_mcmc=run_mcmc,
+                                                 adaptive=self.mcmc_adaptive,
+                                                 ntau=self.mcmc_ntau,
+                                                 check_every=self.mcmc_check_every,
+                                                 vectorize=self.mcmc_vectorize,
+                                                 nproc=self.mcmc_nproc,
                                                  FWHM=FWHM,
                                                  theta=theta,
                                                  coord=coord,
@@ -1714,6 +1889,12 @@ class CTAana(object):
                                                  GaussLike=GaussLike,
                                                  reset_mcmc=reset_mcmc,
                                                  run_mcmc=run_mcmc,
+                                                 adaptive=self.mcmc_adaptive,
+                                                 ntau=self.mcmc_ntau,
+                                                 check_every=self.mcmc_check_every,
+                                                 vectorize=self.mcmc_vectorize,
+                                                 nproc=self.mcmc_nproc,
+                                                 amplitudes=amplitudes,
                                                  FWHM=FWHM,
                                                  theta=theta,
                                                  coord=coord,
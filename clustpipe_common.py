@@ -37,6 +37,7 @@ class Common():
     - _correct_eventfile_names(self, xmlfile, prefix='Events')
     - _write_new_xmlevent_from_obsid(self, xmlin, xmlout, obsID)
     - _rm_source_xml(self, xmlin, xmlout, source)
+    - _edit_models(self, models_in, xmlout=None, keep=None, drop=None)
     - _match_cluster_to_pointing(self, extra=1.1)
     - _match_anamap_to_pointing(self, extra=1.1)
     - _make_model(self, prefix='Model', includeIC=False)
@@ -250,6 +251,49 @@ class Common():
         xml.save(xmlout)
         
         
+    #==================================================
+    # Keep or drop sources from a model, in memory
+    #==================================================
+    
+    def _edit_models(self, models_in, xmlout=None, keep=None, drop=None):
+        """
+        Apply all the source selections to a model in one pass, 
+        and write the result once if requested. The returned GModels
+        can be handed directly to a ctool (e.g. cubemaking.model_cube)
+        without going through the disk.
+        
+        Parameters
+        ----------
+        - models_in (str or GModels): input xml file or model. A GModels
+        is edited in place.
+        - xmlout (str): output xml file, None for no output file
+        - keep (str list): name of the sources to keep, None to keep all
+        - drop (str list): name of the sources to remove
+
+        Outputs
+        -------
+        - models (GModels): the edited model
+        - The new xml file is writen if requested
+        """
+
+        if isinstance(models_in, str):
+            models = gammalib.GModels(models_in)
+        else:
+            models = models_in
+
+        keep = None if keep is None else set(keep)
+        drop = set() if drop is None else set(drop)
+        for i in range(len(models))[::-1]:
+            name = models[i].name()
+            if name in drop or (keep is not None and name not in keep):
+                models.remove(i)
+
+        if xmlout is not None:
+            models.save(xmlout)
+
+        return models
+        
+        
     #==================================================
     # Match the cluster map and FoV to the pointing def
     #==================================================
@@ -346,12 +390,16 @@ class Common():
                                        self.output_dir+'/'+prefix+'_Map.fits',
                                        Egmin=self.obs_setup.get_emin(),
                                        Egmax=self.obs_setup.get_emax(),
-                                       includeIC=includeIC)
+                                       includeIC=includeIC,
+                                       cache_dir=self.template_cache_dir,
+                                       cache_size=self.template_cache_size)
         
         make_cluster_template.make_spectrum(self.cluster,
                                             self.output_dir+'/'+prefix+'_Spectrum.txt',
                                             energy=np.logspace(-1,5,1000)*u.GeV,
-                                            includeIC=includeIC)
+                                            includeIC=includeIC,
+                                            cache_dir=self.template_cache_dir,
+                                            cache_size=self.template_cache_size)
         
         #----- Create the model
         model_tot = gammalib.GModels()
@@ -11,12 +11,17 @@ is available.
 #==================================================
 
 import os
+import copy
+import traceback
+import numpy as np
 import astropy.units as u
+from astropy.table import Table, Column
 from random import randint
 import gammalib
 import ctools
 
 from kesacco.Tools import plotting
+from kesacco.Tools import pipeline_stages
 
 
 #==================================================
@@ -32,6 +37,7 @@ class CTAsim(object):
     Methods
     ----------  
     - run_sim_obs(self, obsID=None): run the observations to generate event files
+    - run_sim_ensemble(self, n_realizations): simulate and analyse several realizations
     - run_sim_quicklook(self, obsID=None): perform quicklook analysis of event files and model
     
     """
@@ -40,7 +46,7 @@ class CTAsim(object):
     # Run observation simulation
     #==================================================
     
-    def run_sim_obs(self, obsID=None, seed=None):
+    def run_sim_obs(self, obsID=None, seed=None, split_obs=False, nproc=1):
         """
         Run all the observations at once
         
@@ -48,6 +54,232 @@ class CTAsim(object):
         ----------
         - obsID (str or str list): list of runs to be observed
         - seed (int): the seed used for simulations of observations
+        - split_obs (bool): simulate each observation independently, 
+        with a seed derived from the master seed and the obsID. The events 
+        only depend on the seed and obsID, not on nproc nor on the other 
+        observations simulated.
+        - nproc (int): number of observations simulated at the same time
+        when split_obs is True
+        """
+
+        #----- Sky model and observation definition
+        obsID = self._prepare_sim(obsID)
+
+        #----- Get the seed for reapeatable simu
+        if seed is None: seed = randint(1, 1e6)
+        
+        #----- Run the observation
+        if not split_obs:
+            obssim = self._run_ctobssim(self.output_dir+'/Sim_ObsDef.xml',
+                                        self.output_dir+'/Events.xml',
+                                        self.output_dir+'/TmpEvents',
+                                        seed,
+                                        self.output_dir+'/Events_log.txt')
+        
+            if not self.silent:
+                print('------- Simulation log -------')
+                print(obssim)
+                print('')
+        
+        #----- Or run each observation separately, with its own seed
+        else:
+            obsdef = gammalib.GXml(self.output_dir+'/Sim_ObsDef.xml').element('observation_list')
+            obsid_list = [obsdef[i].attribute('id') for i in range(len(obsdef))]
+
+            stages = []
+            for iobs in obsid_list:
+                seed_obs = np.random.SeedSequence(seed, spawn_key=tuple(iobs.encode()))
+                seed_obs = int(seed_obs.generate_state(1)[0] >> 1) # ctobssim seed is a signed int
+                self._write_new_xmlevent_from_obsid(self.output_dir+'/Sim_ObsDef.xml',
+                                                    self.output_dir+'/Sim_ObsDef_'+iobs+'.xml',
+                                                    [iobs])
+                stages.append(pipeline_stages.make_stage(iobs, self._make_sim_obs_function(iobs, seed_obs)))
+            pipeline_stages.run_stages(stages, None, nproc=nproc, silent=self.silent)
+
+            # Merge the observations in a single list, following Sim_ObsDef.xml order
+            xml     = gammalib.GXml(self.output_dir+'/Events_'+obsid_list[0]+'.xml')
+            obslist = xml.element('observation_list')
+            for iobs in obsid_list[1:]:
+                xml_obs = gammalib.GXml(self.output_dir+'/Events_'+iobs+'.xml')
+                obslist.append(xml_obs.element('observation_list').element('observation', 0))
+            xml.save(self.output_dir+'/Events.xml')
+            for iobs in obsid_list:
+                os.remove(self.output_dir+'/Events_'+iobs+'.xml')
+                os.remove(self.output_dir+'/Sim_ObsDef_'+iobs+'.xml')
+            
+        self._correct_eventfile_names(self.output_dir+'/Events.xml', prefix='Events')
+        
+        
+    #==================================================
+    # Run an ensemble of simulations and analyses
+    #==================================================
+    
+    def run_sim_ensemble(self, n_realizations,
+                         obsID=None,
+                         seed=None,
+                         ana_options=None,
+                         nproc=1):
+        """
+        Simulate several realizations of the observations and analyse
+        each of them, e.g. to study biases and coverage. The sky model
+        and observation definition are built once, in output_dir, and shared 
+        by all the realizations. Each realization is simulated and analysed
+        in output_dir/Ensemble/Realization_{i}. A realization which fails does
+        not stop the ensemble: its error is written in Realization_Error.txt
+        and recorded in the results.
+        
+        Parameters
+        ----------
+        - n_realizations (int): number of realizations
+        - obsID (str or str list): list of runs to be observed
+        - seed (int): the master seed. The seed of each realization is derived 
+        from it, so that the results do not depend on nproc.
+        - ana_options (dict): keyword arguments passed to run_analysis, to select
+        the analysis sub-modules run on each realization. By default, only the
+        likelihood fit is run.
+        - nproc (int): number of realizations run at the same time
+
+        Outputs
+        -------
+        - Ensemble_Results.fits: table with one row per realization, giving the 
+        seed, the status ('ok' or 'failed') and error message, and the fitted 
+        value and error of the free parameters
+        - results (Table): the same table
+        """
+        
+        if ana_options is None:
+            ana_options = {'do_like':True,
+                           'do_img':False,
+                           'do_spec':False,
+                           'do_expected_output':False,
+                           'do_plot':False}
+        
+        #----- Sky model and observation definition, built once
+        obsID = self._prepare_sim(obsID)
+        if seed is None: seed = randint(1, 1e6)
+        
+        #----- Realizations
+        ensdir = self.output_dir+'/Ensemble'
+        if not os.path.exists(ensdir): os.mkdir(ensdir)
+        
+        stages = []
+        rdir_list = []
+        seed_list = []
+        for ireal in range(n_realizations):
+            rdir = ensdir+'/Realization_'+str(ireal)
+            if not os.path.exists(rdir): os.mkdir(rdir)
+
+            # Share the sky model and observation files
+            for filename in os.listdir(self.output_dir):
+                if filename.startswith('Sim_') and os.path.isfile(self.output_dir+'/'+filename):
+                    if os.path.lexists(rdir+'/'+filename): os.remove(rdir+'/'+filename)
+                    os.symlink(os.path.abspath(self.output_dir+'/'+filename), rdir+'/'+filename)
+
+            seed_real = np.random.SeedSequence(seed, spawn_key=(ireal,))
+            seed_real = int(seed_real.generate_state(1)[0] >> 1) # ctobssim seed is a signed int
+            rdir_list.append(rdir)
+            seed_list.append(seed_real)
+            stages.append(pipeline_stages.make_stage('Realization_'+str(ireal),
+                                                     self._make_realization_function(rdir, seed_real,
+                                                                                     obsID, ana_options)))
+        pipeline_stages.run_stages(stages, None, nproc=nproc, silent=self.silent)
+        
+        #----- Collect the fitted parameters
+        rows = []
+        for ireal in range(n_realizations):
+            row = {'realization':ireal, 'seed':seed_list[ireal], 'status':'ok', 'error':''}
+            outmodel = rdir_list[ireal]+'/Ana_Model_Output.xml'
+            errfile  = rdir_list[ireal]+'/Realization_Error.txt'
+            if os.path.isfile(errfile):
+                with open(errfile) as f:
+                    lines = f.read().strip().splitlines()
+                row['status'] = 'failed'
+                row['error']  = lines[-1] if len(lines) > 0 else 'unknown error'
+            elif os.path.isfile(outmodel):
+                models = gammalib.GModels(outmodel)
+                for imod in range(len(models)):
+                    for ipar in range(models[imod].size()):
+                        par = models[imod][ipar]
+                        if par.is_free():
+                            key = models[imod].name()+'_'+par.name()
+                            row[key]          = par.value()
+                            row[key+'_error'] = par.error()
+            rows.append(row)
+
+        colnames = []
+        for row in rows:
+            for key in row.keys():
+                if key not in colnames: colnames.append(key)
+        results = Table()
+        for key in colnames:
+            results[key] = Column([row.get(key, np.nan) for row in rows])
+        results.write(self.output_dir+'/Ensemble_Results.fits', overwrite=True)
+        
+        return results
+        
+        
+    #==================================================
+    # Function running one realization of the ensemble
+    #==================================================
+    
+    def _make_realization_function(self, rdir, seed, obsID, ana_options):
+        """
+        Build the function that simulates and analyses one realization,
+        as a stage of the ensemble.
+        
+        Parameters
+        ----------
+        - rdir (str): the directory of the realization
+        - seed (int): the seed of the realization
+        - obsID (str list): list of runs to be observed
+        - ana_options (dict): keyword arguments passed to run_analysis
+
+        Outputs
+        -------
+        - function (callable): function without argument running the realization
+        """
+        
+        def function():
+            # Outputs of a previous run are not mistaken for this one
+            for filename in ['Realization_Error.txt', 'Ana_Model_Output.xml']:
+                if os.path.exists(rdir+'/'+filename): os.remove(rdir+'/'+filename)
+            
+            try:
+                real = copy.deepcopy(self)
+                real.output_dir = rdir
+                real.cluster.output_dir = rdir
+                real.silent = True
+                real._run_ctobssim(rdir+'/Sim_ObsDef.xml',
+                                   rdir+'/Events.xml',
+                                   rdir+'/TmpEvents',
+                                   seed,
+                                   rdir+'/Events_log.txt')
+                real._correct_eventfile_names(rdir+'/Events.xml', prefix='Events')
+                real.run_analysis(obsID=obsID, **ana_options)
+            except Exception:
+                with open(rdir+'/Realization_Error.txt', 'w') as f:
+                    f.write(traceback.format_exc())
+                print('WARNING: the realization in '+rdir+' failed, see Realization_Error.txt')
+            
+        return function
+    
+    
+    #==================================================
+    # Prepare the sky model and observation definition
+    #==================================================
+    
+    def _prepare_sim(self, obsID):
+        """
+        Build the sky model templates (Sim_Model_*) and the observation
+        definition files (Sim_Pnt.def, Sim_ObsDef.xml) used by ctobssim.
+        
+        Parameters
+        ----------
+        - obsID (str or str list): list of runs to be observed
+
+        Outputs
+        -------
+        - obsID (str list): the checked list of runs
         """
 
         #----- Create the output directory if needed
@@ -70,7 +302,7 @@ class CTAsim(object):
         self._match_cluster_to_pointing()
         
         #----- Make cluster templates
-        model_sim = self._make_model(prefix='Sim_Model', includeIC=False)
+        self._make_model(prefix='Sim_Model', includeIC=False)
         self.cluster.save_param()
         os.rename(self.cluster.output_dir+'/parameters.txt',
                   self.cluster.output_dir+'/Sim_Model_Cluster_param.txt')
@@ -81,18 +313,67 @@ class CTAsim(object):
         self.obs_setup.write_pnt(self.output_dir+'/Sim_Pnt.def', obsid=obsID)
         self.obs_setup.run_csobsdef(self.output_dir+'/Sim_Pnt.def', self.output_dir+'/Sim_ObsDef.xml')
 
-        #----- Get the seed for reapeatable simu
-        if seed is None: seed = randint(1, 1e6)
+        return obsID
+    
+    
+    #==================================================
+    # Function running the simulation of one observation
+    #==================================================
+    
+    def _make_sim_obs_function(self, iobs, seed):
+        """
+        Build the function that simulates a single observation, 
+        as a stage of the parallel simulation.
+        
+        Parameters
+        ----------
+        - iobs (str): the obsID
+        - seed (int): the seed of this observation
+
+        Outputs
+        -------
+        - function (callable): function without argument running ctobssim
+        """
+        
+        def function():
+            self._run_ctobssim(self.output_dir+'/Sim_ObsDef_'+iobs+'.xml',
+                               self.output_dir+'/Events_'+iobs+'.xml',
+                               self.output_dir+'/TmpEvents_'+iobs+'_',
+                               seed,
+                               self.output_dir+'/Events_'+iobs+'_log.txt')
+            
+        return function
+    
+    
+    #==================================================
+    # Run ctobssim
+    #==================================================
+    
+    def _run_ctobssim(self, inobs, outevents, prefix, seed, logfile):
+        """
+        Run ctobssim with the simulation model.
+        
+        Parameters
+        ----------
+        - inobs (str): the observation definition xml file
+        - outevents (str): the output event xml file
+        - prefix (str): the prefix of the event files
+        - seed (int): the seed used for simulations of observations
+        - logfile (str): the log file
+
+        Outputs
+        -------
+        - obssim (ctobssim): the ctool that was run
+        """
         
-        #----- Run the observation
         obssim = ctools.ctobssim()
-        obssim['inobs']      = self.output_dir+'/Sim_ObsDef.xml'
+        obssim['inobs']      = inobs
         obssim['inmodel']    = self.output_dir+'/Sim_Model_Unstack.xml'
         #obssim['caldb']     = --> read from ObsDef
         #obssim['irf']       = --> read from ObsDef
         obssim['edisp']      = self.spec_edisp
-        obssim['outevents']  = self.output_dir+'/Events.xml'
-        obssim['prefix']     = self.output_dir+'/TmpEvents'
+        obssim['outevents']  = outevents
+        obssim['prefix']     = prefix
         obssim['startindex'] = 1
         obssim['seed']       = seed
         #obssim['ra']        = --> read from ObsDef
@@ -105,20 +386,15 @@ class CTAsim(object):
         #obssim['emax']      = --> read from ObsDef
         #obssim['deadc']     = --> read from ObsDef
         obssim['maxrate']    = 1e6
-        obssim['logfile']    = self.output_dir+'/Events_log.txt'
+        obssim['logfile']    = logfile
         obssim['chatter']    = 2
         obssim.logFileOpen()
         obssim.execute()
         obssim.logFileClose()
-        
-        if not self.silent:
-            print('------- Simulation log -------')
-            print(obssim)
-            print('')
 
-        self._correct_eventfile_names(self.output_dir+'/Events.xml', prefix='Events')
-        
-        
+        return obssim
+    
+    
     #==================================================
     # Quicklook
     #==================================================
@@ -0,0 +1,33 @@
+"""
+Make the repository importable as the kesacco package, whatever the
+name of the directory in which it is cloned, so that the tests always
+run on this checkout.
+
+"""
+
+import os
+import sys
+import importlib.util
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_kesacco():
+    """
+    Register the repository as the kesacco package.
+
+    Outputs
+    --------
+    - module: the kesacco package
+    """
+
+    if 'kesacco' in sys.modules:
+        return sys.modules['kesacco']
+
+    spec = importlib.util.spec_from_file_location('kesacco', os.path.join(ROOT, '__init__.py'),
+                                                  submodule_search_locations=[ROOT])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['kesacco'] = module
+    spec.loader.exec_module(module)
+
+    return module
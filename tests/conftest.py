@@ -0,0 +1,8 @@
+"""
+Test configuration: the repository is imported as the kesacco package.
+
+"""
+
+from _bootstrap import load_kesacco
+
+load_kesacco()
@@ -0,0 +1,21 @@
+"""
+Tests of the options of the analysis pipeline.
+
+"""
+
+import os
+
+import pytest
+
+for module in ['gammalib', 'ctools', 'minot']:
+    pytest.importorskip(module)
+
+from kesacco.clustpipe import ClusterPipe
+
+
+@pytest.mark.parametrize('amplitudes', ['profile', 'marginalize'])
+def test_linear_amplitudes_require_the_background_in_the_grid(tmp_path, amplitudes):
+    cpipe = ClusterPipe(silent=True, output_dir=str(tmp_path))
+    with pytest.raises(ValueError):
+        cpipe.run_ana_mcmc_spectralimaging(bkg_marginalize=True, amplitudes=amplitudes)
+    assert not os.path.exists(str(tmp_path/'Ana_MCMC_SpecImg1'))
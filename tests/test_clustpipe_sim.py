@@ -0,0 +1,44 @@
+"""
+Tests of the ensemble of simulated realizations.
+
+"""
+
+import os
+
+import pytest
+
+for module in ['gammalib', 'ctools', 'minot']:
+    pytest.importorskip(module)
+
+from kesacco.clustpipe import ClusterPipe
+
+
+def test_failed_realizations_are_recorded(tmp_path, monkeypatch):
+    calls = []
+
+    def run_ctobssim(self, obsdef, eventfile, tmpdir, seed, logfile):
+        calls.append(os.path.basename(self.output_dir))
+
+    def run_analysis(self, obsID=None, **kwargs):
+        assert kwargs['do_like'] and not kwargs['do_img']
+        if self.output_dir.endswith('Realization_1'):
+            raise RuntimeError('likelihood fit failed')
+
+    monkeypatch.setattr(ClusterPipe, '_prepare_sim', lambda self, obsID: ['001'])
+    monkeypatch.setattr(ClusterPipe, '_run_ctobssim', run_ctobssim)
+    monkeypatch.setattr(ClusterPipe, '_correct_eventfile_names', lambda self, xml, prefix=None: None)
+    monkeypatch.setattr(ClusterPipe, 'run_analysis', run_analysis)
+
+    cpipe = ClusterPipe(silent=True, output_dir=str(tmp_path))
+    results = cpipe.run_sim_ensemble(3, seed=1)
+
+    assert calls == ['Realization_0', 'Realization_1', 'Realization_2']
+    assert list(results['status']) == ['ok', 'failed', 'ok']
+    assert 'likelihood fit failed' in results['error'][1]
+    assert os.path.isfile(str(tmp_path/'Ensemble/Realization_1/Realization_Error.txt'))
+    assert os.path.isfile(str(tmp_path/'Ensemble_Results.fits'))
+
+    # A successful rerun clears the previous error
+    monkeypatch.setattr(ClusterPipe, 'run_analysis', lambda self, obsID=None, **kwargs: None)
+    results = cpipe.run_sim_ensemble(3, seed=1)
+    assert list(results['status']) == ['ok', 'ok', 'ok']
@@ -0,0 +1,59 @@
+"""
+Tests of the NumPy event sampler of the cluster component.
+
+"""
+
+import numpy as np
+import pytest
+import astropy.units as u
+from astropy.io import fits
+from astropy.wcs import WCS
+from astropy.coordinates import SkyCoord
+
+from kesacco.Tools import event_sampler
+
+
+def _templates(tmp_path, ra0, dec0):
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [ra0, dec0]
+    wcs.wcs.crpix = [6.0, 6.0]
+    wcs.wcs.cdelt = [-1e-4, 1e-4]
+    image = np.zeros((11, 11))
+    image[5, 5] = 1.0
+    map_file = str(tmp_path/'Sim_Model_Map.fits')
+    fits.writeto(map_file, image, wcs.to_header())
+
+    energy = np.logspace(4, 8, 50) # MeV
+    spec_file = str(tmp_path/'Sim_Model_Spectrum.txt')
+    with open(spec_file, 'w') as f:
+        f.write('# energy (MeV)    spectrum (MeV-1 cm-2 s-1)\n')
+        for e in energy:
+            f.write(str(e)+' '+str(1e-15*(e/1e5)**-2)+'\n')
+
+    return map_file, spec_file
+
+
+@pytest.mark.parametrize('dec0', [0.0, 60.0, 88.0])
+def test_psf_offsets_are_isotropic(tmp_path, dec0):
+    ra0 = 150.0
+    map_file, spec_file = _templates(tmp_path, ra0, dec0)
+    sigma = 0.5*u.deg
+    aeff = (np.array([0.01, 1000.0])*u.TeV, np.array([1e9, 1e9])*u.cm**2)
+    outfile = str(tmp_path/'events.fits')
+
+    n_events = event_sampler.simulate_cluster_events(map_file, spec_file, outfile, 40*u.h, aeff, sigma,
+                                                     seed=1)
+    assert n_events > 20000
+
+    events = fits.getdata(outfile)
+    center = SkyCoord(ra0, dec0, unit='deg')
+    photons = SkyCoord(events['RA'].astype(float), events['DEC'].astype(float), unit='deg')
+    sep = center.separation(photons).to_value('deg')
+    offset = center.spherical_offsets_to(photons)
+    east, north = offset[0].to_value('deg'), offset[1].to_value('deg')
+
+    # Circular Gaussian of width sigma around the source
+    assert np.abs(np.mean(sep**2)/(2*sigma.to_value('deg')**2) - 1) < 0.015
+    assert np.abs(np.std(east)/np.std(north) - 1) < 0.02
+    assert np.abs(np.mean(east)) < 0.01 and np.abs(np.mean(north)) < 0.01
@@ -0,0 +1,77 @@
+"""
+Tests of the interpolation of the model grids along the parameter
+axes, against scipy interpn over the full grid.
+
+"""
+
+import numpy as np
+import pytest
+from scipy.interpolate import interpn
+
+for module in ['matplotlib', 'pandas', 'corner', 'gammalib', 'minot']:
+    pytest.importorskip(module)
+
+from kesacco.Tools import mcmc_common
+
+
+def _grid(shape, seed=2):
+    rng = np.random.default_rng(seed)
+    grid1 = np.sort(rng.uniform(0, 2, shape[0]))
+    grid2 = np.linspace(-1, 3, shape[1])
+    models = rng.uniform(0, 10, shape)
+    return grid1, grid2, models
+
+
+def _interpn_at_pixels(axes, models, values):
+    """Interpolate the full grid at the given parameters and at all the pixel nodes."""
+    pixels = [np.arange(n, dtype=float) for n in models.shape[len(axes):]]
+    mesh = np.meshgrid(*pixels, indexing='ij')
+    points = np.stack([np.full(mesh[0].shape, v) for v in values] + list(mesh), axis=-1)
+    return interpn(list(axes)+pixels, models, points)
+
+
+@pytest.mark.parametrize('value', [0.0, 0.37, 1.0, 2.0])
+def test_interp_grid1d_matches_interpn(value):
+    grid = np.linspace(0, 2, 5)
+    models = _grid((5, 4, 6))[2]
+    expected = _interpn_at_pixels([grid], models, [value])
+    assert np.allclose(mcmc_common.interp_grid1d(grid, models, value), expected, rtol=1e-12)
+
+
+@pytest.mark.parametrize('values', [(0.5, 0.1), (1.2, -1.0), (1.9, 3.0), (1.0, 1.7)])
+def test_interp_grid2d_matches_interpn(values):
+    grid1, grid2, models = _grid((6, 7, 3, 4, 5))
+    values = (np.clip(values[0], grid1[0], grid1[-1]), values[1])
+    expected = _interpn_at_pixels([grid1, grid2], models, values)
+    output = mcmc_common.interp_grid2d(grid1, grid2, models, *values)
+    assert np.allclose(output, expected, rtol=1e-12)
+
+
+def test_out_of_bounds_raises():
+    grid = np.linspace(0, 2, 5)
+    models = _grid((5, 4))[2]
+    for value in [-0.1, 2.1, np.nan]:
+        with pytest.raises(ValueError):
+            mcmc_common.interp_grid1d(grid, models, value)
+
+
+def test_batch_interpolation_matches_single_walker():
+    grid1, grid2, models = _grid((6, 7, 3, 4, 5))
+    rng = np.random.default_rng(3)
+    values1 = rng.uniform(grid1[0], grid1[-1], 10)
+    values2 = np.append(rng.uniform(grid2[0], grid2[-1], 8), [grid2[0], grid2[-1]])
+
+    batch = mcmc_common.interp_grid2d_batch(grid1, grid2, models, values1, values2)
+    for i in range(len(values1)):
+        single = mcmc_common.interp_grid2d(grid1, grid2, models, values1[i], values2[i])
+        assert np.allclose(batch[i], single, rtol=1e-12)
+
+    batch = mcmc_common.interp_grid1d_batch(grid2, models[0], values2)
+    for i in range(len(values2)):
+        assert np.allclose(batch[i], mcmc_common.interp_grid1d(grid2, models[0], values2[i]), rtol=1e-12)
+
+
+def test_batch_prior():
+    params = np.array([[0.5, 1.0], [-0.1, 1.0], [0.5, 3.0], [0.5, np.nan]])
+    prior = mcmc_common.lnprior_batch(params, [0, 0], [1, 2])
+    assert prior[0] == 0.0 and np.all(np.isinf(prior[1:]))
@@ -0,0 +1,114 @@
+"""
+Tests of the resumable computation of the model grid nodes.
+
+"""
+
+import os
+import socket
+import subprocess
+
+import pytest
+
+for module in ['matplotlib', 'pandas', 'corner', 'gammalib', 'minot']:
+    pytest.importorskip(module)
+
+from kesacco.Tools import mcmc_common
+
+
+def _make_nodes(calls, fail=None):
+    def run(tag):
+        def function(workdir):
+            if tag == fail:
+                raise RuntimeError('interrupted')
+            calls.append(tag)
+            with open(workdir+'/Model_'+tag+'.txt', 'w') as f:
+                f.write(tag)
+        return function
+
+    return [(tag, 'value='+str(i), run(tag)) for i, tag in enumerate(['TMP_0', 'TMP_1', 'TMP_2'])]
+
+
+def _write_lock(subdir, tag, pid):
+    os.makedirs(subdir+'/Grid_Lock', exist_ok=True)
+    with open(subdir+'/Grid_Lock/'+tag+'.lock', 'w') as f:
+        f.write(socket.gethostname()+' '+str(pid))
+
+
+def test_resume_computes_the_missing_nodes(tmp_path):
+    subdir = str(tmp_path)
+    config = {'includeIC':False, 'cluster':'abc'}
+
+    calls = []
+    with pytest.raises(RuntimeError):
+        mcmc_common.run_grid_nodes(_make_nodes(calls, fail='TMP_1'), subdir, config=config)
+    assert calls == ['TMP_0']
+
+    calls = []
+    mcmc_common.run_grid_nodes(_make_nodes(calls), subdir, resume=True, config=config)
+    assert calls == ['TMP_1', 'TMP_2']
+    for tag in ['TMP_0', 'TMP_1', 'TMP_2']:
+        assert os.path.isfile(subdir+'/Model_'+tag+'.txt')
+        assert os.path.isfile(subdir+'/Grid_Done/'+tag)
+
+    calls = []
+    mcmc_common.run_grid_nodes(_make_nodes(calls), subdir, resume=True, config=config)
+    assert calls == []
+
+
+def test_resume_refused_when_the_configuration_changed(tmp_path):
+    subdir = str(tmp_path)
+    with pytest.raises(RuntimeError):
+        mcmc_common.run_grid_nodes(_make_nodes([], fail='TMP_1'), subdir, config={'includeIC':False})
+
+    with pytest.raises(ValueError):
+        mcmc_common.run_grid_nodes(_make_nodes([]), subdir, resume=True, config={'includeIC':True})
+
+    # Without resuming, the grid is recomputed from scratch
+    calls = []
+    mcmc_common.run_grid_nodes(_make_nodes(calls), subdir, config={'includeIC':True})
+    assert calls == ['TMP_0', 'TMP_1', 'TMP_2']
+
+
+def test_reset_refused_while_a_node_is_locked(tmp_path):
+    subdir = str(tmp_path)
+    mcmc_common.run_grid_nodes(_make_nodes([]), subdir)
+
+    # A node claimed by a running process
+    _write_lock(subdir, 'TMP_1', os.getpid())
+    with pytest.raises(ValueError):
+        mcmc_common.run_grid_nodes(_make_nodes([]), subdir)
+    assert os.path.isfile(subdir+'/Grid_Done/TMP_0')
+
+    # A lock left by a dead process does not prevent the reset
+    proc = subprocess.Popen(['true'])
+    proc.wait()
+    _write_lock(subdir, 'TMP_1', proc.pid)
+    calls = []
+    mcmc_common.run_grid_nodes(_make_nodes(calls), subdir)
+    assert calls == ['TMP_0', 'TMP_1', 'TMP_2']
+
+
+def test_stale_lock_reclaimed_by_a_single_job(tmp_path, monkeypatch):
+    subdir = str(tmp_path)
+    proc = subprocess.Popen(['true'])
+    proc.wait()
+    _write_lock(subdir, 'TMP_1', proc.pid)
+    monkeypatch.setattr(mcmc_common, '_GRID_STATE', {'subdir':subdir, 'lock_timeout':None})
+
+    # The second job finds the lock stale and claims the node while the
+    # first job, which also found it stale, is about to reclaim it
+    claims = []
+    lock_is_stale = mcmc_common._lock_is_stale
+    def racing_lock_is_stale(lockfile, lock_timeout):
+        stale = lock_is_stale(lockfile, lock_timeout)
+        if len(claims) == 0:
+            claims.append(None)
+            claims.append(mcmc_common._claim_grid_node('TMP_1'))
+        return stale
+    monkeypatch.setattr(mcmc_common, '_lock_is_stale', racing_lock_is_stale)
+    claims[0] = mcmc_common._claim_grid_node('TMP_1')
+
+    assert claims == [False, True]
+    assert os.listdir(subdir+'/Grid_Lock') == ['TMP_1.lock']
+    with open(subdir+'/Grid_Lock/TMP_1.lock') as f:
+        assert f.read() == socket.gethostname()+' '+str(os.getpid())
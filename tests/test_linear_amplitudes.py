@@ -0,0 +1,103 @@
+"""
+Tests of the likelihood profiled over the linear amplitudes, against a
+brute force maximization on a grid of amplitudes.
+
+"""
+
+import numpy as np
+import pytest
+
+for module in ['matplotlib', 'pandas', 'corner', 'gammalib', 'minot']:
+    pytest.importorskip(module)
+
+from kesacco.Tools import mcmc_common
+
+
+def _problem(amp_true, npix=60, seed=1):
+    rng = np.random.default_rng(seed)
+    x = np.linspace(-3, 3, npix)
+    templates = np.array([10.0*np.exp(-0.5*x**2/0.5**2), 5.0 + 0.0*x, 8.0*np.exp(-0.5*(x-1)**2/0.3**2)])
+    templates = templates[0:len(amp_true)]
+    data = rng.poisson(np.dot(amp_true, templates)).astype(float)
+    return templates, data
+
+
+def _brute_force(templates, data, axes, gauss):
+    mesh = np.meshgrid(*axes, indexing='ij')
+    amp = np.stack([m.ravel() for m in mesh], axis=1)
+    lnL = np.zeros(len(amp))
+    for i in range(0, len(amp), 20000):
+        model = np.dot(amp[i:i+20000], templates)
+        lnl = mcmc_common._pixel_lnlike(data, model, gauss=gauss)[0]
+        lnL[i:i+20000] = np.sum(lnl, axis=1)
+    lnL[~np.isfinite(lnL)] = -np.inf
+    return lnL, amp
+
+
+@pytest.mark.parametrize('gauss', [False, True])
+@pytest.mark.parametrize('amp_true', [[1.3], [1.3, 0.7], [1.3, 0.0]])
+def test_profile_matches_brute_force(gauss, amp_true):
+    templates, data = _problem(amp_true)
+    npt = 20001 if len(amp_true) == 1 else 601
+    axes = [np.linspace(0, 3, npt) for i in amp_true]
+    step = axes[0][1] - axes[0][0]
+    lnL_grid, amp_grid = _brute_force(templates, data, axes, gauss)
+    ibest = np.argmax(lnL_grid)
+
+    lnL, amp = mcmc_common.profile_linear_amplitudes(templates[np.newaxis], data, gauss=gauss)
+
+    assert np.all(amp >= 0)
+    assert lnL[0] >= lnL_grid[ibest] - 1e-6
+    assert np.all(np.abs(amp[0] - amp_grid[ibest]) <= 2*step)
+
+
+def test_profile_of_a_batch_of_walkers():
+    templates, data = _problem([1.3, 0.7])
+    batch = np.array([templates, 2*templates, templates[::-1]])
+    lnL, amp = mcmc_common.profile_linear_amplitudes(batch, data)
+    for i in range(len(batch)):
+        lnL_i, amp_i = mcmc_common.profile_linear_amplitudes(batch[i:i+1], data)
+        assert np.allclose(lnL[i], lnL_i[0])
+        assert np.allclose(amp[i], amp_i[0], rtol=1e-5, atol=1e-8)
+
+
+def test_laplace_marginal_likelihood():
+    templates, data = _problem([1.3], npix=200)
+    axis = np.linspace(0.5, 2.5, 20001)
+    lnL_grid = _brute_force(templates, data, [axis], False)[0]
+    lnZ = np.amax(lnL_grid) + np.log(np.sum(np.exp(lnL_grid - np.amax(lnL_grid)))*(axis[1]-axis[0]))
+
+    lnL, amp = mcmc_common.profile_linear_amplitudes(templates[np.newaxis], data, marginalize=True,
+                                                     rng=np.random.default_rng(0))
+    assert np.abs(lnL[0] - lnZ) < 0.01
+
+
+def test_marginal_draws_are_reproducible():
+    templates, data = _problem([1.3, 0.7])
+    batch = np.repeat(templates[np.newaxis], 4, axis=0)
+    draws = [mcmc_common.profile_linear_amplitudes(batch, data, marginalize=True,
+                                                   rng=np.random.default_rng(seed))[1]
+             for seed in [3, 3, 4]]
+    assert np.array_equal(draws[0], draws[1])
+    assert not np.array_equal(draws[0], draws[2])
+    assert len(np.unique(draws[0][:,0])) == 4
+
+
+@pytest.mark.parametrize('gauss', [False, True])
+def test_laplace_marginal_likelihood_at_the_bound(gauss):
+    templates, data = _problem([1.3, 0.0])
+    lnL, amp = mcmc_common.profile_linear_amplitudes(templates[np.newaxis], data, gauss=gauss)
+    assert amp[0,1] == 0
+
+    # Direct integration over the positive amplitudes, half weight at the zero edge
+    axes = [np.linspace(0.5, 2.5, 601), np.linspace(0, 3, 601)]
+    lnL_grid, amp_grid = _brute_force(templates, data, axes, gauss)
+    weight = np.where(amp_grid[:,1] == 0, 0.5, 1.0)
+    lnL_max = np.amax(lnL_grid)
+    lnZ = lnL_max + np.log(np.sum(weight*np.exp(lnL_grid - lnL_max))*(axes[0][1]-axes[0][0])*(axes[1][1]-axes[1][0]))
+
+    batch = np.repeat(templates[np.newaxis], 500, axis=0)
+    lnL, draws = mcmc_common.profile_linear_amplitudes(batch, data, gauss=gauss, marginalize=True,
+                                                       rng=np.random.default_rng(0))
+    assert np.abs(lnL[0] - lnZ) < 0.15
+    assert np.all(draws > 0)
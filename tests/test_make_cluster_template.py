@@ -0,0 +1,105 @@
+"""
+Tests of the content-addressed template cache keys.
+
+"""
+
+import os
+import sys
+import subprocess
+
+import numpy as np
+import pytest
+
+from kesacco.Tools import make_cluster_template
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# A cluster-like object holding the types found in a minot Cluster
+CLUSTER_SCRIPT = """
+import numpy as np
+import astropy.units as u
+from astropy.io import fits
+from astropy.coordinates import SkyCoord
+from astropy.cosmology import Planck15
+
+class Cluster(object):
+    def __init__(self):
+        self._silent     = True
+        self._output_dir = '/tmp'
+        self._cosmo      = Planck15
+        self._coord      = SkyCoord(49.95*u.deg, 41.51*u.deg, frame='icrs')
+        self._map_coord  = SkyCoord(150.57*u.deg, -13.26*u.deg, frame='galactic')
+        self._M500       = 6e14*u.Msun
+        self._X_crp_E    = {'X':0.01, 'R_norm':1200*u.kpc}
+        self._spectrum_crp_model = {'name':'PowerLaw', 'PivotEnergy':1.0*u.TeV, 'Index':2.5}
+        self._map_fov    = [5.0, 5.0]*u.deg
+        header = fits.Header()
+        header['NAXIS1'] = 100
+        header['CDELT1'] = 0.02
+        self._map_header = header
+
+cluster = Cluster()
+energy = np.logspace(-2, 2, 30)*u.TeV
+"""
+
+
+def _key_in_subprocess():
+    script = ("import sys\n"
+              "sys.path.insert(0, "+repr(TESTS_DIR)+")\n"
+              "import _bootstrap\n"
+              "_bootstrap.load_kesacco()\n"
+              "from kesacco.Tools import make_cluster_template\n"
+              +CLUSTER_SCRIPT+
+              "print(make_cluster_template.cache_key(cluster, 'spectrum', energy, False))\n")
+    out = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True)
+    return out.stdout.strip()
+
+
+def test_cache_key_is_reproducible_across_processes():
+    key1 = _key_in_subprocess()
+    key2 = _key_in_subprocess()
+    assert key1 == key2
+
+    namespace = {}
+    exec(CLUSTER_SCRIPT, namespace)
+    key = make_cluster_template.cache_key(namespace['cluster'], 'spectrum', namespace['energy'], False)
+    assert key == key1
+
+
+def test_cache_key_depends_on_content():
+    namespace = {}
+    exec(CLUSTER_SCRIPT, namespace)
+    cluster, energy = namespace['cluster'], namespace['energy']
+    key = make_cluster_template.cache_key(cluster, 'spectrum', energy, False)
+
+    assert make_cluster_template.cache_key(cluster, 'spectrum', energy, True) != key
+    assert make_cluster_template.cache_key(cluster, 'spectrum', energy[1:], False) != key
+
+    cluster._spectrum_crp_model['Index'] = 2.6
+    assert make_cluster_template.cache_key(cluster, 'spectrum', energy, False) != key
+
+    # The silent and output_dir attributes do not change the templates
+    cluster._spectrum_crp_model['Index'] = 2.5
+    cluster._output_dir = '/somewhere/else'
+    assert make_cluster_template.cache_key(cluster, 'spectrum', energy, False) == key
+
+
+def test_cache_key_rejects_unsupported_types():
+    namespace = {}
+    exec(CLUSTER_SCRIPT, namespace)
+    cluster = namespace['cluster']
+    cluster._profile_function = lambda r: r**2
+
+    with pytest.raises(TypeError):
+        make_cluster_template.cache_key(cluster, 'map')
+
+
+def test_cache_key_galactic_and_icrs_coordinates_agree():
+    namespace = {}
+    exec(CLUSTER_SCRIPT, namespace)
+    cluster = namespace['cluster']
+    key = make_cluster_template.cache_key(cluster, 'map')
+
+    cluster._map_coord = cluster._map_coord.icrs
+    assert make_cluster_template.cache_key(cluster, 'map') == key
+    assert np.isfinite(cluster._map_coord.ra.deg)
@@ -0,0 +1,97 @@
+"""
+Tests of the MCMC sampling helpers: pool of processes and adaptive
+chain length.
+
+"""
+
+import multiprocessing
+
+import numpy as np
+import pytest
+
+for module in ['matplotlib', 'pandas', 'corner', 'h5py', 'gammalib', 'minot']:
+    pytest.importorskip(module)
+
+import emcee
+
+from kesacco.Tools import mcmc_common
+
+
+def lnprob(params, modgrid):
+    return -0.5*np.sum((params - modgrid['mean'])**2)
+
+
+def _sampler(filename, nwalkers=8, ndim=2):
+    backend = emcee.backends.HDFBackend(filename)
+    backend.reset(nwalkers, ndim)
+    modgrid = {'mean':np.zeros(ndim)}
+    sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob, args=[modgrid], backend=backend)
+    pos = np.random.default_rng(1).normal(size=(nwalkers, ndim))
+    return sampler, pos
+
+
+def test_adaptive_run_uses_a_single_pool(tmp_path, monkeypatch):
+    npool = []
+    pool_class = multiprocessing.Pool
+    def counted_pool(*args, **kwargs):
+        npool.append(1)
+        return pool_class(*args, **kwargs)
+    monkeypatch.setattr(mcmc_common.multiprocessing, 'Pool', counted_pool)
+
+    sampler, pos = _sampler(str(tmp_path/'chains.h5'))
+    mcmc_common.run_ensemble_adaptive(sampler, pos, 30, nproc=2, check_every=10, ntau=1e6)
+    assert sampler.iteration == 30
+    assert len(npool) == 1
+    assert sampler.pool is None and isinstance(sampler.log_prob_fn.args[0], dict)
+
+
+def test_adaptive_budget_includes_the_resumed_steps(tmp_path):
+    sampler, pos = _sampler(str(tmp_path/'chains.h5'))
+    mcmc_common.run_ensemble(sampler, pos, 25)
+
+    history = mcmc_common.run_ensemble_adaptive(sampler, sampler.get_last_sample(), 40,
+                                                check_every=10, ntau=1e6)
+    assert sampler.iteration == 40
+    assert [h[0] for h in history] == [35, 40]
+
+    history = mcmc_common.run_ensemble_adaptive(sampler, sampler.get_last_sample(), 40,
+                                                check_every=10, ntau=1e6)
+    assert sampler.iteration == 40 and history == []
+
+
+def _store_chains(filename, config):
+    backend, resume = mcmc_common.chains_backend(filename, 8, 2, reset=True, config=config)
+    sampler = emcee.EnsembleSampler(8, 2, lnprob, args=[{'mean':np.zeros(2)}], backend=backend)
+    sampler.run_mcmc(np.random.default_rng(1).normal(size=(8, 2)), 5)
+
+
+def test_chains_are_reset_when_the_configuration_changed(tmp_path):
+    filename = str(tmp_path/'chains.h5')
+    config = {'GaussLike':False, 'amplitudes':'sample', 'par_min':[0, 1.0], 'par_max':[np.inf, 2.0]}
+
+    _store_chains(filename, config)
+    backend, resume = mcmc_common.chains_backend(filename, 8, 2, config=dict(config))
+    assert resume and backend.iteration == 5
+
+    for key, value in [('GaussLike', True), ('amplitudes', 'profile'), ('par_max', [np.inf, 3.0])]:
+        _store_chains(filename, config)
+        changed = dict(config)
+        changed[key] = value
+        backend, resume = mcmc_common.chains_backend(filename, 8, 2, config=changed)
+        assert not resume and backend.iteration == 0
+
+
+def test_chains_statistics_reports_the_given_best_fit(tmp_path):
+    chains = np.random.default_rng(2).normal(size=(4, 50, 3))
+    lnL = -0.5*np.sum(chains**2, axis=2)
+    ibest = np.unravel_index(np.argmax(lnL), lnL.shape)
+
+    par_best = mcmc_common.chains_statistics(chains, lnL, show=False)[0]
+    assert np.array_equal(par_best, chains[ibest])
+
+    outfile = str(tmp_path/'chainstat.txt')
+    par_best = mcmc_common.chains_statistics(chains, lnL, parname=['a', 'b', 'c'],
+                                             outfile=outfile, par_best=[0.5, 1.5, 2.5])[0]
+    assert np.array_equal(par_best, [0.5, 1.5, 2.5])
+    with open(outfile) as f:
+        assert '  best   = 1.5 ' in f.read()
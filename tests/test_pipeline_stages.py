@@ -0,0 +1,139 @@
+"""
+Tests of the stage executor: fingerprints and skipping of the
+stages whose inputs did not change.
+
+"""
+
+import os
+import sys
+import subprocess
+
+from kesacco.Tools import pipeline_stages
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CONFIG_SCRIPT = """
+import astropy.units as u
+from astropy.coordinates import SkyCoord
+config = {'map_coord':SkyCoord(0.0, 0.0, frame='icrs', unit='deg'), 'map_reso':0.02*u.deg,
+          'spec_emin':50*u.GeV, 'obsID':['001', '002'], 'method_stack':True}
+"""
+
+
+def _write(filename, text):
+    with open(filename, 'w') as f:
+        f.write(text)
+
+
+def _touch_later(filename):
+    info = os.stat(filename)
+    os.utime(filename, ns=(info.st_atime_ns, info.st_mtime_ns+10**9))
+
+
+def _make_stages(tmp_path, calls, inputs=[], outputs=True):
+    def run(name):
+        def function():
+            calls.append(name)
+            if outputs:
+                _write(str(tmp_path/(name+'.out')), name)
+        return function
+
+    namespace = {}
+    exec(CONFIG_SCRIPT, namespace)
+    stages = [pipeline_stages.make_stage('a', run('a'), inputs=inputs, params=namespace['config'],
+                                         outputs=[str(tmp_path/'a.out')] if outputs else []),
+              pipeline_stages.make_stage('b', run('b'), depends=['a'],
+                                         outputs=[str(tmp_path/'b.out')] if outputs else [])]
+    return stages
+
+
+def test_unchanged_stages_are_skipped(tmp_path):
+    infile = str(tmp_path/'input.txt')
+    _write(infile, 'data')
+    record = str(tmp_path/'stages.json')
+
+    calls = []
+    pipeline_stages.run_stages(_make_stages(tmp_path, calls, inputs=[infile]), record, silent=True)
+    assert calls == ['a', 'b']
+
+    calls = []
+    executed = pipeline_stages.run_stages(_make_stages(tmp_path, calls, inputs=[infile]), record, silent=True)
+    assert calls == [] and executed == []
+
+
+def test_changed_input_reruns_the_stage_and_its_dependents(tmp_path):
+    infile = str(tmp_path/'input.txt')
+    _write(infile, 'data')
+    record = str(tmp_path/'stages.json')
+    pipeline_stages.run_stages(_make_stages(tmp_path, []), record, silent=True)
+
+    calls = []
+    pipeline_stages.run_stages(_make_stages(tmp_path, calls, inputs=[infile]), record, silent=True)
+    assert calls == ['a', 'b']
+
+    _write(infile, 'new data')
+    _touch_later(infile)
+    calls = []
+    pipeline_stages.run_stages(_make_stages(tmp_path, calls, inputs=[infile]), record, silent=True)
+    assert calls == ['a', 'b']
+
+
+def test_missing_output_reruns_the_stage(tmp_path):
+    record = str(tmp_path/'stages.json')
+    pipeline_stages.run_stages(_make_stages(tmp_path, []), record, silent=True)
+
+    os.remove(str(tmp_path/'b.out'))
+    calls = []
+    pipeline_stages.run_stages(_make_stages(tmp_path, calls), record, silent=True)
+    assert calls == ['b']
+
+
+def test_stages_without_outputs_always_run(tmp_path):
+    record = str(tmp_path/'stages.json')
+    pipeline_stages.run_stages(_make_stages(tmp_path, [], outputs=False), record, silent=True)
+
+    calls = []
+    pipeline_stages.run_stages(_make_stages(tmp_path, calls, outputs=False), record, silent=True)
+    assert calls == ['a', 'b']
+
+
+def test_event_files_of_the_observation_definition(tmp_path):
+    evfile = str(tmp_path/'Events001.fits')
+    _write(evfile, 'events')
+    xmlfile = str(tmp_path/'Events.xml')
+    _write(xmlfile, '<?xml version="1.0" standalone="no"?>\n'
+                    '<observation_list title="observation library">\n'
+                    '  <observation name="Cluster" id="001" instrument="CTA">\n'
+                    '    <parameter name="EventList" file="'+evfile+'" />\n'
+                    '  </observation>\n'
+                    '  <observation name="Cluster" id="002" instrument="CTA">\n'
+                    '    <parameter name="EventList" file="Events002.fits" />\n'
+                    '  </observation>\n'
+                    '</observation_list>\n')
+
+    files = pipeline_stages.obsdef_event_files(xmlfile)
+    assert files == [evfile, str(tmp_path/'Events002.fits')]
+    assert pipeline_stages.obsdef_event_files(str(tmp_path/'missing.xml')) == []
+
+    # A replaced event file is detected, although the xml file did not change
+    record = str(tmp_path/'stages.json')
+    pipeline_stages.run_stages(_make_stages(tmp_path, [], inputs=[xmlfile]+files), record, silent=True)
+    _write(evfile, 'other events')
+    _touch_later(evfile)
+    calls = []
+    pipeline_stages.run_stages(_make_stages(tmp_path, calls, inputs=[xmlfile]+files), record, silent=True)
+    assert calls == ['a', 'b']
+
+
+def test_fingerprint_is_reproducible_across_processes(tmp_path):
+    script = ("import sys\n"
+              "sys.path.insert(0, "+repr(TESTS_DIR)+")\n"
+              "import _bootstrap\n"
+              "_bootstrap.load_kesacco()\n"
+              "from kesacco.Tools import pipeline_stages\n"
+              +CONFIG_SCRIPT+
+              "stage = pipeline_stages.make_stage('a', None, params=config)\n"
+              "print(pipeline_stages.stage_fingerprint(stage, {}))\n")
+    keys = [subprocess.run([sys.executable, '-c', script], capture_output=True, text=True,
+                           check=True).stdout.strip() for i in range(2)]
+    assert keys[0] == keys[1]
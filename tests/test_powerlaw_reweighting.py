@@ -0,0 +1,85 @@
+"""
+Tests of the spectral index grids obtained by reweighting the energy
+bins of a reference cube.
+
+"""
+
+import numpy as np
+import pytest
+import astropy.units as u
+from astropy.io import fits
+from astropy.table import Table
+from scipy.integrate import quad
+
+for module in ['matplotlib', 'pandas', 'corner', 'gammalib', 'ctools', 'minot']:
+    pytest.importorskip(module)
+
+from kesacco.Tools import mcmc_spectralimaging2
+
+
+EBINS = np.logspace(-1.3, 2, 11)*u.TeV
+PIVOT = 1.0*u.TeV
+
+
+@pytest.mark.parametrize('index, shift', [(-2.0, 0.3), (-2.5, -0.7), (-1.5, 0.5), (-2.0, 1.0)])
+def test_ratio_matches_numerical_integration(index, shift):
+    emin, emax = EBINS[:-1], EBINS[1:]
+    ratio = mcmc_spectralimaging2.powerlaw_shift_ratio(emin.to('GeV'), emax.to('GeV'), index, shift, PIVOT)
+
+    for i in range(len(emin)):
+        lo, hi = emin[i].to_value('TeV'), emax[i].to_value('TeV')
+        shifted = quad(lambda e: e**(index+shift), lo, hi, epsrel=1e-12)[0]
+        reference = quad(lambda e: e**index, lo, hi, epsrel=1e-12)[0]
+        assert np.isclose(ratio[i], shifted/reference, rtol=1e-8)
+
+
+def _cube_maker(tmp_path, calls, index=-2.2, bias=0.0):
+    """Cubes of a power law times a fixed image, as ctools would compute them."""
+    image = np.outer(np.hanning(6), np.hanning(5)) + 0.1
+    ebounds = Table()
+    ebounds['E_MIN'] = EBINS[:-1]
+    ebounds['E_MAX'] = EBINS[1:]
+
+    def make_cube(shift, extj):
+        calls.append(extj)
+        gamma = index + shift + bias*(shift != 0)
+        x = EBINS.to_value('TeV')
+        spec = (x[1:]**(gamma+1) - x[:-1]**(gamma+1))/(gamma+1)
+        hdul = fits.HDUList([fits.PrimaryHDU(spec[:,np.newaxis,np.newaxis]*image),
+                             fits.BinTableHDU(ebounds, name='EBOUNDS')])
+        hdul.writeto(str(tmp_path/('Cube_'+extj+'.fits')), overwrite=True)
+        return index, PIVOT
+
+    return make_cube
+
+
+def test_reweighted_cubes_match_the_direct_computation(tmp_path):
+    shifts = np.linspace(-0.5, 0.5, 5)
+    calls = []
+    mcmc_spectralimaging2.build_shifted_cubes(_cube_maker(tmp_path, calls), str(tmp_path/'Cube_'),
+                                              shifts, 'test')
+    assert calls == ['TMP_REF']
+
+    (tmp_path/'direct').mkdir()
+    direct = str(tmp_path/'direct')
+    make_direct = _cube_maker(tmp_path/'direct', [])
+    for j in range(len(shifts)):
+        make_direct(shifts[j], 'TMP_'+str(j))
+        assert np.allclose(fits.getdata(str(tmp_path/('Cube_TMP_'+str(j)+'.fits'))),
+                           fits.getdata(direct+'/Cube_TMP_'+str(j)+'.fits'), rtol=1e-10)
+
+
+def test_energy_dispersion_check(tmp_path):
+    shifts = np.linspace(-0.5, 0.5, 5)
+
+    # Consistent cubes: a single check cube is computed
+    calls = []
+    mcmc_spectralimaging2.build_shifted_cubes(_cube_maker(tmp_path, calls), str(tmp_path/'Cube_'),
+                                              shifts, 'test', edisp=True, tol=1e-6)
+    assert calls == ['TMP_REF', 'TMP_CHECK']
+
+    # Inconsistent cubes: all the cubes are computed directly
+    calls = []
+    mcmc_spectralimaging2.build_shifted_cubes(_cube_maker(tmp_path, calls, bias=0.1), str(tmp_path/'Cube_'),
+                                              shifts, 'test', edisp=True, tol=0.01)
+    assert calls == ['TMP_REF', 'TMP_CHECK'] + ['TMP_'+str(j) for j in range(len(shifts))]
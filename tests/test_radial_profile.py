@@ -0,0 +1,70 @@
+"""
+Tests of the precomputed radial profiler against the minot profile
+it replaces.
+
+"""
+
+import numpy as np
+import pytest
+from astropy.wcs import WCS
+
+map_tools = pytest.importorskip('minot.ClusterTools.map_tools')
+
+from kesacco.Tools import radial_profile
+
+
+def _header(npix=41, reso=0.02, ra0=83.6, dec0=22.0):
+    w = WCS(naxis=2)
+    w.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    w.wcs.crval = [ra0, dec0]
+    w.wcs.crpix = [(npix+1)/2.0, (npix+1)/2.0]
+    w.wcs.cdelt = [-reso, reso]
+    header = w.to_header()
+    header['NAXIS'] = 2
+    header['NAXIS1'] = npix
+    header['NAXIS2'] = npix
+    return header
+
+
+def _maps(seed=4, npix=41):
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:npix, 0:npix]
+    expected = 5.0 + 50.0*np.exp(-0.5*((x-18)**2 + (y-22)**2)/6.0**2)
+    counts = rng.poisson(expected).astype(float)
+    return counts, expected
+
+
+@pytest.mark.parametrize('stat, residual', [('GAUSSIAN', True), ('POISSON', True), ('POISSON', False)])
+@pytest.mark.parametrize('counts2brightness', [False, True])
+def test_profile_matches_minot(stat, residual, counts2brightness):
+    header = _header()
+    center = [83.65, 22.03]
+    counts, expected = _maps()
+    image = counts - expected if residual else counts
+    stddev = np.sqrt(expected)
+    stddev[0, 0] = 0.0 # pixel ignored in both profilers
+
+    profiler = radial_profile.RadialProfiler(header, center, 0.1)
+    r, p, err = profiler.profile(image, stddev=stddev, stat=stat,
+                                 counts2brightness=counts2brightness, residual=residual)
+    r_ref, p_ref, err_ref = map_tools.radial_profile_cts(image, center, stddev=stddev, header=header,
+                                                         binsize=0.1, stat=stat,
+                                                         counts2brightness=counts2brightness,
+                                                         residual=residual)
+
+    assert np.allclose(r, r_ref, rtol=1e-12)
+    assert np.allclose(p, p_ref, rtol=1e-10, equal_nan=True)
+    assert np.allclose(err, err_ref, rtol=1e-10, equal_nan=True)
+
+
+def test_stack_of_maps():
+    header = _header()
+    center = [83.6, 22.0]
+    stack = np.array([_maps(seed)[0] for seed in range(5)])
+    expected = _maps()[1]
+
+    profiler = radial_profile.RadialProfiler(header, center, 0.08)
+    r, p, err = profiler.profile(stack, stddev=np.sqrt(expected), stat='POISSON', residual=False)
+    for i in range(len(stack)):
+        r_i, p_i, err_i = profiler.profile(stack[i], stddev=np.sqrt(expected), stat='POISSON', residual=False)
+        assert np.allclose(p[i], p_i) and np.allclose(err[i], err_i)
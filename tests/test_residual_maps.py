@@ -0,0 +1,55 @@
+"""
+Tests of the residual maps computed in NumPy, against values computed
+by hand from the csresmap formulas.
+
+"""
+
+import os
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+for module in ['gammalib', 'ctools', 'cscripts', 'minot']:
+    pytest.importorskip(module)
+
+from kesacco.Tools import tools_imaging
+
+
+def _write_cube(filename, cube):
+    hdu = fits.PrimaryHDU(data=np.array(cube, dtype=float))
+    for key, val in [('CTYPE1', 'RA---CAR'), ('CTYPE2', 'DEC--CAR'), ('CTYPE3', 'ENERGY'),
+                     ('CRVAL1', 10.0), ('CRVAL2', 0.0), ('CRVAL3', 1.0),
+                     ('CRPIX1', 2.0), ('CRPIX2', 1.5), ('CRPIX3', 1.0),
+                     ('CDELT1', -0.1), ('CDELT2', 0.1), ('CDELT3', 1.0)]:
+        hdu.header[key] = val
+    hdu.writeto(filename)
+    return filename
+
+
+def test_residual_maps_match_the_csresmap_formulas(tmp_path):
+    # Summed over energy, counts = [[4, 0, 2], [1, 9, 0]] and model = [[1, 2, 0], [1, 4, 0]]
+    cntcube = _write_cube(str(tmp_path/'cnt.fits'), [[[3, 0, 1], [1, 4, 0]],
+                                                     [[1, 0, 1], [0, 5, 0]]])
+    modcube = _write_cube(str(tmp_path/'mod.fits'), [[[0.5, 1.5, 0], [0.25, 1, 0]],
+                                                     [[0.5, 0.5, 0], [0.75, 3, 0]]])
+
+    outmaps = {'SUB':str(tmp_path/'sub.fits')}
+    residuals, model, header = tools_imaging.residual_maps(cntcube, modcube, outmaps=outmaps)
+
+    assert np.allclose(model, [[1, 2, 0], [1, 4, 0]])
+    assert header['NAXIS'] == 2
+    expected = {'SUB':          [[3, -2, 2], [0, 5, 0]],
+                'SUBDIV':       [[3, -1, 0], [0, 1.25, 0]],
+                'SUBDIVSQRT':   [[3, -np.sqrt(2), 0], [0, 2.5, 0]],
+                'SIGNIFICANCE': [[np.sqrt(2*(4*np.log(4) + 1 - 4)), -np.sqrt(2*2), 0],
+                                 [0, np.sqrt(2*(9*np.log(9/4.0) + 4 - 9)), 0]]}
+    assert sorted(residuals.keys()) == sorted(expected.keys())
+    for algo in expected:
+        assert np.allclose(residuals[algo], expected[algo], rtol=0, atol=1e-12), algo
+
+    assert np.allclose(fits.getdata(outmaps['SUB']), expected['SUB'])
+    assert sorted(os.listdir(str(tmp_path))) == ['cnt.fits', 'mod.fits', 'sub.fits']
+
+    with pytest.raises(ValueError):
+        tools_imaging.residual_maps(cntcube, modcube, algos=['CHI2'])
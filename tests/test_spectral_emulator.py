@@ -0,0 +1,69 @@
+"""
+Tests of the spectral emulator of the spectrum fit against the direct
+minot computation.
+
+"""
+
+import numpy as np
+import pytest
+
+for module in ['matplotlib', 'pandas', 'corner', 'seaborn', 'gammalib', 'minot']:
+    pytest.importorskip(module)
+
+import minot
+
+from kesacco.Tools import mcmc_spectrum
+
+ENERGY = np.logspace(1, 5, 15) # GeV
+
+
+@pytest.fixture(scope='module')
+def cluster(tmp_path_factory):
+    return minot.Cluster(name='Test', redshift=0.03, M500=5e14*minot.model.u.Msun,
+                         output_dir=str(tmp_path_factory.mktemp('cluster')), silent=True)
+
+
+def test_emulator_accuracy(cluster, tmp_path):
+    report_file = str(tmp_path/'emulator.txt')
+    emulator = mcmc_spectrum.build_emulator(cluster, ENERGY, 2.0, 3.0, index_npt=21,
+                                            Ncheck=0, report_file=report_file)
+
+    # Exact at the grid nodes, linear in the normalization
+    direct = mcmc_spectrum.model_dNdEdSdt(cluster, ENERGY, [1.0, emulator['index'][7]])
+    assert np.allclose(mcmc_spectrum.emulator_model(emulator, [2.5, emulator['index'][7]]), 2.5*direct,
+                       rtol=1e-10)
+
+    # Halfway between the nodes, where the interpolation error is the largest. The
+    # default grid step (0.05) gives percent accuracy, and the error decreases as step^2
+    max_error = mcmc_spectrum.emulator_accuracy(cluster, emulator, Ncheck=3, outfile=report_file)
+    assert max_error < 1e-2
+    with open(report_file) as f:
+        assert 'max relative error' in f.read()
+
+    emulator_fine = mcmc_spectrum.build_emulator(cluster, ENERGY, 2.0, 3.0, index_npt=41, Ncheck=0)
+    assert mcmc_spectrum.emulator_accuracy(cluster, emulator_fine, Ncheck=3) < max_error/3
+
+    # Batch of walkers
+    params = np.array([[1.0, 2.13], [0.5, 2.77]])
+    batch = mcmc_spectrum.emulator_model(emulator, params)
+    for i in range(len(params)):
+        assert np.allclose(batch[i], mcmc_spectrum.emulator_model(emulator, params[i]))
+
+
+def test_emulator_cache(cluster, tmp_path, monkeypatch):
+    cache_file = str(tmp_path/'emulator.npz')
+    emulator = mcmc_spectrum.build_emulator(cluster, ENERGY, 2.0, 3.0, index_npt=5,
+                                            cache_file=cache_file, Ncheck=0)
+
+    calls = []
+    model = mcmc_spectrum.model_dNdEdSdt
+    monkeypatch.setattr(mcmc_spectrum, 'model_dNdEdSdt', lambda *args: calls.append(1) or model(*args))
+
+    cached = mcmc_spectrum.build_emulator(cluster, ENERGY, 2.0, 3.0, index_npt=5,
+                                          cache_file=cache_file, Ncheck=0)
+    assert calls == []
+    assert np.array_equal(cached['lnmodel'], emulator['lnmodel'])
+
+    # Another index grid is not read from the cache
+    mcmc_spectrum.build_emulator(cluster, ENERGY, 2.0, 3.5, index_npt=5, cache_file=cache_file, Ncheck=0)
+    assert len(calls) == 5